@@ -0,0 +1,193 @@
+"""Компактная запись действий пользователя.
+
+Действие хранится кортежем (код, время, данные): код - ActionCode, время -
+миллисекунды Unix, данные - маленький словарь. Текст для людей ("Использована
+подсказка 1 для вопроса 1") выводится из кода и данных функцией describe()
+только там, где его читают: в /user_logs и при экспорте.
+
+В хранилище данные пишутся позиционным JSON-массивом по полям PAYLOAD_FIELDS
+кода (`[1,2,{"hugs":5}]` вместо словаря с именами ключей). Если набор ключей
+не укладывается в схему, пишется обычный словарь - читаются оба вида.
+"""
+import json
+import time
+from datetime import datetime, timezone
+from enum import IntEnum
+from typing import Dict, NamedTuple, Optional, Union
+
+
+class ActionCode(IntEnum):
+    """Коды действий. Значения хранятся в базе - не меняйте их, только добавляйте новые"""
+    OTHER = 0  # действие старого формата без кода, имя лежит в данных
+    INIT = 1
+    USER_MESSAGE = 2
+    WRONG_ANSWER = 3
+    QUEST_STARTED = 4
+    HINT_USED = 5
+    CORRECT_ANSWER = 6
+    SOLUTION_SHOWN = 7
+    ADVANCED = 8
+    RESTART = 9
+    DEBT_CLEARED = 10
+    DEBT_REPAID = 11
+    REMINDERS_SET = 12
+    LEADERBOARD_SET = 13
+    QUEST_COMPLETED = 14
+    TIMER = 15
+
+
+# Поля данных по порядку для позиционной записи. Необязательные поля (участник команды) - в конце
+MEMBER_FIELDS = ('by', 'by_name')
+PAYLOAD_FIELDS = {
+    ActionCode.USER_MESSAGE: ('message',) + MEMBER_FIELDS,
+    ActionCode.WRONG_ANSWER: ('question_id', 'user_answer') + MEMBER_FIELDS,
+    ActionCode.HINT_USED: ('question_id', 'hint_num', 'debit') + MEMBER_FIELDS,
+    ActionCode.CORRECT_ANSWER: ('question_id',) + MEMBER_FIELDS,
+    ActionCode.SOLUTION_SHOWN: ('question_id', 'debit') + MEMBER_FIELDS,
+    ActionCode.ADVANCED: ('question_id', 'unlocked'),
+    ActionCode.RESTART: ('attempt', 'credit', 'from_question'),
+    ActionCode.DEBT_CLEARED: ('credit',),
+    ActionCode.DEBT_REPAID: ('credit',),
+    ActionCode.REMINDERS_SET: ('enabled',),
+    ActionCode.LEADERBOARD_SET: ('name',),
+    ActionCode.TIMER: ('kind',),
+}
+
+DEBT_LABELS = {'hugs': 'обнимашки', 'kisses': 'поцелуи', 'wishes': 'желания'}
+
+_CODES_BY_NAME = {code.name: code for code in ActionCode}
+
+
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+
+def to_ms(value: Union[int, float, str]) -> int:
+    """Метка времени в миллисекундах. Старые метки ISO без часового пояса считаются UTC"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1000)
+
+
+def ms_to_datetime(ms: int) -> datetime:
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+
+
+def ms_to_iso(ms: int) -> str:
+    return ms_to_datetime(ms).isoformat()
+
+
+def format_ms(ms: Optional[Union[int, str]]) -> str:
+    """Время для людей: 2025-01-31 12:00:00 (UTC)"""
+    if ms is None:
+        return '-'
+    return ms_to_datetime(to_ms(ms)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class ActionRecord(NamedTuple):
+    """Одно действие: код, время в мс и данные"""
+    code: ActionCode
+    ts: int
+    data: Dict
+
+    @property
+    def name(self) -> str:
+        if self.code == ActionCode.OTHER:
+            return self.data.get('action', 'OTHER')
+        return self.code.name
+
+    @property
+    def details(self) -> str:
+        return describe(self.code, self.data)
+
+    @classmethod
+    def from_legacy(cls, action: Dict) -> 'ActionRecord':
+        """Из записи старого формата: {'timestamp': ISO, 'action': имя, 'details': текст, 'data': {...}}"""
+        data = dict(action.get('data') or {})
+        code = _CODES_BY_NAME.get(action['action'])
+        if code is None:
+            # Неизвестное действие: сохраняем имя и текст, их не из чего вывести
+            code = ActionCode.OTHER
+            data['action'] = action['action']
+            data['details'] = action.get('details', '')
+        return cls(code, to_ms(action['timestamp']), data)
+
+
+def encode_data(code: ActionCode, data: Dict) -> str:
+    """Данные действия для хранилища: позиционный массив, если ключи укладываются в схему кода"""
+    if not data:
+        return ''
+    fields = PAYLOAD_FIELDS.get(code, ())
+    if len(data) <= len(fields) and all(field in data for field in fields[:len(data)]):
+        payload = [data[field] for field in fields[:len(data)]]
+    else:
+        payload = data
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+
+
+def decode_data(code: ActionCode, text: str) -> Dict:
+    if not text:
+        return {}
+    payload = json.loads(text)
+    if isinstance(payload, list):
+        return dict(zip(PAYLOAD_FIELDS[code], payload))
+    return payload
+
+
+def encode(record: ActionRecord) -> tuple:
+    """Запись для хранилища: (код, время в мс, данные)"""
+    return int(record.code), record.ts, encode_data(record.code, record.data)
+
+
+def decode(code: int, ts: int, data: str) -> ActionRecord:
+    code = ActionCode(code)
+    return ActionRecord(code, ts, decode_data(code, data))
+
+
+def _debt_text(amounts: Dict[str, int]) -> str:
+    parts = [f'{DEBT_LABELS.get(kind, kind)}: {amount}' for kind, amount in amounts.items() if amount]
+    return ', '.join(parts) if parts else 'ничего'
+
+
+def describe(code: ActionCode, data: Dict) -> str:
+    """Текст действия для людей"""
+    if code == ActionCode.INIT:
+        text = 'Создан новый прогресс пользователя'
+    elif code == ActionCode.USER_MESSAGE:
+        text = 'Пользователь отправил сообщение'
+    elif code == ActionCode.WRONG_ANSWER:
+        text = f"Неправильный ответ на вопрос {data.get('question_id')}"
+    elif code == ActionCode.QUEST_STARTED:
+        text = 'Пользователь начал квест'
+    elif code == ActionCode.HINT_USED:
+        text = f"Использована подсказка {data.get('hint_num')} для вопроса {data.get('question_id')}"
+    elif code == ActionCode.CORRECT_ANSWER:
+        text = f"Правильный ответ на вопрос {data.get('question_id')}"
+    elif code == ActionCode.SOLUTION_SHOWN:
+        text = f"Показано решение вопроса {data.get('question_id')}"
+    elif code == ActionCode.ADVANCED:
+        text = f"Переход к вопросу {data.get('question_id')}"
+    elif code == ActionCode.RESTART:
+        text = 'Сброс прогресса'
+        if 'from_question' in data:
+            text += f". Старый прогресс: {data['from_question']} вопрос"
+    elif code == ActionCode.DEBT_CLEARED:
+        text = f"Очистка долга. Было: {_debt_text(data.get('credit', {}))}"
+    elif code == ActionCode.DEBT_REPAID:
+        text = f"Погашено {_debt_text(data.get('credit', {}))}"
+    elif code == ActionCode.REMINDERS_SET:
+        text = f"Напоминания {'включены' if data.get('enabled') else 'выключены'}"
+    elif code == ActionCode.LEADERBOARD_SET:
+        text = f"Участие в таблице лидеров: {data['name']}" if data.get('name') else 'Выход из таблицы лидеров'
+    elif code == ActionCode.QUEST_COMPLETED:
+        text = 'Пользователь завершил квест'
+    elif code == ActionCode.TIMER:
+        text = f"Сработал таймер {data.get('kind')}"
+    else:
+        text = data.get('details') or data.get('action', code.name)
+    if data.get('by_name'):
+        text += f" ({data['by_name']})"
+    return text
@@ -0,0 +1,182 @@
+"""Картинки загадок из папки images/.
+
+Каждый исходник один раз превращается в вариант под ограничения Telegram
+для фото (сторона не больше 1280 пикселей, JPEG или сжатый PNG - что
+меньше). Вариант лежит в кэше под хэшем содержимого исходника и параметров
+сжатия. После первой отправки Telegram возвращает file_id - он тоже
+запоминается по хэшу, и дальше картинка отправляется без загрузки байтов.
+Если картинку поменять, изменится только ее хэш и заново загрузится только она.
+
+Pillow необязателен: без него отправляется исходный файл (тоже с кэшем file_id).
+Импортируется он только при сборке варианта, чтобы не замедлять запуск бота.
+
+Бот собирает варианты сам при прогреве; заранее это можно сделать так:
+    python assets.py --source images --cache images/.cache
+
+Картинку, которую не удалось прочитать, photo() не отдает (None): вопрос
+тогда отправляется текстом, а не падает целиком.
+"""
+import argparse
+import hashlib
+import importlib.util
+import io
+import logging
+import os
+from typing import Dict, Optional, Union
+
+# Pillow необязателен, без него отправляем исходники
+HAS_PIL = importlib.util.find_spec('PIL') is not None
+
+logger = logging.getLogger(__name__)
+
+# Telegram все равно ужимает фото до 1280 по большей стороне - больше загружать незачем
+MAX_SIDE = 1280
+JPEG_QUALITY = 85
+# Версия параметров сжатия: при их изменении все варианты пересобираются
+VARIANT_VERSION = f"{MAX_SIDE}-{JPEG_QUALITY}-{'pil' if HAS_PIL else 'raw'}"
+
+# По умолчанию картинки лежат рядом с ботом, а не в текущем каталоге запуска
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images')
+IMAGE_CACHE_DIR = os.path.join(IMAGES_DIR, '.cache')
+
+
+class ImageAssets:
+    """Готовые к отправке варианты картинок и кэш file_id по хэшу содержимого"""
+
+    def __init__(self, source_dir: str = IMAGES_DIR, cache_dir: str = IMAGE_CACHE_DIR,
+                 file_ids: Optional[Dict[str, str]] = None):
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.hashes: Dict[str, str] = {}  # имя исходника -> хэш варианта
+        self.file_ids: Dict[str, str] = dict(file_ids or {})  # хэш -> file_id в Telegram
+        self.changed = False  # file_ids изменились и их нужно сохранить
+
+    def build(self) -> int:
+        """Готовит варианты для всех картинок папки. Возвращает, сколько собрано заново"""
+        if not os.path.isdir(self.source_dir):
+            return 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        built = 0
+        for name in sorted(os.listdir(self.source_dir)):
+            if not os.path.isfile(os.path.join(self.source_dir, name)):
+                continue
+            try:
+                built += self._prepare(name)
+            except OSError as e:
+                logger.warning(f"Картинка {name} пропущена: {e}")
+
+        # file_id картинок, которых больше нет (или которые поменялись), не нужны
+        live = set(self.hashes.values())
+        stale = [digest for digest in self.file_ids if digest not in live]
+        for digest in stale:
+            del self.file_ids[digest]
+        self.changed = self.changed or bool(stale)
+        return built
+
+    def _prepare(self, name: str) -> bool:
+        """Считает хэш исходника и при необходимости собирает вариант. True - собран заново"""
+        with open(os.path.join(self.source_dir, name), 'rb') as f:
+            source = f.read()
+        digest = hashlib.sha256(source + VARIANT_VERSION.encode()).hexdigest()[:16]
+
+        built = False
+        if not self._variant_path(digest):
+            data, ext = self._optimize(source)
+            with open(os.path.join(self.cache_dir, digest + ext), 'wb') as f:
+                f.write(data)
+            logger.info(f"Картинка {name}: {len(source)} -> {len(data)} байт")
+            built = True
+        # Хэш запоминается только для картинки, у которой есть готовый вариант
+        self.hashes[name] = digest
+        return built
+
+    def _variant_path(self, digest: str) -> Optional[str]:
+        for ext in ('.jpg', '.png'):
+            path = os.path.join(self.cache_dir, digest + ext)
+            if os.path.exists(path):
+                return path
+        return None
+
+    @staticmethod
+    def _optimize(source: bytes):
+        """Уменьшает картинку и выбирает самый компактный формат"""
+        if not HAS_PIL:
+            return source, '.png' if source.startswith(b'\x89PNG') else '.jpg'
+
+        from PIL import Image
+        image = Image.open(io.BytesIO(source))
+        image.thumbnail((MAX_SIDE, MAX_SIDE))
+        candidates = []
+
+        if image.mode in ('RGBA', 'LA', 'P'):
+            png = io.BytesIO()
+            image.save(png, format='PNG', optimize=True)
+            candidates.append((png.getvalue(), '.png'))
+            # Прозрачность в JPEG теряется - подкладываем белый фон
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image.convert('RGBA'), mask=image.convert('RGBA').split()[-1])
+            image = background
+
+        jpeg = io.BytesIO()
+        image.convert('RGB').save(jpeg, format='JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+        candidates.append((jpeg.getvalue(), '.jpg'))
+        return min(candidates, key=lambda candidate: len(candidate[0]))
+
+    def photo(self, name: str) -> Optional[Union[str, bytes]]:
+        """Что передать в reply_photo: file_id, если картинка уже загружалась, иначе байты варианта.
+
+        None - картинку не удалось прочитать (нет файла, битый файл), отправлять ее не нужно.
+        """
+        try:
+            if name not in self.hashes:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                self._prepare(name)
+            digest = self.hashes[name]
+
+            file_id = self.file_ids.get(digest)
+            if file_id:
+                return file_id
+            path = self._variant_path(digest)
+            if path is None:
+                # Кэш вариантов почистили на ходу - собираем вариант заново
+                os.makedirs(self.cache_dir, exist_ok=True)
+                self._prepare(name)
+                path = self._variant_path(self.hashes[name])
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError as e:
+            logger.warning(f"Картинка {name} недоступна, вопрос уйдет без нее: {e}")
+            return None
+
+    def remember(self, name: str, message) -> bool:
+        """Запоминает file_id после отправки. False - фото не отправилось (file_id устарел?)"""
+        digest = self.hashes.get(name)
+        if digest is None:
+            return False
+        if message is None or not message.photo:
+            # Telegram не принял фото по file_id - в следующий раз загрузим байты заново
+            if self.file_ids.pop(digest, None):
+                self.changed = True
+            return False
+        file_id = message.photo[-1].file_id
+        if self.file_ids.get(digest) != file_id:
+            self.file_ids[digest] = file_id
+            self.changed = True
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка вариантов картинок квеста")
+    parser.add_argument('--source', default=IMAGES_DIR, help="папка с исходными картинками")
+    parser.add_argument('--cache', default=IMAGE_CACHE_DIR, help="куда положить варианты")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    assets = ImageAssets(args.source, args.cache)
+    built = assets.build()
+    print(f"{len(assets.hashes)} картинок, собрано заново: {built}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""Микробенчмарки горячих путей бота.
+
+Запуск:
+    python bench.py keyboards
+    python bench.py escaping
+    python bench.py leaderboard
+    python bench.py actions
+    python bench.py startup        # код выхода 1, если запуск не уложился в STARTUP_BUDGET_MS
+"""
+import argparse
+import json
+import re
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from actions import ActionCode, ActionRecord, encode_data, ms_to_iso, now_ms
+from bot import QUESTIONS, KeyboardRegistry, UserProgress, user_actions_logger
+from formatting import escape_html
+from storage import ProgressChanges, ProgressStore
+
+
+def _allocations_per_call(func, iterations: int) -> float:
+    """Сколько новых объектов остается живыми на один вызов (результаты удерживаются)"""
+    results = [None] * iterations
+    func()  # прогрев
+    before = sys.getallocatedblocks()
+    for i in range(iterations):
+        results[i] = func()
+    after = sys.getallocatedblocks()
+    return (after - before) / iterations
+
+
+def _timeit(func, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e9
+
+
+def bench_keyboards(iterations: int):
+    """Клавиатура вопроса на пути подсказки: сборка заново против общего реестра"""
+    registry = KeyboardRegistry(QUESTIONS)
+    progress = UserProgress(1, log_init=False)
+    progress.add_hint_used(3, 1)
+    question_id = 3
+
+    def build():
+        return KeyboardRegistry._build_question_keyboard(
+            question_id, KeyboardRegistry.question_state(progress, question_id))
+
+    def lookup():
+        return registry.question(question_id, KeyboardRegistry.question_state(progress, question_id))
+
+    for name, func in (('сборка', build), ('реестр', lookup)):
+        print(f"{name:>8}: {_timeit(func, iterations):8.0f} нс/вызов, "
+              f"{_allocations_per_call(func, iterations):5.1f} объектов/вызов")
+
+
+def _escape_replace_chain(text: str) -> str:
+    """Прежний способ: три str.replace подряд, каждый копирует строку"""
+    return str(text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+_ESCAPE_REGEX = re.compile(r'[&<>]')
+_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+
+
+def _escape_translate(text: str) -> str:
+    return str(text).translate(_ESCAPE_TABLE)
+
+
+def _escape_regex(text: str) -> str:
+    return _ESCAPE_REGEX.sub(lambda match: _ESCAPES[match.group()], str(text))
+
+
+def bench_escaping(iterations: int):
+    """Экранирование HTML (escape_html): строки пользователей, значения с разметкой и логи"""
+    user_texts = ["Вася Пупкин", "ответ наверное", "john.doe", "воспоминания", "Ёжик", "42"]
+    markup_texts = ["<script>", "Tom & Jerry", "a < b > c"]
+    logs = ["2025-01-01 12:00:00 - USER:1 - ACTION:HINT_USED - DATA:{'question_id': 1}\n" * 20]
+
+    functions = (('replace x3', _escape_replace_chain), ('translate', _escape_translate),
+                 ('regex', _escape_regex), ('escape_html', escape_html))
+    for samples in (user_texts, markup_texts, logs):
+        assert all(len({func(sample) for _, func in functions}) == 1 for sample in samples)
+
+    rounds = max(1, iterations // len(user_texts))
+    for name, func in functions:
+        timings = []
+        for samples in (user_texts, markup_texts, logs):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for sample in samples:
+                    func(sample)
+            timings.append((time.perf_counter() - start) / (rounds * len(samples)) * 1e9)
+        print(f"{name:>12}: имена и ответы {timings[0]:6.0f} нс, с разметкой {timings[1]:6.0f} нс, "
+              f"лог {timings[2]:7.0f} нс на строку")
+
+
+def bench_leaderboard(iterations: int):
+    """Таблица лидеров на 100 тысячах финишировавших: запись результата, страница и место игрока"""
+    players = 100_000
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = ProgressStore(os.path.join(tmpdir, 'bench.db'))
+
+        def finisher(user_id: int) -> ProgressChanges:
+            result = {'quest': 'main', 'name': f"Игрок {user_id}", 'attempt': 1,
+                      'solutions': rng.randint(0, 3), 'hints': rng.randint(0, 20),
+                      'duration': rng.uniform(600, 86400), 'finished_at': '2025-01-01T00:00:00+00:00'}
+            return ProgressChanges(user_id, True, 11, {'user_id': user_id, 'seq': 0, 'state': {}}, [], result=result)
+
+        start = time.perf_counter()
+        for offset in range(0, players, 1000):
+            store.save_changes(finisher(user_id) for user_id in range(offset, offset + 1000))
+        print(f"  заполнение: {players} игроков за {time.perf_counter() - start:.1f} с")
+
+        rounds = max(1, min(iterations, 2000))
+        samples = [rng.randrange(players) for _ in range(rounds)]
+        # Кнопки листания несут ключ последней показанной строки - страница читается с него по индексу
+        cursor = store.leaderboard_key_at('main', 49_989)
+        for name, func in (
+            ('запись', lambda user_id: store.save_changes([finisher(user_id)])),
+            ('страница 1', lambda user_id: store.leaderboard_rows('main', 10)),
+            ('страница 5000', lambda user_id: store.leaderboard_rows('main', 10, after=cursor)),
+            ('переход к 5000', lambda user_id: store.leaderboard_key_at('main', 49_989)),
+            ('всего', lambda user_id: store.leaderboard_count('main')),
+            ('место', lambda user_id: store.leaderboard_place('main', user_id)),
+        ):
+            start = time.perf_counter()
+            for user_id in samples:
+                func(user_id)
+            print(f"{name:>14}: {(time.perf_counter() - start) / rounds * 1e6:8.0f} мкс/вызов")
+        store.close()
+
+
+def bench_actions(iterations: int):
+    """Запись действия: прежний словарь с временем ISO и текстом против кортежа (код, мс, данные)"""
+    user_actions_logger.disabled = True  # файл user_actions.log бенчмарку не нужен
+    progress = UserProgress(1)
+    progress.start_quest()
+    for question in QUESTIONS[:5]:
+        progress.log_user_message("не знаю")
+        progress.log_wrong_answer(question.id, "не знаю")
+        progress.add_hint_used(question.id, 1)
+        progress.log_user_message(question.answer)
+        progress.answer_correct(question.id)
+        progress.advance()
+    records = [record for _, record in progress.action_log.take_pending()]
+
+    # Байты столбцов строки журнала: прежде время ISO, имя, текст и данные; теперь код, время int64 и данные
+    legacy = sum(len(ms_to_iso(record.ts)) + len(record.name) + len(record.details.encode('utf-8'))
+                 + len(json.dumps(record.data, ensure_ascii=False).encode('utf-8')) for record in records)
+    compact = sum(1 + 6 + len(encode_data(record.code, record.data).encode('utf-8')) for record in records)
+    print(f"  байт на действие: было {legacy / len(records):.0f}, стало {compact / len(records):.0f} "
+          f"({legacy / compact:.1f}x) на {len(records)} действиях")
+
+    data = {'question_id': 3, 'hint_num': 1, 'debit': {'hugs': 5}}
+    for name, func in (
+        ('словарь ISO', lambda: {'timestamp': datetime.now(timezone.utc).isoformat(), 'action': 'HINT_USED',
+                                 'details': f"Использована подсказка {data['hint_num']} для вопроса "
+                                            f"{data['question_id']}", 'data': data}),
+        ('кортеж', lambda: ActionRecord(ActionCode.HINT_USED, now_ms(), data)),
+    ):
+        print(f"{name:>14}: {_timeit(func, iterations):8.0f} нс/запись")
+
+
+# Бюджет холодного запуска: импорт bot и создание QuestBot на пустом хранилище
+STARTUP_BUDGET_MS = 1500
+STARTUP_CODE = "import bot; bot.QuestBot().store.close()"
+
+
+def bench_startup(iterations: int):
+    """Холодный запуск в отдельном процессе: самые дорогие импорты (-X importtime) и общее время"""
+    root = os.path.dirname(os.path.abspath(__file__))
+    budget = float(os.getenv('STARTUP_BUDGET_MS', STARTUP_BUDGET_MS))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Пустая папка: процесс не найдет ни progress.db, ни progress.json и создаст все с нуля
+        env = dict(os.environ, PROGRESS_DB=os.path.join(tmpdir, 'progress.db'),
+                   PYTHONPATH=os.pathsep.join(filter(None, [root, os.getenv('PYTHONPATH')])))
+
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import bot'],
+                                cwd=tmpdir, env=env, capture_output=True, text=True, check=True)
+        # Строки вида "import time:  self | cumulative | module", вложенность - отступ имени.
+        # Показываем то, что bot импортирует напрямую (второй уровень)
+        direct = []
+        for line in result.stderr.splitlines():
+            match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)', line)
+            if match and len(match.group(3)) == 3:
+                direct.append((int(match.group(2)), match.group(4)))
+        for cumulative, module in sorted(direct, reverse=True)[:10]:
+            print(f"{module:>24}: {cumulative / 1000:8.1f} мс")
+
+        samples = []
+        for _ in range(max(1, min(iterations, 5))):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', STARTUP_CODE], cwd=tmpdir, env=env, check=True,
+                           stderr=subprocess.DEVNULL)
+            samples.append((time.perf_counter() - start) * 1000)
+
+    elapsed = statistics.median(samples)
+    verdict = "в бюджете" if elapsed <= budget else "ПРЕВЫШЕН бюджет"
+    print(f"{'запуск':>24}: {elapsed:8.1f} мс (медиана из {len(samples)}), {verdict} {budget:.0f} мс")
+    return elapsed <= budget
+
+
+BENCHMARKS = {
+    'actions': bench_actions,
+    'escaping': bench_escaping,
+    'keyboards': bench_keyboards,
+    'leaderboard': bench_leaderboard,
+    'startup': bench_startup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки квест-бота")
+    parser.add_argument('name', choices=sorted(BENCHMARKS), nargs='?', help="какой бенчмарк запустить")
+    parser.add_argument('-n', '--iterations', type=int, default=100_000)
+    args = parser.parse_args()
+
+    names = [args.name] if args.name else sorted(BENCHMARKS)
+    within_budget = True
+    for name in names:
+        print(f"== {name}")
+        if BENCHMARKS[name](args.iterations) is False:
+            within_budget = False
+    sys.exit(0 if within_budget else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,35 @@ import logging
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 from dataclasses import dataclass
-from typing import Dict, Optional, Tuple, List
-import json
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, Tuple, List, Union
+from functools import cached_property
 import os
 from dotenv import load_dotenv
-from datetime import datetime, timezone
+from collections import OrderedDict
 import asyncio
+import argparse
+import contextlib
+import functools
+import json
+import struct
+import sys
+import time
+
+from actions import ActionCode, ActionRecord, format_ms, ms_to_iso, now_ms, to_ms
+from assets import IMAGE_CACHE_DIR, IMAGES_DIR, ImageAssets
+from callbacks import Action, Callback, CallbackRouter, encode as encode_callback
+from quest_graph import (HINT1_USED, HINT2_USED, HINT_BITS, SOLUTION_SHOWN, QuestGraph, bit, count_bits,
+                         outcome_of, with_outcome)
+from scheduler import TimerScheduler
+from team import KeyedLocks, TeamRegistry, is_team_chat
+from storage import RECENT_ACTIONS, LedgerEntry, ProgressChanges, ProgressStore, StoredProgress, leaderboard_key
+from formatting import escape_html, html, legacy_markdown_to_html, strip_legacy_markdown
+
+if TYPE_CHECKING:
+    # Модули для администратора и режима polling импортируются там, где нужны, а не при запуске
+    from bulk_jobs import BulkJob, BulkJobRunner
+    from stale_keyboards import KeyboardStripper
+    from telegram_http import PoolStats
 
 # Настройка основного логирования
 logging.basicConfig(
@@ -24,8 +47,8 @@ user_actions_logger.setLevel(logging.INFO)
 file_handler = logging.FileHandler('user_actions.log', encoding='utf-8')
 file_handler.setLevel(logging.INFO)
 
-# Формат для логов действий пользователей
-action_formatter = logging.Formatter('%(asctime)s - USER:%(user_id)d - ACTION:%(action)s - DETAILS:%(details)s')
+# Формат для логов действий пользователей (текст действия не пишем - он выводится из кода и данных)
+action_formatter = logging.Formatter('%(asctime)s - USER:%(user_id)d - ACTION:%(action)s - DATA:%(data)s')
 file_handler.setFormatter(action_formatter)
 
 # Добавляем обработчик к логгеру
@@ -34,6 +57,12 @@ user_actions_logger.addHandler(file_handler)
 user_actions_logger.propagate = False
 
 
+def env_int(name: str, default: int) -> int:
+    """Читает целочисленную настройку из переменных окружения"""
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
 # Структура вопроса
 @dataclass
 class Question:
@@ -43,35 +72,77 @@ class Question:
     hint1: str
     hint2: str
     description: str
-    image_url: Optional[str] = None
+    image: Optional[str] = None  # файл в папке images/
+
+    # Тексты каталога написаны со старой разметкой Markdown, в HTML переводим один раз
+    @cached_property
+    def text_html(self) -> str:
+        return legacy_markdown_to_html(self.text)
+
+    @cached_property
+    def hint1_html(self) -> str:
+        return legacy_markdown_to_html(self.hint1)
+
+    @cached_property
+    def hint2_html(self) -> str:
+        return legacy_markdown_to_html(self.hint2)
+
+    @cached_property
+    def header_html(self) -> str:
+        """Заголовок с номером загадки"""
+        return f"❤️🧡💛️ <b>Загадка {self.id} из {len(QUESTIONS)}</b> 💛🧡❤️"
 
+    @cached_property
+    def preview(self) -> str:
+        """Короткое начало текста вопроса без разметки"""
+        return escape_html(strip_legacy_markdown(self.text)[:60])
+
+
+# Telegram ограничивает подпись к фото 1024 символами
+CAPTION_LIMIT = 1024
+
+# Deep link /start play сразу начинает квест, пропустив приветствие.
+# Любая ссылка для уже начавшего игрока (например, ?start=resume) продолжает текущую загадку
+START_PAYLOAD_PLAY = 'play'
 
 # Уникальные поздравления для каждого вопроса
 CONGRATULATIONS = {
-    1: "🧡 *Отлично!* Ты разгадал первую загадку! 🧡\n\n💛 В этой игре нет приза, но хочется поблагодарить тебя за твое участие небольшими приятностями)\n*Время открыть пакетик с номером 1.* 💕 \nВероятнее всего местоположение пакетиков уже было спалено, но если нет, то изучи шкафы)",
-    2: "🧡 *Великолепно!* 🧡️\n\n💛 Время открыть пакетик с номером 2 💕",
-    3: "🧡 *Браво!* 🧡\n\n💛 Время открыть пакетик с пакетик 3 💕",
-    4: "🧡 *Потрясающе!* 🧡\n\n💛 Время открыть пакетик с номером 4 💕",
-    5: "🧡 *Восхитительно!* 🧡\n\n💛 Время открыть пакетик с номером 5 💕",
-    6: "🧡 *Замечательно!* 🧡\n\n💛 Время открыть пакетик с номером 6 💕",
-    7: "🧡 *Прекрасно!* 🧡\n\n💛 Время открыть пакетик с номером 7 💕",
-    8: "🧡 *Гениально!* 🧡\n\n💛 Время открыть пакетик с номером 8 💕",
-    9: "🧡 *Умопомрачительно!* 🧡\n\n💛 Время открыть пакетик с номером 9 💕",
-    10: "🧡 *Блестяще!* 🧡\n\n💛 Время открыть пакетик с номером 10 💕"
+    1: "🧡 <b>Отлично!</b> Ты разгадал первую загадку! 🧡\n\n💛 В этой игре нет приза, но хочется поблагодарить тебя за твое участие небольшими приятностями)\n<b>Время открыть пакетик с номером 1.</b> 💕 \nВероятнее всего местоположение пакетиков уже было спалено, но если нет, то изучи шкафы)",
+    2: "🧡 <b>Великолепно!</b> 🧡️\n\n💛 Время открыть пакетик с номером 2 💕",
+    3: "🧡 <b>Браво!</b> 🧡\n\n💛 Время открыть пакетик с пакетик 3 💕",
+    4: "🧡 <b>Потрясающе!</b> 🧡\n\n💛 Время открыть пакетик с номером 4 💕",
+    5: "🧡 <b>Восхитительно!</b> 🧡\n\n💛 Время открыть пакетик с номером 5 💕",
+    6: "🧡 <b>Замечательно!</b> 🧡\n\n💛 Время открыть пакетик с номером 6 💕",
+    7: "🧡 <b>Прекрасно!</b> 🧡\n\n💛 Время открыть пакетик с номером 7 💕",
+    8: "🧡 <b>Гениально!</b> 🧡\n\n💛 Время открыть пакетик с номером 8 💕",
+    9: "🧡 <b>Умопомрачительно!</b> 🧡\n\n💛 Время открыть пакетик с номером 9 💕",
+    10: "🧡 <b>Блестяще!</b> 🧡\n\n💛 Время открыть пакетик с номером 10 💕"
 }
 
 # Уникальные ободряющие сообщения после показа решения
 ENCOURAGEMENTS = {
-    1: "💛 В этой игре нет приза, но хочется поблагодарить тебя за твое участие небольшими приятностями) \n*Время открыть пакетик с номером 1.* 💕",
-    2: "💛 *Время открыть пакетик с номером 2* 💕",
-    3: "💛 *Время открыть пакетик с номером 3* 💕",
-    4: "💛 *Время открыть пакетик с номером 4* 💕",
-    5: "💛 *Время открыть пакетик с номером 5* 💕",
-    6: "💛 *Время открыть пакетик с номером 6* 💕",
-    7: "💛 *Время открыть пакетик с номером 7* 💕",
-    8: "💛 *Время открыть пакетик с номером 8* 💕",
-    9: "💛 *Время открыть пакетик с номером 9* 💕",
-    10: "💛 *Время открыть пакетик с номером 10* 💕"
+    1: "💛 В этой игре нет приза, но хочется поблагодарить тебя за твое участие небольшими приятностями) \n<b>Время открыть пакетик с номером 1.</b> 💕",
+    2: "💛 <b>Время открыть пакетик с номером 2</b> 💕",
+    3: "💛 <b>Время открыть пакетик с номером 3</b> 💕",
+    4: "💛 <b>Время открыть пакетик с номером 4</b> 💕",
+    5: "💛 <b>Время открыть пакетик с номером 5</b> 💕",
+    6: "💛 <b>Время открыть пакетик с номером 6</b> 💕",
+    7: "💛 <b>Время открыть пакетик с номером 7</b> 💕",
+    8: "💛 <b>Время открыть пакетик с номером 8</b> 💕",
+    9: "💛 <b>Время открыть пакетик с номером 9</b> 💕",
+    10: "💛 <b>Время открыть пакетик с номером 10</b> 💕"
+}
+
+
+# Цена подсказок и решения в единицах долга
+HINT_DEBT = {1: {'hugs': 5}, 2: {'kisses': 10}}
+SOLUTION_DEBT = {'wishes': 1}
+
+# Названия видов долга для команды /repay
+DEBT_KINDS = {
+    'hugs': 'hugs', 'обнимашки': 'hugs',
+    'kisses': 'kisses', 'поцелуи': 'kisses',
+    'wishes': 'wishes', 'желания': 'wishes',
 }
 
 
@@ -95,6 +166,19 @@ class UserDebt:
         """Добавить желание автора"""
         self.wishes += count
 
+    def add(self, amounts: Dict[str, int]):
+        """Начислить долг (проводка-дебет журнала долгов)"""
+        for kind, amount in amounts.items():
+            setattr(self, kind, getattr(self, kind) + amount)
+
+    def subtract(self, amounts: Dict[str, int]):
+        """Погасить долг (проводка-кредит), но не ниже нуля"""
+        for kind, amount in amounts.items():
+            setattr(self, kind, max(0, getattr(self, kind) - amount))
+
+    def is_empty(self) -> bool:
+        return self.hugs == 0 and self.kisses == 0 and self.wishes == 0
+
     def to_dict(self):
         return {
             'hugs': self.hugs,
@@ -122,187 +206,673 @@ class UserDebt:
 
 
 class UserActionLog:
-    """Класс для логирования действий пользователя"""
+    """Журнал действий пользователя (только добавление).
 
-    def __init__(self, user_id: int):
+    Каждое действие получает порядковый номер seq. В памяти держим хвост
+    последних действий и еще не сохраненные записи, вся история - в хранилище.
+    Запись - кортеж ActionRecord (код, время в мс, данные), текст для людей
+    из него выводится только при показе.
+    """
+
+    def __init__(self, user_id: int, next_seq: int = 0):
         self.user_id = user_id
-        self.actions: List[Dict] = []
+        self.actions: List[ActionRecord] = []  # последние действия
+        self.pending: List[Tuple[int, ActionRecord]] = []  # (seq, запись), еще не сохраненные
+        self.next_seq = next_seq
 
-    def log_action(self, action: str, details: str, data: Optional[Dict] = None):
+    def log_action(self, code: ActionCode, data: Optional[Dict] = None) -> ActionRecord:
         """Записать действие в лог"""
-        action_record = {
-            'timestamp': datetime.now(timezone.utc).isoformat(),
-            'action': action,
-            'details': details,
-            'data': data or {}
-        }
+        action_record = ActionRecord(code, now_ms(), data or {})
         self.actions.append(action_record)
+        if len(self.actions) > 2 * RECENT_ACTIONS:
+            del self.actions[:-RECENT_ACTIONS]
+        self.pending.append((self.next_seq, action_record))
+        self.next_seq += 1
 
         # Также записываем в файл через логгер
         user_actions_logger.info(
             '',
             extra={
                 'user_id': self.user_id,
-                'action': action,
-                'details': details
+                'action': code.name,
+                'data': action_record.data
             }
         )
+        return action_record
 
-    def get_recent_actions(self, limit: int = 10) -> List[Dict]:
+    def take_pending(self) -> List[Tuple[int, ActionRecord]]:
+        """Забрать несохраненные действия для записи в хранилище"""
+        pending, self.pending = self.pending, []
+        return pending
+
+    def get_recent_actions(self, limit: int = 10) -> List[ActionRecord]:
         """Получить последние действия"""
         return self.actions[-limit:] if self.actions else []
 
+
+def seconds_between(start: Union[int, str], end: Union[int, str]) -> float:
+    """Секунды между двумя метками времени: миллисекунды или ISO из старых снимков"""
+    return max(0.0, (to_ms(end) - to_ms(start)) / 1000)
+
+
+def format_duration(seconds: float) -> str:
+    """Длительность для сообщений, например 1 ч 05 мин или 3 мин 12 с"""
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours} ч {minutes:02d} мин"
+    if minutes:
+        return f"{minutes} мин {seconds:02d} с"
+    return f"{seconds} с"
+
+
+def normalize_answer(text: str) -> str:
+    """Приводит ответ к каноническому виду для подсчета частот"""
+    return ' '.join(text.lower().split())[:100]
+
+
+class WrongAnswerIndex:
+    """Частотный индекс неправильных ответов по вопросам.
+
+    Для каждого вопроса хранится не больше capacity счетчиков (алгоритм
+    Мисры-Гриса), поэтому память ограничена независимо от числа игроков.
+    Обновление амортизированно O(1): каждое вычитание оплачено одной
+    предыдущей вставкой. Ответ, который встречается чаще чем total/(capacity+1),
+    гарантированно остается в индексе.
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.capacity = capacity
+        self.counters: Dict[int, Dict[str, int]] = {}
+        self.totals: Dict[int, int] = {}
+        self.changed = False  # индекс изменился с прошлого сохранения
+
+    def add(self, question_id: int, answer: str):
+        """Учесть неправильный ответ"""
+        answer = normalize_answer(answer)
+        if not answer:
+            return
+
+        self.totals[question_id] = self.totals.get(question_id, 0) + 1
+        self.changed = True
+        counters = self.counters.setdefault(question_id, {})
+
+        if answer in counters:
+            counters[answer] += 1
+        elif len(counters) < self.capacity:
+            counters[answer] = 1
+        else:
+            # Места нет - уменьшаем все счетчики и выбрасываем обнулившиеся
+            for key in list(counters):
+                counters[key] -= 1
+                if counters[key] == 0:
+                    del counters[key]
+
+    def top(self, question_id: int, k: int = 10) -> List[Tuple[str, int]]:
+        """Самые частые неправильные ответы (оценка снизу)"""
+        counters = self.counters.get(question_id, {})
+        return sorted(counters.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+    def total(self, question_id: int) -> int:
+        return self.totals.get(question_id, 0)
+
     def to_dict(self):
         return {
-            'user_id': self.user_id,
-            'actions': self.actions
+            'capacity': self.capacity,
+            'counters': self.counters,
+            'totals': self.totals
         }
 
     @classmethod
     def from_dict(cls, data):
-        log = cls(data['user_id'])
-        log.actions = data.get('actions', [])
-        return log
+        index = cls(data.get('capacity', 64))
+        index.counters = {int(q): dict(c) for q, c in data.get('counters', {}).items()}
+        index.totals = {int(q): t for q, t in data.get('totals', {}).items()}
+        return index
+
+
+class _AnswerBucket:
+    """Состояние ограничителя для одного пользователя"""
+    __slots__ = ('tokens', 'updated', 'wrong_streak', 'blocked_until', 'notified')
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        self.wrong_streak = 0
+        self.blocked_until = 0.0
+        self.notified = False
+
+
+class AnswerThrottle:
+    """Ограничение частоты ответов (token bucket) с растущей паузой после ошибок"""
+
+    def __init__(self, burst: int = 5, rate: float = 0.5, wrong_limit: int = 5,
+                 base_backoff: float = 10.0, max_backoff: float = 600.0, idle_ttl: float = 3600.0):
+        self.burst = burst  # сколько ответов можно отправить подряд
+        self.rate = rate  # сколько ответов в секунду восстанавливается
+        self.wrong_limit = wrong_limit  # после скольких ошибок подряд включается пауза
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.idle_ttl = idle_ttl
+        self.buckets: Dict[int, _AnswerBucket] = {}
+        self.last_cleanup = time.monotonic()
+        self.counters = {'allowed': 0, 'throttled': 0, 'backoffs': 0, 'notices': 0}
+
+    def check(self, user_id: int) -> Tuple[bool, bool]:
+        """Возвращает (можно ли принять ответ, нужно ли сообщить об ограничении)"""
+        now = time.monotonic()
+        self._cleanup(now)
+
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = _AnswerBucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+
+        if now >= bucket.blocked_until and bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.notified = False
+            self.counters['allowed'] += 1
+            return True, False
+
+        # Отказ: сообщаем об этом только один раз, пока ограничение не снято
+        self.counters['throttled'] += 1
+        notify = not bucket.notified
+        if notify:
+            bucket.notified = True
+            self.counters['notices'] += 1
+        return False, notify
+
+    def record_wrong(self, user_id: int):
+        """Учесть неправильный ответ: после серии ошибок пауза растет экспоненциально"""
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            return
+
+        bucket.wrong_streak += 1
+        over = bucket.wrong_streak - self.wrong_limit
+        if over >= 0:
+            delay = min(self.max_backoff, self.base_backoff * (2 ** min(over, 16)))
+            bucket.blocked_until = time.monotonic() + delay
+            self.counters['backoffs'] += 1
+
+    def record_correct(self, user_id: int):
+        """Правильный ответ сбрасывает серию ошибок"""
+        bucket = self.buckets.get(user_id)
+        if bucket is not None:
+            bucket.wrong_streak = 0
+            bucket.blocked_until = 0.0
+
+    def retry_after(self, user_id: int) -> int:
+        """Через сколько секунд пользователь снова сможет отвечать"""
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            return 0
+        now = time.monotonic()
+        wait_tokens = max(0.0, (1 - bucket.tokens) / self.rate)
+        return int(max(bucket.blocked_until - now, wait_tokens)) + 1
+
+    def _cleanup(self, now: float):
+        """Удаляем давно неактивных пользователей, чтобы словарь не рос бесконечно"""
+        if now - self.last_cleanup < self.idle_ttl:
+            return
+        self.last_cleanup = now
+        self.buckets = {
+            user_id: bucket for user_id, bucket in self.buckets.items()
+            if now - bucket.updated < self.idle_ttl or bucket.blocked_until > now
+        }
 
 
 class UserProgress:
-    def __init__(self, user_id: int):
+    """Прогресс пользователя.
+
+    Состояние меняется только событиями журнала (QUEST_STARTED, HINT_USED,
+    CORRECT_ANSWER, SOLUTION_SHOWN, ADVANCED, RESTART, DEBT_CLEARED) и
+    является их сверткой: apply() применяет одно событие. Остальные действия
+    (сообщения, неправильные ответы) пишутся в тот же журнал, но состояние не меняют.
+    """
+
+    def __init__(self, user_id: int, log_init: bool = True):
         self.user_id = user_id
-        self.current_question = 1
-        self.used_hints: Dict[int, list] = {}  # какие подсказки использованы
-        self.showed_solutions: list = []  # номера вопросов, где показано решение
-        self.questions_without_hints = []  # номера вопросов, пройденных без подсказок
+        self.attempt = 1  # номер попытки: /restart начинает следующую, прошлые хранятся в архиве
+        self.reminders = False  # согласие на напоминания (/remind), сохраняется между попытками
+        self.leaderboard_name: Optional[str] = None  # имя в таблице лидеров, None - не участвует
+        self.members: Dict[int, str] = {}  # участники команды (в группе): id -> имя
+        self._reset_state(now_ms())
+        self.action_log = UserActionLog(user_id)  # Лог действий пользователя
+        self.snapshot_seq: Optional[int] = None  # на каком событии сделан сохраненный снимок
+
+        # Логируем инициализацию прогресса (при загрузке из хранилища не логируем повторно)
+        if log_init:
+            self.action_log.log_action(ActionCode.INIT)
+
+    def _reset_state(self, start_time: int):
+        self.current_question = QUEST_GRAPH.start
+        # Пройденные и открытые шаги графа квеста: бит i - шаг i
+        self.visited = 0
+        self.unlocked = 0
+        # Исходы загадок, упакованные по шагам (см. quest_graph.outcome_of): взятые подсказки и показанные
+        # решения. И маска загадок, отгаданных без подсказок
+        self.outcomes = 0
+        self.solved_without_hints = 0
         self.debt = UserDebt()  # Изначально долг равен 0
-        self.start_time = datetime.now().isoformat()
+        self.start_time = start_time
         self.has_started_quest = False  # Флаг, начал ли пользователь квест
-        self.action_log = UserActionLog(user_id)  # Лог действий пользователя
-
-        # Логируем инициализацию прогресса
-        self.action_log.log_action('INIT', 'Создан новый прогресс пользователя')
-
-    def log_user_message(self, message: str):
+        # Время прохождения (мс Unix): когда начат квест и текущий вопрос, сколько секунд ушло на каждый вопрос
+        self.quest_started_at: Optional[int] = None
+        self.question_started_at: Optional[int] = None
+        self.question_times: Dict[int, float] = {}
+        self.finished_at: Optional[int] = None
+        # В команде: кто первым отгадал загадку и кто сколько долга набрал подсказками
+        self.solved_by: Dict[int, int] = {}
+        self.member_debts: Dict[int, UserDebt] = {}
+
+    def apply(self, code: ActionCode, data: Dict, timestamp: int):
+        """Применить событие к состоянию (один шаг свертки журнала)"""
+        if code == ActionCode.QUEST_STARTED:
+            if not self.quest_started_at:
+                self.quest_started_at = self.question_started_at = timestamp
+            self.has_started_quest = True
+            self.visited |= bit(self.current_question)
+            self.unlocked |= bit(self.current_question)
+        elif code == ActionCode.HINT_USED:
+            flag = HINT_BITS.get(data['hint_num'], 0)
+            if flag and not self.outcome(data['question_id']) & flag:
+                self.outcomes = with_outcome(self.outcomes, data['question_id'], flag)
+                # "Долг" за подсказку (в старых записях суммы в событии нет)
+                debit = data.get('debit') or HINT_DEBT.get(data['hint_num'], {})
+                self.debt.add(debit)
+                self._charge_member(data, debit)
+        elif code == ActionCode.SOLUTION_SHOWN:
+            self._stop_question_timer(data['question_id'], timestamp)
+            if not self.solution_shown(data['question_id']):
+                self.outcomes = with_outcome(self.outcomes, data['question_id'], SOLUTION_SHOWN)
+                debit = data.get('debit') or SOLUTION_DEBT
+                self.debt.add(debit)
+                self._charge_member(data, debit)
+        elif code == ActionCode.CORRECT_ANSWER:
+            question_id = data['question_id']
+            self._stop_question_timer(question_id, timestamp)
+            if not self.hints_taken(question_id):
+                self.solved_without_hints |= bit(question_id)
+            if 'by' in data and question_id not in self.solved_by:
+                self._remember_member(data)
+                self.solved_by[question_id] = data['by']
+        elif code == ActionCode.ADVANCED:
+            self.current_question = data['question_id']
+            self.visited |= bit(self.current_question)
+            self.unlocked |= bit(self.current_question) | data.get('unlocked', 0)
+            self.question_started_at = timestamp
+            if self.is_finished() and not self.finished_at:
+                self.finished_at = timestamp
+        elif code == ActionCode.RESTART:
+            self._reset_state(timestamp)
+            self.attempt += 1
+        elif code == ActionCode.DEBT_CLEARED:
+            self.debt = UserDebt()
+        elif code == ActionCode.DEBT_REPAID:
+            self.debt.subtract(data['credit'])
+        elif code == ActionCode.REMINDERS_SET:
+            self.reminders = data['enabled']
+        elif code == ActionCode.LEADERBOARD_SET:
+            self.leaderboard_name = data['name']
+
+    def _remember_member(self, data: Dict):
+        self.members[data['by']] = data.get('by_name') or self.members.get(data['by']) or f"Игрок {data['by']}"
+
+    def _charge_member(self, data: Dict, debit: Dict[str, int]):
+        """В команде долг за подсказку или решение записывается и на того, кто нажал кнопку"""
+        if 'by' in data:
+            self._remember_member(data)
+            self.member_debts.setdefault(data['by'], UserDebt()).add(debit)
+
+    @staticmethod
+    def _with_member(data: Dict, member: Optional[Tuple[int, str]]) -> Dict:
+        """Добавляет к данным события участника команды (id, имя), если действие было в группе"""
+        if member:
+            data['by'], data['by_name'] = member
+        return data
+
+    def _stop_question_timer(self, question_id: int, timestamp: int):
+        """Запоминает, сколько длилось решение вопроса (первый правильный ответ или решение)"""
+        if self.question_started_at and question_id not in self.question_times:
+            self.question_times[question_id] = seconds_between(self.question_started_at, timestamp)
+
+    def record(self, code: ActionCode, data: Optional[Dict] = None):
+        """Добавить событие в журнал и применить его к состоянию"""
+        action_record = self.action_log.log_action(code, data)
+        self.apply(code, action_record.data, action_record.ts)
+
+    def log_user_message(self, message: str, member: Optional[Tuple[int, str]] = None):
         """Записать сообщение пользователя в лог"""
         self.action_log.log_action(
-            'USER_MESSAGE',
-            f'Пользователь отправил сообщение',
-            {'message': message[:200]}  # Ограничиваем длину сообщения
-        )
-
-    def log_correct_answer(self, question_id: int):
-        """Записать правильный ответ"""
-        self.action_log.log_action(
-            'CORRECT_ANSWER',
-            f'Правильный ответ на вопрос {question_id}',
-            {'question_id': question_id}
+            ActionCode.USER_MESSAGE,
+            self._with_member({'message': message[:200]}, member)  # Ограничиваем длину сообщения
         )
 
-    def log_wrong_answer(self, question_id: int, user_answer: str):
+    def log_wrong_answer(self, question_id: int, user_answer: str, member: Optional[Tuple[int, str]] = None):
         """Записать неправильный ответ"""
         self.action_log.log_action(
-            'WRONG_ANSWER',
-            f'Неправильный ответ на вопрос {question_id}',
-            {'question_id': question_id, 'user_answer': user_answer[:100]}
-        )
-
-    def log_hint_used(self, question_id: int, hint_num: int):
-        """Записать использование подсказки"""
-        self.action_log.log_action(
-            'HINT_USED',
-            f'Использована подсказка {hint_num} для вопроса {question_id}',
-            {'question_id': question_id, 'hint_num': hint_num}
+            ActionCode.WRONG_ANSWER,
+            self._with_member({'question_id': question_id, 'user_answer': user_answer[:100]}, member)
         )
 
-    def log_solution_shown(self, question_id: int):
-        """Записать показ решения"""
-        self.action_log.log_action(
-            'SOLUTION_SHOWN',
-            f'Показано решение вопроса {question_id}',
-            {'question_id': question_id}
-        )
-
-    def log_quest_started(self):
-        """Записать начало квеста"""
-        self.action_log.log_action('QUEST_STARTED', 'Пользователь начал квест')
-
     def log_quest_completed(self):
         """Записать завершение квеста"""
         total_completed, without_hints = self.get_stats()
         self.action_log.log_action(
-            'QUEST_COMPLETED',
-            'Пользователь завершил квест',
+            ActionCode.QUEST_COMPLETED,
             {
                 'total_completed': total_completed,
                 'without_hints': without_hints,
-                'debt': self.debt.to_dict()
+                'debt': self.debt.to_dict(),
+                'attempt': self.attempt,
+                'hints': self.hints_used(),
+                'solutions': self.solutions_shown(),
+                'duration': self.quest_duration()
             }
         )
 
-    def add_hint_used(self, question_id: int, hint_num: int):
+    def start_quest(self):
+        """Пользователь начал квест"""
+        self.record(ActionCode.QUEST_STARTED)
+
+    def answer_correct(self, question_id: int, member: Optional[Tuple[int, str]] = None):
+        """Правильный ответ: вопрос засчитывается без подсказок, если их не было"""
+        self.record(ActionCode.CORRECT_ANSWER, self._with_member({'question_id': question_id}, member))
+
+    def add_hint_used(self, question_id: int, hint_num: int, member: Optional[Tuple[int, str]] = None):
         """Добавить использованную подсказку"""
-        # Инициализируем список для вопроса, если его нет
-        if question_id not in self.used_hints:
-            self.used_hints[question_id] = []
+        if not self.hint_used(question_id, hint_num):
+            self.record(
+                ActionCode.HINT_USED,
+                self._with_member(
+                    {'question_id': question_id, 'hint_num': hint_num, 'debit': HINT_DEBT.get(hint_num, {})}, member)
+            )
+
+    def add_solution_shown(self, question_id: int, member: Optional[Tuple[int, str]] = None):
+        """Добавить просмотр решения"""
+        if not self.solution_shown(question_id):
+            self.record(
+                ActionCode.SOLUTION_SHOWN,
+                self._with_member({'question_id': question_id, 'debit': SOLUTION_DEBT}, member)
+            )
 
-        if hint_num not in self.used_hints[question_id]:
-            self.used_hints[question_id].append(hint_num)
+    def outcome(self, question_id: int) -> int:
+        """Исход загадки: биты взятых подсказок и показанного ответа (как у состояния клавиатуры)"""
+        return outcome_of(self.outcomes, question_id)
+
+    def hint_used(self, question_id: int, hint_num: int) -> bool:
+        return bool(self.outcome(question_id) & HINT_BITS.get(hint_num, 0))
+
+    def hints_taken(self, question_id: int) -> int:
+        """Сколько подсказок взято на загадке"""
+        return count_bits(self.outcome(question_id) & (HINT1_USED | HINT2_USED))
+
+    def solution_shown(self, question_id: int) -> bool:
+        return bool(self.outcome(question_id) & SOLUTION_SHOWN)
+
+    def solutions_shown(self) -> int:
+        """На скольких загадках показано решение"""
+        return QUEST_GRAPH.count_outcomes(self.outcomes, SOLUTION_SHOWN)
+
+    def next_step(self) -> Tuple[int, int]:
+        """Куда ведет текущая загадка по графу квеста: (шаг, открываемые шаги)"""
+        return QUEST_GRAPH.next_step(self.current_question, self.outcome(self.current_question), self.unlocked)
+
+    def next_is_ending(self) -> bool:
+        """Текущая загадка при нынешнем исходе ведет к концовке"""
+        return QUEST_GRAPH.is_ending(self.next_step()[0])
+
+    def advance(self):
+        """Перейти к следующему шагу графа квеста"""
+        next_question, unlocks = self.next_step()
+        data = {'question_id': next_question}
+        if unlocks:
+            data['unlocked'] = unlocks
+        self.record(ActionCode.ADVANCED, data)
+
+    def restart(self):
+        """Начать квест заново: итоги текущей попытки уходят в архив, долг списывается"""
+        self.record(
+            ActionCode.RESTART,
+            {'attempt': self.attempt_summary(), 'credit': self.debt.to_dict(), 'from_question': self.current_question}
+        )
 
-            # Добавляем "долг" за подсказку
-            if hint_num == 1:
-                self.debt.add_hugs(5)
-            elif hint_num == 2:
-                self.debt.add_kisses(10)
+    def set_reminders(self, enabled: bool):
+        """Включить или выключить напоминания"""
+        self.record(ActionCode.REMINDERS_SET, {'enabled': enabled})
 
-            # Логируем использование подсказки
-            self.log_hint_used(question_id, hint_num)
+    def set_leaderboard(self, name: Optional[str]):
+        """Участвовать в таблице лидеров под именем name (None - выйти из нее)"""
+        self.record(ActionCode.LEADERBOARD_SET, {'name': name})
 
-    def add_solution_shown(self, question_id: int):
-        """Добавить просмотр решения"""
-        if question_id not in self.showed_solutions:
-            self.showed_solutions.append(question_id)
-            # Добавляем долг за просмотр решения
-            self.debt.add_wish(1)
-            # Логируем показ решения
-            self.log_solution_shown(question_id)
-
-    def mark_question_completed(self, question_id: int):
-        """Отметить вопрос как завершенный и проверить, были ли подсказки"""
-        used = self.used_hints.get(question_id, [])
-        if not used:
-            self.questions_without_hints.append(question_id)
+    def hints_used(self) -> int:
+        return QUEST_GRAPH.count_outcomes(self.outcomes, HINT1_USED | HINT2_USED)
+
+    def leaderboard_result(self) -> Dict:
+        """Результат завершенной попытки для таблицы лидеров"""
+        return {
+            'quest': QUEST_ID,
+            'name': self.leaderboard_name,
+            'attempt': self.attempt,
+            'solutions': self.solutions_shown(),
+            'hints': self.hints_used(),
+            'duration': self.quest_duration() or 0.0,
+            'finished_at': ms_to_iso(self.finished_at or now_ms())
+        }
+
+    def is_finished(self) -> bool:
+        return QUEST_GRAPH.is_finished(self.current_question)
+
+    def ending(self) -> Optional[str]:
+        return QUEST_GRAPH.endings.get(self.current_question)
+
+    def quest_duration(self) -> Optional[float]:
+        """Сколько секунд идет (или шел) квест"""
+        if not self.quest_started_at:
+            return None
+        return seconds_between(self.quest_started_at, self.finished_at or now_ms())
+
+    def clear_debt(self):
+        """Списать весь долг"""
+        self.record(ActionCode.DEBT_CLEARED, {'credit': self.debt.to_dict()})
+
+    def repay(self, kind: str, amount: int) -> int:
+        """Погасить часть долга одного вида. Возвращает, сколько реально списано"""
+        amount = min(amount, getattr(self.debt, kind))
+        if amount > 0:
+            self.record(ActionCode.DEBT_REPAID, {'credit': {kind: amount}})
+        return amount
+
+    def debt_incurred(self) -> UserDebt:
+        """Долг, набранный в текущей попытке (без учета очисток)"""
+        debt = UserDebt()
+        for hint_num, flag in HINT_BITS.items():
+            for _ in range(QUEST_GRAPH.count_outcomes(self.outcomes, flag)):
+                debt.add(HINT_DEBT.get(hint_num, {}))
+        for _ in range(self.solutions_shown()):
+            debt.add(SOLUTION_DEBT)
+        return debt
+
+    def attempt_summary(self) -> Dict:
+        """Итоги текущей попытки для архива"""
+        total_completed, without_hints = self.get_stats()
+        return {
+            'attempt': self.attempt,
+            'started_at': ms_to_iso(self.start_time),
+            'ended_at': ms_to_iso(now_ms()),
+            'completed': total_completed,
+            'without_hints': without_hints,
+            'solutions': self.solutions_shown(),
+            'finished': self.is_finished(),
+            'duration': self.quest_duration(),
+            'debt': self.debt_incurred().to_dict()
+        }
+
+    def team(self) -> List[Tuple[str, int, Dict[str, int]]]:
+        """Вклад участников команды в этой попытке: (имя, отгадано загадок, долг за подсказки)"""
+        solved: Dict[int, int] = {}
+        for member in self.solved_by.values():
+            solved[member] = solved.get(member, 0) + 1
+        members = sorted(set(solved) | set(self.member_debts), key=lambda member: -solved.get(member, 0))
+        return [
+            (self.members.get(member, f"Игрок {member}"), solved.get(member, 0),
+             self.member_debts[member].to_dict() if member in self.member_debts else {})
+            for member in members
+        ]
+
+    def summary(self) -> Dict:
+        """Итоги для /stats и /debt. В холодном уровне хранятся рядом с архивом и читаются без распаковки"""
+        total_completed, without_hints = self.get_stats()
+        return {
+            'current_question': self.current_question,
+            'has_started': self.has_started_quest,
+            'finished': self.is_finished(),
+            'completed': total_completed,
+            'without_hints': without_hints,
+            'solutions': self.solutions_shown(),
+            'current_hints': self.hints_taken(self.current_question),
+            'question_started_at': self.question_started_at,
+            'debt': self.debt.to_dict(),
+            'team': self.team()
+        }
 
     def get_stats(self) -> Tuple[int, int]:
         """Возвращает статистику: (всего пройдено, без подсказок)"""
-        total_completed = self.current_question - 1
-        without_hints = len(self.questions_without_hints)
+        # Пройдены все посещенные загадки, кроме текущей
+        total_completed = count_bits(self.visited & QUEST_GRAPH.step_mask & ~bit(self.current_question))
+        without_hints = count_bits(self.solved_without_hints)
         return total_completed, without_hints
 
-    def to_dict(self):
+    def state_dict(self):
         return {
-            'user_id': self.user_id,
             'current_question': self.current_question,
-            'used_hints': self.used_hints,
-            'showed_solutions': self.showed_solutions,
-            'questions_without_hints': self.questions_without_hints,
+            'visited': self.visited,
+            'unlocked': self.unlocked,
+            'outcomes': self.outcomes,
+            'solved_without_hints': self.solved_without_hints,
             'debt': self.debt.to_dict(),
             'start_time': self.start_time,
             'has_started_quest': self.has_started_quest,
-            'action_log': self.action_log.to_dict()
+            'attempt': self.attempt,
+            'reminders': self.reminders,
+            'leaderboard_name': self.leaderboard_name,
+            'quest_started_at': self.quest_started_at,
+            'question_started_at': self.question_started_at,
+            'question_times': self.question_times,
+            'finished_at': self.finished_at,
+            'members': self.members,
+            'solved_by': self.solved_by,
+            'member_debts': {member: debt.to_dict() for member, debt in self.member_debts.items()}
+        }
+
+    def load_state(self, state: Dict):
+        self.current_question = state.get('current_question', QUEST_GRAPH.start)
+        # В снимках до графа квеста масок нет: загадки шли подряд, пройдены все до текущей
+        linear = (1 << (self.current_question + 1)) - 2 if state.get('has_started_quest') else 0
+        self.visited = state.get('visited', linear)
+        self.unlocked = state.get('unlocked', linear)
+        if 'outcomes' in state:
+            self.outcomes = state['outcomes']
+            self.solved_without_hints = state.get('solved_without_hints', 0)
+        else:
+            # Старые снимки хранят списки: подсказки по номеру вопроса (ключи после JSON - строки),
+            # вопросы с показанным решением и вопросы, пройденные без подсказок
+            self.outcomes = 0
+            for question_id, hints in state.get('used_hints', {}).items():
+                for hint_num in hints:
+                    self.outcomes = with_outcome(self.outcomes, int(question_id), HINT_BITS.get(hint_num, 0))
+            for question_id in state.get('showed_solutions', []):
+                self.outcomes = with_outcome(self.outcomes, question_id, SOLUTION_SHOWN)
+            self.solved_without_hints = 0
+            for question_id in state.get('questions_without_hints', []):
+                self.solved_without_hints |= bit(question_id)
+        self.debt = UserDebt.from_dict(state.get('debt', {}))
+        # В старых снимках метки времени - строки ISO
+        self.start_time = to_ms(state['start_time']) if state.get('start_time') else now_ms()
+        self.has_started_quest = state.get('has_started_quest', False)
+        self.attempt = state.get('attempt', 1)
+        self.reminders = state.get('reminders', False)
+        self.leaderboard_name = state.get('leaderboard_name')
+        self.quest_started_at = self._load_time(state.get('quest_started_at'))
+        self.question_started_at = self._load_time(state.get('question_started_at'))
+        self.question_times = {int(q): seconds for q, seconds in state.get('question_times', {}).items()}
+        self.finished_at = self._load_time(state.get('finished_at'))
+        self.members = {int(member): name for member, name in state.get('members', {}).items()}
+        self.solved_by = {int(q): member for q, member in state.get('solved_by', {}).items()}
+        self.member_debts = {int(member): UserDebt.from_dict(debt)
+                             for member, debt in state.get('member_debts', {}).items()}
+
+    @staticmethod
+    def _load_time(value) -> Optional[int]:
+        return to_ms(value) if value else None
+
+    def to_dict(self):
+        """Снимок состояния на текущем событии журнала"""
+        return {
+            'user_id': self.user_id,
+            'seq': self.action_log.next_seq,
+            'state': self.state_dict()
         }
 
     @classmethod
-    def from_dict(cls, data):
-        progress = cls(data['user_id'])
-        progress.current_question = data['current_question']
-        progress.used_hints = data.get('used_hints', {})
-        progress.showed_solutions = data.get('showed_solutions', [])
-        progress.questions_without_hints = data.get('questions_without_hints', [])
-        progress.debt = UserDebt.from_dict(data.get('debt', {}))
-        progress.start_time = data.get('start_time', datetime.now().isoformat())
-        progress.has_started_quest = data.get('has_started_quest', False)
-        progress.action_log = UserActionLog.from_dict(
-            data.get('action_log', {'user_id': data['user_id'], 'actions': []}))
+    def from_dict(cls, snapshot: Dict, events: Iterable[Tuple[int, Dict]] = (),
+                  recent: Optional[List[ActionRecord]] = None):
+        """Восстановить прогресс: снимок плюс повтор событий после него"""
+        progress = cls(snapshot['user_id'], log_init=False)
+        progress.load_state(snapshot.get('state', {}))
+        progress.snapshot_seq = next_seq = snapshot.get('seq', 0)
+        for seq, event in events:
+            progress.apply(event.code, event.data, event.ts)
+            next_seq = seq + 1
+        progress.action_log.next_seq = next_seq
+        progress.action_log.actions = list(recent or [])
         return progress
 
+    @classmethod
+    def from_stored(cls, stored: StoredProgress):
+        return cls.from_dict(stored.snapshot, stored.events, stored.recent)
+
+    def collect_changes(self, snapshot_interval: int) -> ProgressChanges:
+        """Несохраненные события и, если прошло snapshot_interval событий, новый снимок"""
+        snapshot = None
+        if self.snapshot_seq is None or self.action_log.next_seq - self.snapshot_seq >= snapshot_interval:
+            snapshot = self.to_dict()
+            self.snapshot_seq = snapshot['seq']
+        events = self.action_log.take_pending()
+        result, left = self.leaderboard_change(events)
+        return ProgressChanges(self.user_id, self.has_started_quest, self.current_question,
+                               snapshot, events, self.attempts_in(events), self.ledger_in(events), result, left)
+
+    @staticmethod
+    def attempts_in(events: List[Tuple[int, ActionRecord]]) -> List[Dict]:
+        """Итоги попыток из событий RESTART - они пишутся в архив попыток"""
+        return [event.data['attempt'] for _, event in events
+                if event.code == ActionCode.RESTART and 'attempt' in event.data]
+
+    @staticmethod
+    def ledger_in(events: List[Tuple[int, ActionRecord]]) -> List[LedgerEntry]:
+        """Проводки журнала долгов: начисления (debit) и погашения (credit) из событий"""
+        return [
+            LedgerEntry(seq, ms_to_iso(event.ts), entry, event.name, event.data.get('question_id'),
+                        event.data.get('hint_num'), event.data[entry])
+            for seq, event in events for entry in ('debit', 'credit')
+            if any(event.data.get(entry, {}).values())
+        ]
+
+    def leaderboard_change(self, events: List[Tuple[int, ActionRecord]]) -> Tuple[Optional[Dict], bool]:
+        """Что события меняют в таблице лидеров: (результат для записи или None, вышел ли игрок из таблицы)"""
+        # В таблицу попадает завершенная попытка: при завершении или при включении участия
+        codes = {event.code for _, event in events}
+        result = None
+        if (self.leaderboard_name and self.is_finished()
+                and codes & {ActionCode.QUEST_COMPLETED, ActionCode.LEADERBOARD_SET}):
+            result = self.leaderboard_result()
+        return result, ActionCode.LEADERBOARD_SET in codes and not self.leaderboard_name
+
 
 # Вопросы для квеста
 QUESTIONS = [
@@ -329,7 +899,7 @@ QUESTIONS = [
         answer="наши",
         hint1="\n1. Треугольник \n2. Орфография",
         hint2="\n3. Чебурашка\n4. Исток",
-        image_url="https://github.com/iukh/iukh_quest_bot/blob/main/images/%D0%BA%D1%80%D0%BE%D1%81%D1%81%D0%B2%D0%BE%D1%80%D0%B4.png?raw=true"
+        image="кроссворд.png"
     ),
     Question(
         id=4,
@@ -354,7 +924,7 @@ QUESTIONS = [
         answer="согревают",
         hint1="Внешний вид букв искажен отрицательно",
         hint2="Наложи ключ на букву и убери все совпадающие линии",
-        image_url="https://github.com/iukh/iukh_quest_bot/blob/main/images/negative1.png?raw=true"
+        image="negative1.png"
     ),
     Question(
         id=7,
@@ -363,7 +933,7 @@ QUESTIONS = [
         answer="скучаю",
         hint1="На первой картинке нота СИ",
         hint2="На третье картинке ЮАР",
-        image_url="https://github.com/iukh/iukh_quest_bot/blob/main/images/computer1.png?raw=true"
+        image="computer1.png"
     ),
     Question(
         id=8,
@@ -372,7 +942,7 @@ QUESTIONS = [
         answer="жду встречу",
         hint1="Цезарь - не салат, а шифр) Ключ - это сдвиг относительно алфавита",
         hint2="Шифр заменяет кажду букву на другую букву, находящуюся справа от нее со смещением равным значению ключа. А -> Б; Б -> В",
-        image_url="https://github.com/iukh/iukh_quest_bot/blob/main/images/%D1%86%D0%B5%D0%B7%D0%B0%D1%80%D1%8C.jpg?raw=true"
+        image="цезарь.jpg"
     ),
     Question(
         id=9,
@@ -381,7 +951,7 @@ QUESTIONS = [
         answer="твой ёжик",
         hint1="Основное действие - вычитание",
         hint2="Буква получается результатом вычитания координаты по оси X и Y. Например, 52-15 = 37 = В",
-        image_url="https://github.com/iukh/iukh_quest_bot/blob/main/images/%D0%B5%D0%B6%D0%B8%D0%BA1.png?raw=true"
+        image="ежик1.png"
     ),
     Question(
         id=10,
@@ -394,170 +964,744 @@ QUESTIONS = [
 ]
 
 
+# Идентификатор квеста в таблице лидеров
+QUEST_ID = 'main'
+
+# Порядок загадок. Сейчас они идут подряд и ведут к одной концовке; ветвления
+# описываются переходами quest_graph.Transition и QuestGraph.compile, например
+# Transition(3, 11, when=without_hints) перед Transition(3, 4) - побочная загадка 11
+# для тех, кто решил третью без подсказок. Граф проверяется при загрузке.
+QUESTIONS_BY_ID = {question.id: question for question in QUESTIONS}
+QUEST_GRAPH = QuestGraph.linear([question.id for question in QUESTIONS], "Квест пройден")
+
+
+class KeyboardRegistry:
+    """Заранее собранные клавиатуры, общие для всех пользователей.
+
+    У клавиатуры вопроса всего несколько состояний (какие подсказки взяты и
+    показан ли ответ), поэтому все варианты вопроса строятся один раз - при
+    первом обращении к нему или при прогреве - и дальше только выдаются по индексу.
+    InlineKeyboardMarkup неизменяем, так что один объект можно отправлять всем.
+    """
+
+    def __init__(self, questions: List[Question]):
+        self.question_ids = [question.id for question in questions]
+        self.start_quest = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🎮 Начать квест", callback_data=encode_callback(Callback(Action.START_QUEST)))]
+        ])
+        # question_id -> список из 8 клавиатур, индекс - биты состояния
+        self.question_keyboards: Dict[int, List[Optional[InlineKeyboardMarkup]]] = {}
+        self.continue_keyboards: Dict[int, InlineKeyboardMarkup] = {}
+
+    def _build(self, question_id: int):
+        self.question_keyboards[question_id] = [
+            self._build_question_keyboard(question_id, state) for state in range(8)
+        ]
+        self.continue_keyboards[question_id] = InlineKeyboardMarkup([
+            [InlineKeyboardButton("➡️ Продолжить", callback_data=encode_callback(Callback(Action.NEXT, question_id)))]
+        ])
+
+    def build_all(self):
+        """Собирает клавиатуры всех вопросов (при прогреве)"""
+        for question_id in self.question_ids:
+            if question_id not in self.question_keyboards:
+                self._build(question_id)
+
+    @staticmethod
+    def _build_question_keyboard(question_id: int, state: int) -> Optional[InlineKeyboardMarkup]:
+        buttons = []
+
+        # Кнопки подсказок
+        if not state & HINT1_USED:
+            buttons.append(
+                [InlineKeyboardButton("🧸 Подсказка 1 (+5 мин обнимашек)", callback_data=encode_callback(Callback(Action.HINT, question_id, 1, state)))])
+        if not state & HINT2_USED:
+            buttons.append(
+                [InlineKeyboardButton("💋 Подсказка 2 (+10 поцелуев)", callback_data=encode_callback(Callback(Action.HINT, question_id, 2, state)))])
+
+        # Кнопка решения (появляется только после обеих подсказок)
+        if state & HINT1_USED and state & HINT2_USED and not state & SOLUTION_SHOWN:
+            buttons.append([InlineKeyboardButton("🔴 Ответ (+1 желание)", callback_data=encode_callback(Callback(Action.SOLUTION, question_id, nonce=state)))])
+
+        return InlineKeyboardMarkup(buttons) if buttons else None
+
+    @staticmethod
+    def question_state(progress: 'UserProgress', question_id: int) -> int:
+        """Битовое состояние клавиатуры вопроса для пользователя"""
+        return progress.outcome(question_id)
+
+    def question(self, question_id: int, state: int) -> Optional[InlineKeyboardMarkup]:
+        if question_id not in self.question_keyboards:
+            self._build(question_id)
+        return self.question_keyboards[question_id][state]
+
+    def continue_to_next(self, question_id: int) -> InlineKeyboardMarkup:
+        if question_id not in self.continue_keyboards:
+            self._build(question_id)
+        return self.continue_keyboards[question_id]
+
+
+@dataclass
+class QuestionMessage:
+    """Последнее отправленное пользователю сообщение с вопросом"""
+    chat_id: int
+    message_id: int
+    question_id: int
+    is_photo: bool  # вопрос с картинкой редактируется через caption
+    text: str  # последний отрисованный текст
+    keyboard: Optional[InlineKeyboardMarkup]  # общая клавиатура из KeyboardRegistry
+    with_header: bool = False  # заголовок "Загадка N из M" в том же сообщении
+
+
 class QuestBot:
     def __init__(self):
-        self.user_progress: Dict[int, UserProgress] = {}
+        # Кэш прогресса в памяти: порядок ключей - от давно неактивных к недавним
+        self.user_progress: 'OrderedDict[int, UserProgress]' = OrderedDict()
+        self.last_access: Dict[int, float] = {}
+        self.dirty_users: set = set()
+        self.question_messages: Dict[int, QuestionMessage] = {}
+        self.wrong_answers = WrongAnswerIndex()
+        self.keyboards = KeyboardRegistry(QUESTIONS)
+        self.answer_throttle = AnswerThrottle(
+            burst=env_int('ANSWER_BURST', 5),
+            rate=env_int('ANSWER_RATE_PER_MINUTE', 30) / 60,
+            wrong_limit=env_int('WRONG_ANSWERS_BEFORE_BACKOFF', 5),
+            base_backoff=env_int('WRONG_ANSWER_BACKOFF', 10),
+            max_backoff=env_int('WRONG_ANSWER_MAX_BACKOFF', 600)
+        )
+
+        # Настройки вытеснения неактивных пользователей из памяти
+        self.max_cached_users = env_int('MAX_CACHED_USERS', 1000)
+        self.session_ttl = env_int('SESSION_TTL', 30 * 60)
+        self.never_started_grace = env_int('NEVER_STARTED_GRACE', 24 * 60 * 60)
+        self.eviction_interval = env_int('EVICTION_INTERVAL', 60)
+        self.last_eviction = time.monotonic()
+
+        # Холодный уровень хранилища: через сколько секунд после конца квеста и после последней
+        # активности игрок уходит в сжатый архив (0 - не переносить) и сколько переносить за раз
+        self.cold_finished_after = env_int('COLD_FINISHED_AFTER', 60 * 60)
+        self.cold_idle_after = env_int('COLD_IDLE_AFTER', 30 * 24 * 60 * 60)
+        self.cold_batch = env_int('COLD_BATCH', 200)
+        self.cleanup_chunk = 500  # не начавших квест удаляем пачками, отдавая цикл событий между ними
+
+        # Отложенное сохранение (write-behind) и жизненный цикл
+        self.save_delay = env_int('SAVE_DELAY', 2)
+        self.snapshot_interval = env_int('SNAPSHOT_INTERVAL', 50)
+        self.shutdown_timeout = env_int('SHUTDOWN_TIMEOUT', 10)
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.warmup_task: Optional[asyncio.Task] = None
+        self.maintenance_task: Optional[asyncio.Task] = None
+        self.in_flight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+        self.store = ProgressStore(os.getenv('PROGRESS_DB', 'progress.db'))
+
+        # Таймеры: лимит времени квеста и напоминания неактивным игрокам (0 - выключено)
+        self.quest_time_limit = env_int('QUEST_TIME_LIMIT', 0)
+        self.nudge_after = env_int('NUDGE_AFTER', 24 * 60 * 60)
+        self.scheduler = TimerScheduler(
+            self.store, self.on_timer,
+            shards=env_int('TIMER_SHARDS', 1),
+            shard=env_int('TIMER_SHARD', 0)
+        )
+        self.application: Optional[Application] = None
+        self.http_stats: Dict[str, 'PoolStats'] = {}  # пулы HTTP-клиента Telegram, см. /metrics
+
+        # Снятие кнопок с устаревших сообщений - только в режиме polling, см. start_scheduler
+        self.keyboard_stripper: Optional['KeyboardStripper'] = None
+
+        # Командный режим в группах: бюджет необязательных ответов (не чаще одного в TEAM_REPLY_INTERVAL
+        # секунд после TEAM_REPLY_BURST подряд) и окно склейки одинаковых правильных ответов
+        self.teams = TeamRegistry(
+            reply_burst=env_int('TEAM_REPLY_BURST', 2),
+            reply_interval=env_int('TEAM_REPLY_INTERVAL', 5),
+            coalesce_window=env_int('TEAM_COALESCE_WINDOW', 10)
+        )
+        # Обновления обрабатываются параллельно, но для одного игрока или группы - по очереди
+        self.player_locks = KeyedLocks()
+
+        # Картинки загадок: варианты собираются при прогреве, file_id хранятся в meta.
+        # По умолчанию - папка images рядом с bot.py, откуда бы его ни запустили
+        self.images = ImageAssets(
+            os.getenv('IMAGES_DIR') or IMAGES_DIR,
+            os.getenv('IMAGE_CACHE_DIR') or IMAGE_CACHE_DIR,
+            self.store.get_meta('image_file_ids')
+        )
         self.load_progress()
-        self.admin_user_id = 372495015  # ID пользователя для отправки результатов
 
-    def escape_markdown(self, text: str) -> str:
-        """Экранирует специальные символы Markdown"""
-        escape_chars = r'_*[]()~`>#+-=|{}.!'
-        for char in escape_chars:
-            text = text.replace(char, f'\\{char}')
-        return text
+        # Массовые операции администратора создаются при первом обращении, см. bulk_runner
+        self.bulk_jobs: Optional['BulkJobRunner'] = None
+        self.admin_user_id = 372495015  # ID пользователя для отправки результатов
 
     async def send_results_to_admin(self, user_progress: UserProgress, context: ContextTypes.DEFAULT_TYPE):
         """Отправляет результаты прохождения квеста администратору"""
-        try:
-            total_completed, without_hints = user_progress.get_stats()
-
-            # Экранируем текст долга
-            debt_str = self.escape_markdown(str(user_progress.debt))
-
-            # Формируем отчет с Markdown форматированием
-            report = (
-                f"📊 *РЕЗУЛЬТАТЫ ПРОХОЖДЕНИЯ КВЕСТА*\n\n"
-                f"👤 *Пользователь:* `{user_progress.user_id}`\n"
-                f"📅 *Дата начала:* `{user_progress.start_time[:19]}`\n"
-                f"🎯 *Завершено:* `{total_completed}`/`{len(QUESTIONS)}`\n"
-                f"✅ *Без подсказок:* `{without_hints}`\n"
-                f"💡 *С подсказками:* `{total_completed - without_hints}`\n"
-                f"🔴 *Решений показано:* `{len(user_progress.showed_solutions)}`\n\n"
-                f"💝 *Долг:*\n`{debt_str}`"
-            )
+        total_completed, without_hints = user_progress.get_stats()
+
+        # Все значения экранированы, поэтому повторная отправка без форматирования не нужна
+        report = (
+            f"📊 <b>РЕЗУЛЬТАТЫ ПРОХОЖДЕНИЯ КВЕСТА</b>\n\n"
+            f"👤 <b>Пользователь:</b> <code>{user_progress.user_id}</code>\n"
+            f"📅 <b>Дата начала:</b> <code>{format_ms(user_progress.start_time)}</code>\n"
+            f"🎯 <b>Завершено:</b> <code>{total_completed}</code>/<code>{len(QUESTIONS)}</code>\n"
+            f"✅ <b>Без подсказок:</b> <code>{without_hints}</code>\n"
+            f"💡 <b>С подсказками:</b> <code>{total_completed - without_hints}</code>\n"
+            f"🔴 <b>Решений показано:</b> <code>{user_progress.solutions_shown()}</code>\n"
+        )
+        duration = user_progress.quest_duration()
+        if duration is not None:
+            report += f"⏱ <b>Время:</b> <code>{format_duration(duration)}</code>\n"
+        if user_progress.question_times:
+            times = ", ".join(f"{question_id}: {format_duration(seconds)}"
+                              for question_id, seconds in sorted(user_progress.question_times.items()))
+            report += f"🧩 <b>По загадкам:</b> <code>{times}</code>\n"
+        report += f"\n💝 <b>Долг:</b>\n<code>{escape_html(user_progress.debt)}</code>"
+        report += team_lines(user_progress.team())
 
-            # Отправляем отчет администратору
+        try:
             await context.bot.send_message(
                 chat_id=self.admin_user_id,
                 text=report,
-                parse_mode='MarkdownV2'
+                parse_mode='HTML'
             )
-
             logger.info(f"Отправлены результаты пользователя {user_progress.user_id} администратору {self.admin_user_id}")
-
         except Exception as e:
             logger.error(f"Ошибка при отправке результатов администратору: {e}")
-            # Пробуем отправить без форматирования
-            try:
-                simple_report = (
-                    f"РЕЗУЛЬТАТЫ ПРОХОЖДЕНИЯ КВЕСТА\n\n"
-                    f"Пользователь: {user_progress.user_id}\n"
-                    f"Дата начала: {user_progress.start_time[:19]}\n"
-                    f"Завершено: {total_completed}/{len(QUESTIONS)}\n"
-                    f"Без подсказок: {without_hints}\n"
-                    f"С подсказками: {total_completed - without_hints}\n"
-                    f"Решений показано: {len(user_progress.showed_solutions)}\n\n"
-                    f"Долг: {str(user_progress.debt)}"
-                )
-
-                await context.bot.send_message(
-                    chat_id=self.admin_user_id,
-                    text=simple_report
-                )
-            except Exception as e2:
-                logger.error(f"Ошибка при отправке простого отчета: {e2}")
 
     def save_progress(self):
-        """Сохраняет прогресс всех пользователей в файл"""
-        data = {user_id: progress.to_dict()
-                for user_id, progress in self.user_progress.items()}
-        with open('progress.json', 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        """Планирует сохранение прогресса: изменения за SAVE_DELAY секунд пишутся одной транзакцией"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if loop is None or self.save_delay <= 0:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.save_delay, self.flush)
+
+    def flush(self):
+        """Сохраняет в хранилище прогресс пользователей, измененный с прошлого сохранения"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        # Пишутся только новые события; снимок состояния - раз в SNAPSHOT_INTERVAL событий
+        changes = [self.user_progress[user_id].collect_changes(self.snapshot_interval)
+                   for user_id in self.dirty_users if user_id in self.user_progress]
+        # Индексы в meta переписываются целиком, поэтому пишем их только после изменений и в той же транзакции
+        meta = {}
+        if self.images.changed:
+            meta['image_file_ids'] = self.images.file_ids
+            self.images.changed = False
+        if self.wrong_answers.changed:
+            meta['wrong_answers'] = self.wrong_answers.to_dict()
+            self.wrong_answers.changed = False
+        self.store.save_changes(changes, meta)
+        self.scheduler.flush()
+        self.dirty_users.clear()
 
     def load_progress(self):
-        """Загружает прогресс из файла"""
-        if os.path.exists('progress.json'):
+        """Загружает индексы из хранилища (старый progress.json переносит import_legacy_progress)"""
+        try:
+            wrong_answers = self.store.get_meta('wrong_answers')
+            if wrong_answers:
+                self.wrong_answers = WrongAnswerIndex.from_dict(wrong_answers)
+            logger.info("Хранилище прогресса готово")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки прогресса: {e}")
+
+    def track(self, callback):
+        """Оборачивает обработчик, чтобы при остановке дождаться его завершения.
+
+        Обработчики одного игрока (в группе - всей команды) выполняются по очереди:
+        обновления обрабатываются параллельно, а прогресс меняется между await.
+        """
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            self.in_flight += 1
+            self.idle.clear()
+            try:
+                if not update.effective_user:
+                    return await callback(update, context)
+                player = player_id(update)
+                async with self.player_locks.hold(player):
+                    result = await callback(update, context)
+                self.on_activity(player)
+                return result
+            finally:
+                self.in_flight -= 1
+                if self.in_flight == 0:
+                    self.idle.set()
+        return wrapper
+
+    def on_activity(self, user_id: int):
+        """После каждого обновления от пользователя переставляет его таймеры"""
+        progress = self.user_progress.get(user_id)
+        if progress is None:
+            return
+
+        active = progress.has_started_quest and not progress.is_finished()
+        if active and progress.reminders and self.nudge_after > 0:
+            self.scheduler.schedule(user_id, 'nudge', time.time() + self.nudge_after)
+        else:
+            self.scheduler.cancel(user_id, 'nudge')
+
+        duration = progress.quest_duration()
+        if active and self.quest_time_limit > 0 and duration is not None:
+            # Срок считается от начала квеста, уже прошедший не ставим повторно.
+            # У игроков из старых данных начало квеста неизвестно - для них лимита нет
+            left = self.quest_time_limit - duration
+            if left > 0:
+                self.scheduler.schedule(user_id, 'time_limit', time.time() + left)
+        else:
+            self.scheduler.cancel(user_id, 'time_limit')
+
+    async def on_timer(self, user_id: int, kind: str):
+        """Срабатывание таймера пользователя"""
+        progress = self.peek_user_progress(user_id)
+        if progress is None or not progress.has_started_quest or progress.is_finished():
+            return
+
+        if kind == 'nudge':
+            if not progress.reminders:
+                return
+            text = (
+                f"🧡 Ты давно не заходил... Загадка {progress.current_question} из {len(QUESTIONS)} ждет тебя!\n"
+                f"Нажми /start, чтобы продолжить.\n\n"
+                f"<i>Отключить напоминания: /remind off</i>"
+            )
+        elif kind == 'time_limit':
+            text = (
+                f"⏰ <b>Время квеста вышло!</b>\n\n"
+                f"Лимит был {format_duration(self.quest_time_limit)}. Можешь продолжать, "
+                f"но в итогах будет отмечено, что квест пройден вне лимита."
+            )
+        else:
+            return
+
+        await self.application.bot.send_message(chat_id=user_id, text=text, parse_mode='HTML')
+        progress.action_log.log_action(ActionCode.TIMER, {'kind': kind})
+        self.dirty_users.add(user_id)
+        self.save_progress()
+
+    def start_scheduler(self, application: Application):
+        """Загружает сохраненные таймеры и запускает планировщик"""
+        self.application = application
+        self.scheduler.load()
+        self.scheduler.start()
+        # Снятие кнопок с устаревших сообщений: правок в секунду и правок в одной пачке (0 - выключено)
+        from stale_keyboards import KeyboardStripper
+        self.keyboard_stripper = KeyboardStripper(
+            rate=env_int('STALE_KEYBOARD_RATE', 5),
+            batch=env_int('STALE_KEYBOARD_BATCH', 10)
+        )
+        self.keyboard_stripper.start(application.bot)
+        # Уборка хранилища идет в фоне, а не в обработчике, который первым попал на интервал
+        self.maintenance_task = asyncio.create_task(self.maintain())
+
+    def strip_keyboard(self, chat_id: int, message_id: int):
+        """Ставит в очередь снятие кнопок со старого сообщения (без polling кнопки не снимаются)"""
+        if self.keyboard_stripper is not None:
+            self.keyboard_stripper.add(chat_id, message_id)
+
+    def bulk_runner(self) -> 'BulkJobRunner':
+        """Массовые операции администратора: рассылка (сообщений в секунду), очистка долгов, сброс"""
+        if self.bulk_jobs is None:
+            from bulk_jobs import BulkJobRunner
+            self.bulk_jobs = BulkJobRunner(
+                self.store, self.process_bulk_batch, self.report_bulk_job,
+                first_ending=QUEST_GRAPH.first_ending,
+                rate=env_int('BROADCAST_RATE', 20),
+                batch_size=env_int('BULK_BATCH_SIZE', 500),
+                report_interval=env_int('BULK_REPORT_INTERVAL', 10)
+            )
+            self.bulk_jobs.load()
+        return self.bulk_jobs
+
+    async def process_bulk_batch(self, job: 'BulkJob', user_ids: List[int]) -> Tuple[List[ProgressChanges], int]:
+        """Применяет массовую операцию к пачке пользователей. Изменения записывает вызывающий"""
+        if job.kind == 'broadcast':
+            delivered = await asyncio.gather(*(self._broadcast_to(user_id, job.text) for user_id in user_ids))
+            return [], delivered.count(False)
+
+        changes = []
+        # Прогресс меняется под теми же блокировками игроков, что и в обработчиках (см. track).
+        # Они держатся до конца пачки: вызывающий пишет изменения сразу после возврата, без await,
+        # поэтому обработчик не прочитает из хранилища прогресс игрока без этих изменений
+        async with contextlib.AsyncExitStack() as locks:
+            for user_id in user_ids:
+                await locks.enter_async_context(self.player_locks.hold(user_id))
+                # Загруженный в память прогресс меняем на месте, остальной - не загружая в кэш
+                progress = self.user_progress.get(user_id)
+                if progress is None:
+                    # Игрока из архива распаковываем, только если задача его действительно меняет
+                    summary = self.store.load_summary(user_id)
+                    if summary and not (summary['has_started'] if job.kind == 'reset'
+                                        else any(summary['debt'].values())):
+                        continue
+                    stored = self.store.load(user_id)
+                    if stored is None:
+                        continue
+                    progress = UserProgress.from_stored(stored)
+
+                if job.kind == 'reset' and progress.has_started_quest:
+                    progress.restart()
+                elif job.kind == 'clear_debt' and not progress.debt.is_empty():
+                    progress.clear_debt()
+                else:
+                    continue
+                changes.append(progress.collect_changes(self.snapshot_interval))
+                self.dirty_users.discard(user_id)
+        return changes, 0
+
+    async def _broadcast_to(self, user_id: int, text: str) -> bool:
+        """Отправляет сообщение рассылки; при RetryAfter ждет и пробует еще раз"""
+        for _ in range(2):
             try:
-                with open('progress.json', 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for user_data in data.values():
-                        progress = UserProgress.from_dict(user_data)
-                        self.user_progress[progress.user_id] = progress
-                logger.info("Прогресс загружен из файла")
+                await self.application.bot.send_message(chat_id=user_id, text=text)
+                return True
             except Exception as e:
-                logger.error(f"Ошибка загрузки прогресса: {e}")
+                retry_after = getattr(e, 'retry_after', None)
+                if retry_after is None:
+                    logger.warning(f"Рассылка не доставлена пользователю {user_id}: {e}")
+                    return False
+                await asyncio.sleep(retry_after.total_seconds() if hasattr(retry_after, 'total_seconds')
+                                    else float(retry_after))
+        return False
+
+    async def report_bulk_job(self, job: 'BulkJob', finished: bool):
+        """Обновляет сообщение администратору о ходе задачи, а по завершении пишет отдельно"""
+        from bulk_jobs import KINDS as BULK_KINDS
+        try:
+            if job.status_message_id:
+                await self.application.bot.edit_message_text(
+                    chat_id=job.admin_chat_id, message_id=job.status_message_id, text=job.describe())
+            if finished and job.status == 'failed':
+                last = f" (последний user_id {job.cursor})" if job.cursor is not None else ""
+                await self.application.bot.send_message(
+                    chat_id=job.admin_chat_id,
+                    text=f"❌ {BULK_KINDS[job.kind].capitalize()} остановлена после {job.processed} пользователей"
+                         f"{last}: {job.error}\n"
+                         f"Запустите задачу заново, когда устраните причину.")
+            elif finished:
+                await self.application.bot.send_message(
+                    chat_id=job.admin_chat_id,
+                    text=f"✅ {BULK_KINDS[job.kind].capitalize()} завершена: {job.processed} пользователей, "
+                         f"ошибок: {job.failed}")
+        except Exception as e:
+            logger.error(f"Ошибка при отчете о массовой задаче: {e}")
 
-    def get_user_progress(self, user_id: int) -> UserProgress:
-        """Получает или создает прогресс пользователя"""
+    async def import_legacy_progress(self, path: str = 'progress.json'):
+        """Переносит старый progress.json в пустое хранилище до начала обработки обновлений.
+
+        Перенос идет в отдельном потоке со своим соединением, цикл событий не блокируется.
+        """
+        if self.store.count() > 0 or not os.path.exists(path):
+            return
+
+        def import_json() -> int:
+            store = ProgressStore(self.store.path)
+            try:
+                return store.import_json(path)
+            finally:
+                store.close()
+
+        try:
+            await asyncio.to_thread(import_json)
+        except Exception as e:
+            logger.error(f"Ошибка переноса {path}: {e}")
+
+    def start_warmup(self):
+        """Запускает фоновый прогрев, не задерживая начало обработки обновлений"""
+        self.warmup_task = asyncio.create_task(self.warmup())
+
+    async def warmup(self):
+        """Готовит каталог и подгружает недавно активных игроков в память"""
+        started = time.monotonic()
+
+        # Отрисовываем тексты и клавиатуры каталога заранее, чтобы первые ответы не тратили на это время
+        for question in QUESTIONS:
+            for attribute in ('text_html', 'hint1_html', 'hint2_html', 'header_html', 'preview'):
+                getattr(question, attribute)
+        self.keyboards.build_all()
+
+        # Данные, сохраненные до появления журнала долгов, переносим остатками (один раз).
+        # Проход по всем игрокам идет в отдельном потоке со своим соединением
+        if self.store.get_meta('ledger') is None:
+            opened = await asyncio.to_thread(
+                self.store.open_ledger, lambda stored: UserProgress.from_stored(stored).debt.to_dict())
+            logger.info(f"Журнал долгов открыт, перенесено остатков: {opened}")
+
+        # Незавершенная массовая задача продолжается с сохраненного курсора
+        self.bulk_runner().start()
+
+        # Собираем варианты картинок (при неизменных исходниках это только чтение и хэши)
+        built = await asyncio.to_thread(self.images.build)
+        if built:
+            logger.info(f"Собрано вариантов картинок: {built}")
+
+        # Читаем хранилище в отдельном потоке; тех, кто уже успел загрузиться, не трогаем
+        since = time.time() - self.session_ttl
+        records = await asyncio.to_thread(self.store.load_recent, since, self.max_cached_users // 2)
+        loaded = 0
+        for stored in reversed(records):
+            user_id = stored.snapshot['user_id']
+            if user_id not in self.user_progress:
+                self.user_progress[user_id] = UserProgress.from_stored(stored)
+                self.user_progress.move_to_end(user_id, last=False)
+                self.last_access[user_id] = time.monotonic()
+                loaded += 1
+            await asyncio.sleep(0)
+
+        logger.info(f"Прогрев завершен за {time.monotonic() - started:.2f} с, загружено игроков: {loaded}")
+
+    async def shutdown(self):
+        """Дожидается обработчиков, сохраняет прогресс и закрывает ресурсы в пределах SHUTDOWN_TIMEOUT"""
+        deadline = time.monotonic() + self.shutdown_timeout
+
+        for task in (self.warmup_task, self.maintenance_task):
+            if task and not task.done():
+                task.cancel()
+        await self.scheduler.stop()
+        if self.keyboard_stripper is not None:
+            await self.keyboard_stripper.stop()
+        if self.bulk_jobs is not None:
+            await self.bulk_jobs.stop()
+
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            logger.warning(f"Не дождались завершения {self.in_flight} обработчиков, сохраняем то, что есть")
+
+        self.flush()
+        self.store.close()
+        logger.info("Прогресс сохранен, хранилище закрыто")
+
+        for handler in user_actions_logger.handlers:
+            handler.flush()
+            handler.close()
+
+    def _touch(self, user_id: int):
+        """Отмечает обращение к пользователю и при необходимости вытесняет неактивных"""
+        self.user_progress.move_to_end(user_id)
+        self.last_access[user_id] = time.monotonic()
+        self.evict_idle()
+
+    def peek_user_progress(self, user_id: int) -> Optional[UserProgress]:
+        """Получает прогресс пользователя, не создавая новый (для команд только на чтение)"""
         if user_id not in self.user_progress:
-            self.user_progress[user_id] = UserProgress(user_id)
+            stored = self.store.load(user_id)
+            if stored is None:
+                return None
+            self.user_progress[user_id] = UserProgress.from_stored(stored)
+        self._touch(user_id)
         return self.user_progress[user_id]
 
+    def get_user_progress(self, user_id: int) -> UserProgress:
+        """Получает или создает прогресс пользователя"""
+        progress = self.peek_user_progress(user_id)
+        if progress is None:
+            progress = UserProgress(user_id)
+            self.user_progress[user_id] = progress
+            self._touch(user_id)
+        # Прогресс может быть изменен обработчиком - сохраним его при следующем save_progress()
+        self.dirty_users.add(user_id)
+        return progress
+
+    def evict_idle(self, force: bool = False):
+        """Выгружает из памяти давно неактивных пользователей и лишних сверх лимита"""
+        now = time.monotonic()
+        sweep = force or now - self.last_eviction >= self.eviction_interval
+        if not sweep and len(self.user_progress) <= self.max_cached_users:
+            return
+
+        evicted = []
+        while self.user_progress:
+            user_id = next(iter(self.user_progress))
+            over_limit = len(self.user_progress) > self.max_cached_users
+            idle = now - self.last_access.get(user_id, 0) >= self.session_ttl
+            if not over_limit and not (sweep and idle):
+                break
+            evicted.append((user_id, self.user_progress.popitem(last=False)[1]))
+            self.last_access.pop(user_id, None)
+
+        # Несохраненные события выгружаемых пользователей пишем одной транзакцией
+        self.store.save_changes(progress.collect_changes(self.snapshot_interval) for user_id, progress in evicted
+                                if user_id in self.dirty_users or progress.action_log.pending)
+        for user_id, _ in evicted:
+            self.dirty_users.discard(user_id)
+            self.question_messages.pop(user_id, None)
+
+        if sweep:
+            self.last_eviction = now
+
+        if evicted:
+            logger.info(f"Выгружено из памяти {len(evicted)} пользователей")
+
+    async def maintain(self):
+        """Фоновая уборка хранилища раз в EVICTION_INTERVAL: не начавшие квест и перенос в холодный уровень"""
+        while True:
+            await asyncio.sleep(max(1, self.eviction_interval))
+            try:
+                await self.delete_never_started()
+                await self.archive_cold()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой уборки хранилища: {e}")
+
+    async def delete_never_started(self):
+        """Удаляет тех, кто так и не начал квест за отведенное время, пачками по cleanup_chunk"""
+        older_than = time.time() - self.never_started_grace
+        removed = 0
+        while True:
+            deleted = self.store.delete_never_started(older_than, self.cleanup_chunk)
+            removed += deleted
+            if deleted < self.cleanup_chunk:
+                break
+            await asyncio.sleep(0)
+        if removed:
+            logger.info(f"Удалено {removed} пользователей, не начавших квест")
+
+    async def archive_cold(self):
+        """Переносит в холодный уровень прошедших квест и давно неактивных (кроме тех, кто в памяти).
+
+        Каждый игрок переносится своей короткой транзакцией, между ними обрабатываются обновления.
+        """
+        if self.cold_batch <= 0:
+            return
+        now = time.time()
+        finished_before = now - self.cold_finished_after if self.cold_finished_after > 0 else 0
+        idle_before = now - self.cold_idle_after if self.cold_idle_after > 0 else 0
+        candidates = self.store.cold_candidates(QUEST_GRAPH.first_ending, finished_before, idle_before, self.cold_batch)
+        archived = 0
+        for user_id in candidates:
+            # Игрок мог вернуться, пока шла уборка: загруженных в память не трогаем
+            if user_id not in self.user_progress:
+                archived += self.store.archive([user_id], lambda stored: UserProgress.from_stored(stored).summary())
+            await asyncio.sleep(0)
+        if archived:
+            logger.info(f"В холодный уровень перенесено игроков: {archived}")
+
+    def unsaved(self) -> Iterable[UserProgress]:
+        """Загруженные игроки с событиями, которые еще не записаны в хранилище (ждут SAVE_DELAY)"""
+        for user_id in self.dirty_users:
+            progress = self.user_progress.get(user_id)
+            if progress is not None and progress.action_log.pending:
+                yield progress
+
+    def pending_leaderboard(self) -> Dict[int, Optional[Dict]]:
+        """Несохраненные изменения таблицы лидеров: user_id -> результат (None - игрок вышел из таблицы)"""
+        pending = {}
+        for progress in self.unsaved():
+            result, left = progress.leaderboard_change(progress.action_log.pending)
+            if result or left:
+                pending[progress.user_id] = result
+        return pending
+
+    def progress_summary(self, user_id: int) -> Optional[Dict]:
+        """Итоги игрока для /stats и /debt; игрока из холодного уровня не распаковывает"""
+        progress = self.user_progress.get(user_id)
+        if progress is None:
+            summary = self.store.load_summary(user_id)
+            if summary is not None:
+                return summary
+            progress = self.peek_user_progress(user_id)
+        return progress.summary() if progress else None
+
     def get_current_question(self, user_id: int) -> Optional[Question]:
         """Получает текущий вопрос для пользователя"""
         progress = self.get_user_progress(user_id)
-        if 1 <= progress.current_question <= len(QUESTIONS):
-            return QUESTIONS[progress.current_question - 1]
+        # Текущий шаг графа - загадка, пока игрок не дошел до концовки
+        if QUEST_GRAPH.is_step(progress.current_question):
+            return QUESTIONS_BY_ID[progress.current_question]
         return None
 
     def get_question_keyboard(self, user_id: int, question_id: int):
-        """Создает клавиатуру с подсказками и решением для вопроса"""
+        """Возвращает готовую клавиатуру с подсказками и решением для вопроса"""
         progress = self.get_user_progress(user_id)
-        used_hints = progress.used_hints.get(question_id, [])
-
-        buttons = []
-
-        # Кнопки подсказок
-        if 1 not in used_hints:
-            buttons.append(
-                [InlineKeyboardButton("🧸 Подсказка 1 (+5 мин обнимашек)", callback_data=f"hint_{question_id}_1")])
-        if 2 not in used_hints:
-            buttons.append(
-                [InlineKeyboardButton("💋 Подсказка 2 (+10 поцелуев)", callback_data=f"hint_{question_id}_2")])
-
-        # Кнопка решения (появляется только после обеих подсказок)
-        if len(used_hints) >= 2 and question_id not in progress.showed_solutions:
-            buttons.append([InlineKeyboardButton("🔴 Ответ (+1 желание)", callback_data=f"solution_{question_id}")])
-
-        return InlineKeyboardMarkup(buttons) if buttons else None
+        return self.keyboards.question(question_id, KeyboardRegistry.question_state(progress, question_id))
 
     def get_question_text(self, user_id: int, question: Question) -> str:
         """Формирует текст вопроса со статистикой и использованными подсказками"""
         progress = self.get_user_progress(user_id)
         total_completed, without_hints = progress.get_stats()
-        used_hints = progress.used_hints.get(question.id, [])
-
         text = (
-            f"{question.text}\n\n"
+            f"{question.text_html}\n\n"
             f"▫️▫️▫️▫️▫️▫️▫️▫️▫️▫️▫️\n\n"
         )
 
         # Показываем использованные подсказки
-        if 1 in used_hints:
-            text += f"💡 *Подсказка 1:* {question.hint1}\n"
-        if 2 in used_hints:
-            text += f"💡 *Подсказка 2:* {question.hint2}\n"
+        if progress.hint_used(question.id, 1):
+            text += f"💡 <b>Подсказка 1:</b> {question.hint1_html}\n"
+        if progress.hint_used(question.id, 2):
+            text += f"💡 <b>Подсказка 2:</b> {question.hint2_html}\n"
 
-        if used_hints:
+        if progress.hints_taken(question.id):
             text += "\n"
 
         text += (
-            f"*Прогресс:* \n 📈 {total_completed}/{len(QUESTIONS)}\n"
+            f"<b>Прогресс:</b> \n 📈 {total_completed}/{len(QUESTIONS)}\n"
         )
 
         debt_str = str(progress.debt)
         if debt_str != "🎉 Долгов нет!":
-            text += f"\n *Текущий долг:*\n{debt_str}\n"
+            text += f"\n <b>Текущий долг:</b>\n{debt_str}\n"
 
         return text
 
 
-async def send_message(update: Update, text: str, parse_mode: str = 'Markdown', reply_markup=None,
-                       image_url: Optional[str] = None):
-    """Универсальная функция для отправки сообщений"""
-    if image_url:
+def player_id(update: Update) -> int:
+    """Чей прогресс меняет обновление: в группе - общий прогресс чата, иначе - пользователя"""
+    if is_team_chat(update.effective_chat):
+        return update.effective_chat.id
+    return update.effective_user.id
+
+
+def team_member(update: Update) -> Optional[Tuple[int, str]]:
+    """Участник команды, который действует (id, имя); вне группы None"""
+    if not is_team_chat(update.effective_chat):
+        return None
+    user = update.effective_user
+    return user.id, user.first_name or f"Игрок {user.id}"
+
+
+async def reply_optional(update: Update, bot: 'QuestBot', text: str, **kwargs):
+    """Необязательный ответ (неправильно, слишком часто): в группе - в пределах бюджета чата"""
+    if is_team_chat(update.effective_chat) and not bot.teams.allow_reply(update.effective_chat.id):
+        return None
+    return await update.message.reply_text(text, **kwargs)
+
+
+async def may_manage_team(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Сбрасывать общий прогресс и долги группы могут только ее администраторы"""
+    if not is_team_chat(update.effective_chat):
+        return True
+    try:
+        member = await context.bot.get_chat_member(update.effective_chat.id, update.effective_user.id)
+    except Exception as e:
+        logger.error(f"Ошибка при проверке прав в группе {update.effective_chat.id}: {e}")
+        return False
+    if member.status in ('administrator', 'creator'):
+        return True
+    await send_message(update, "❌ В группе это может сделать только администратор чата.")
+    return False
+
+
+async def send_message(update: Update, text: str, parse_mode: str = 'HTML', reply_markup=None,
+                       photo=None):
+    """Универсальная функция для отправки сообщений (photo - file_id или байты картинки)"""
+    if photo:
         try:
             if update.message:
-                await update.message.reply_photo(photo=image_url, caption=text, parse_mode=parse_mode,
-                                                 reply_markup=reply_markup)
+                return await update.message.reply_photo(photo=photo, caption=text, parse_mode=parse_mode,
+                                                        reply_markup=reply_markup)
             elif update.callback_query:
-                await update.callback_query.message.reply_photo(photo=image_url, caption=text, parse_mode=parse_mode,
-                                                                reply_markup=reply_markup)
+                return await update.callback_query.message.reply_photo(photo=photo, caption=text,
+                                                                       parse_mode=parse_mode,
+                                                                       reply_markup=reply_markup)
             elif update.effective_message:
-                await update.effective_message.reply_photo(photo=image_url, caption=text, parse_mode=parse_mode,
-                                                           reply_markup=reply_markup)
-            return
+                return await update.effective_message.reply_photo(photo=photo, caption=text, parse_mode=parse_mode,
+                                                                  reply_markup=reply_markup)
         except Exception as e:
             logger.error(f"Ошибка при отправке изображения: {e}")
             # Продолжаем отправку текста без изображения
@@ -571,8 +1715,12 @@ async def send_message(update: Update, text: str, parse_mode: str = 'Markdown',
         return await update.effective_message.reply_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
 
 
-async def send_question(update: Update, user_id: int, bot: 'QuestBot'):
-    """Функция для отправки вопроса с изображением и клавиатурой"""
+async def send_question(update: Update, user_id: int, bot: 'QuestBot', with_header: bool = False):
+    """Функция для отправки вопроса с изображением и клавиатурой.
+
+    С with_header заголовок "Загадка N из M" идет в том же сообщении,
+    так что вопрос приходит одним запросом к Telegram.
+    """
     question = bot.get_current_question(user_id)
     if not question:
         await send_message(update, "🎉 Квест завершен! Нажми /restart чтобы начать заново.")
@@ -580,103 +1728,208 @@ async def send_question(update: Update, user_id: int, bot: 'QuestBot'):
 
     text = bot.get_question_text(user_id, question)
     keyboard = bot.get_question_keyboard(user_id, question.id)
+    # Картинку, которую не удалось прочитать, пропускаем: вопрос уходит текстом
+    photo = bot.images.photo(question.image) if question.image else None
+
+    if with_header:
+        combined = f"{question.header_html}\n\n{text}"
+        if photo is not None and len(combined) > CAPTION_LIMIT:
+            # Длинная подпись к фото не поместится - заголовок отдельным сообщением
+            await send_message(update, question.header_html, parse_mode='HTML')
+            with_header = False
+        else:
+            text = combined
 
-    await send_message(
-        update,
-        text,
-        reply_markup=keyboard,
-        parse_mode='Markdown',
-        image_url=question.image_url
+    message = await send_message(update, text, reply_markup=keyboard, parse_mode='HTML', photo=photo)
+    if photo is not None:
+        bot.images.remember(question.image, message)
+    remember_question_message(bot, user_id, question.id, message, text, keyboard, with_header)
+
+
+def remember_question_message(bot: 'QuestBot', user_id: int, question_id: int, message,
+                              text: str, keyboard: Optional[InlineKeyboardMarkup], with_header: bool = False):
+    """Запоминает сообщение с вопросом, чтобы потом редактировать его правильным методом"""
+    if message is None:
+        return
+    previous = bot.question_messages.get(user_id)
+    if previous and previous.keyboard is not None and (
+            previous.chat_id, previous.message_id) != (message.chat_id, message.message_id):
+        # Прежнее сообщение с вопросом больше не актуально - его кнопки снимаем в фоне
+        bot.strip_keyboard(previous.chat_id, previous.message_id)
+    bot.question_messages[user_id] = QuestionMessage(
+        chat_id=message.chat_id,
+        message_id=message.message_id,
+        question_id=question_id,
+        is_photo=bool(message.photo),
+        text=text,
+        keyboard=keyboard,
+        with_header=with_header
     )
 
 
+async def edit_question_message(query, bot: 'QuestBot', user_id: int, question_id: int,
+                                text: str, keyboard: Optional[InlineKeyboardMarkup]):
+    """Редактирует сообщение с вопросом одним запросом и пропускает правки без изменений"""
+    message = query.message
+    record = bot.question_messages.get(user_id)
+    with_header = False
+
+    if record and record.message_id == message.message_id and record.chat_id == message.chat_id:
+        # Сохраняем заголовок, если вопрос был отправлен вместе с ним
+        with_header = record.with_header
+        if with_header:
+            text = f"{QUESTIONS_BY_ID[question_id].header_html}\n\n{text}"
+        if record.text == text and record.keyboard is keyboard:
+            return
+        is_photo = record.is_photo
+    else:
+        # Сообщение отправлено до перезапуска бота - тип узнаем из самого сообщения
+        is_photo = bool(message.photo)
+
+    try:
+        if is_photo:
+            await query.edit_message_caption(caption=text, reply_markup=keyboard, parse_mode='HTML')
+        else:
+            await query.edit_message_text(text=text, reply_markup=keyboard, parse_mode='HTML')
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении сообщения: {e}")
+        message = await message.reply_text(text, reply_markup=keyboard, parse_mode='HTML')
+
+    remember_question_message(bot, user_id, question_id, message, text, keyboard, with_header)
+
+
+STALE_BUTTON_TOAST = "Эта кнопка устарела - продолжай текущую загадку 👇"
+
+
+def retire_question_message(bot: 'QuestBot', user_id: int):
+    """Вопрос решен: кнопки его сообщения снимаются в фоне, нажатия до этого получают тост"""
+    record = bot.question_messages.get(user_id)
+    if record and record.keyboard is not None:
+        bot.strip_keyboard(record.chat_id, record.message_id)
+        record.keyboard = None
+
+
+def is_superseded_press(bot: 'QuestBot', user_id: int, message, callback: Callback) -> bool:
+    """Нажатие на кнопку вопроса, с которого игрок уже ушел.
+
+    Решается только по памяти (последнее сообщение с вопросом и кэш прогресса),
+    прогресс из хранилища не загружается. Если в памяти ничего нет, решает обработчик.
+    """
+    record = bot.question_messages.get(user_id)
+    if record is not None:
+        if (record.chat_id, record.message_id) != (message.chat_id, message.message_id):
+            return True
+        if record.keyboard is None:
+            return True
+    progress = bot.user_progress.get(user_id)
+    return progress is not None and progress.has_started_quest and progress.current_question != callback.question_id
+
+
+async def answer_superseded_press(query, bot: 'QuestBot') -> None:
+    """Один ответ-тост на нажатие устаревшей кнопки; сами кнопки снимаются в фоне"""
+    await query.answer(STALE_BUTTON_TOAST)
+    bot.strip_keyboard(query.message.chat_id, query.message.message_id)
+
+
+async def reject_stale_press(query, bot: 'QuestBot', progress: Optional['UserProgress'], callback: Callback) -> bool:
+    """Нажатие на клавиатуру, отрисованную в другом состоянии вопроса (например, в старой копии сообщения).
+
+    Такое нажатие не применяется: пользователь получает подсказку, а у сообщения
+    обновляются кнопки. True - нажатие отклонено и на запрос уже ответили.
+    """
+    if callback.nonce is None or progress is None or progress.current_question != callback.question_id:
+        return False
+    state = KeyboardRegistry.question_state(progress, callback.question_id)
+    if callback.nonce == state:
+        return False
+
+    await query.answer("Эта кнопка устарела - кнопки обновлены 🙈")
+    try:
+        await query.edit_message_reply_markup(reply_markup=bot.keyboards.question(callback.question_id, state))
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении устаревших кнопок: {e}")
+    return True
+
+
+def begin_quest(bot: 'QuestBot', user_id: int):
+    """Отмечает, что пользователь начал квест"""
+    progress = bot.get_user_progress(user_id)
+    progress.start_quest()
+    bot.save_progress()
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /start"""
+    """Обработчик команды /start (в том числе deep link t.me/<бот>?start=<payload>)"""
     user = update.effective_user
     bot: QuestBot = context.bot_data['quest_bot']
+    payload = context.args[0].lower() if context.args else None
+    player = player_id(update)
 
-    progress = bot.get_user_progress(user.id)
+    # Не создаем прогресс, пока пользователь не нажмет "Начать квест"
+    progress = bot.peek_user_progress(player)
+
+    # Ссылка ?start=play сразу запускает квест без приветствия
+    if payload == START_PAYLOAD_PLAY and (not progress or not progress.has_started_quest):
+        begin_quest(bot, player)
+        await send_question(update, player, bot, with_header=True)
+        return
 
     # Если квест уже завершен
-    if progress.current_question > len(QUESTIONS):
+    if progress and progress.is_finished():
         await send_message(update, "🎉 Ты уже завершил квест! Нажми /restart чтобы начать заново.")
         return
 
     # Если пользователь еще не начинал квест
-    if not progress.has_started_quest:
+    if not progress or not progress.has_started_quest:
         welcome_text = (
-            f"Привет, мой милый *{user.first_name}*! 🧡\n\n"
+            f"Привет, мой милый <b>{escape_html(user.first_name)}</b>! 🧡\n\n"
             f"Добро пожаловать в квест:\n"
-            f"🧡 *В ожидании тепла* 🧡\n\n"
+            f"🧡 <b>В ожидании тепла</b> 🧡\n\n"
             f"Если вдруг зимним вечером тебе станет скучно, то ты можешь открыть этот квест и попробовать решить какую-нибудь загадку)\n\n"
             f"Не обещаю, что станет веселее, но это должно немного отвлечь тебя, и, надеюсь, принести немного приятных эмоций)\n\n"
-            f"Всего тебя ждут *{len(QUESTIONS)}* загадок!\n\n"
-            f"🎮 *Как играть:*\n"
+            f"Всего тебя ждут <b>{len(QUESTIONS)}</b> загадок!\n\n"
+            f"🎮 <b>Как играть:</b>\n"
             f"1. Отвечай на загадки, отправляя ответ в чат\n"
             f"2. Если сложно - используй подсказки (кнопки ниже)\n"
             f"3. После обеих подсказок появится кнопка 'Ответ'\n"
             f"4. Все ответы вводятся маленькими буквами\n"
             f"5. Куда присылать жалобы ты точно знаешь)\n\n"
-            f"📖 *Особые правила:*\n"
+            f"📖 <b>Особые правила:</b>\n"
             f"Если вдруг возникнут трудности, то ты можешь взять подсказку\n"
-            f"• За первую подсказку: +5 минут *обнимашек* для ёжика 🧸\n"
-            f"• За вторую подсказку: +10 *поцелуев* ёжика 💋\n"
-            f"• За ответ (после обеих подсказок): +1 исполнение *желания* ёжика 🪄\n\n"
-            f"*Готов принять вызов? =)*🪄\n\n"
+            f"• За первую подсказку: +5 минут <b>обнимашек</b> для ёжика 🧸\n"
+            f"• За вторую подсказку: +10 <b>поцелуев</b> ёжика 💋\n"
+            f"• За ответ (после обеих подсказок): +1 исполнение <b>желания</b> ёжика 🪄\n\n"
+            f"<b>Готов принять вызов? =)</b>🪄\n\n"
         )
 
-        # Создаем клавиатуру с кнопкой "Начать квест"
-        start_keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🎮 Начать квест", callback_data="start_quest")]
-        ])
-
-        await send_message(update, welcome_text, parse_mode='Markdown', reply_markup=start_keyboard)
+        # Клавиатура с кнопкой "Начать квест"
+        await send_message(update, welcome_text, parse_mode='HTML', reply_markup=bot.keyboards.start_quest)
         return
 
-    # Если пользователь уже начал квест
-    question = bot.get_current_question(user.id)
+    # Если пользователь уже начал квест - одним сообщением заголовок, загадка,
+    # взятые подсказки и клавиатура
+    await send_question(update, player, bot, with_header=True)
 
-    # Показываем сообщение с номером загадки
-    await send_message(
-        update,
-        f"❤️🧡💛️ *Загадка {question.id} из {len(QUESTIONS)}* 💛🧡❤️",
-        parse_mode='Markdown'
-    )
-
-    # Небольшая пауза для эффекта
-    await asyncio.sleep(0.5)
 
-    # Показываем саму загадку
-    await send_question(update, user.id, bot)
-
-
-async def handle_start_quest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_start_quest(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback):
     """Обработчик нажатия кнопки 'Начать квест'"""
     query = update.callback_query
-    await query.answer()
-
-    user = query.from_user
     bot: QuestBot = context.bot_data['quest_bot']
+    player = player_id(update)
 
-    progress = bot.get_user_progress(user.id)
+    # В группе кнопку нажимают несколько участников - квест начинается один раз
+    progress = bot.peek_user_progress(player)
+    if is_team_chat(update.effective_chat) and progress and progress.has_started_quest:
+        await query.answer("Квест уже начат 👇")
+        return
+    await query.answer()
 
     # Устанавливаем флаг, что пользователь начал квест
-    progress.has_started_quest = True
-    progress.log_quest_started()
-    bot.save_progress()
+    begin_quest(bot, player)
 
     # ВМЕСТО РЕДАКТИРОВАНИЯ СООБЩЕНИЯ - ОТПРАВЛЯЕМ НОВОЕ
-    # Показываем сообщение с номером загадки как новое сообщение
-    await query.message.reply_text(
-        text=f"❤️🧡💛️ *Загадка 1 из {len(QUESTIONS)}* 💛🧡❤️",
-        parse_mode='Markdown'
-    )
-
-    # Небольшая пауза для эффекта
-    await asyncio.sleep(0.5)
-
-    # Показываем первую загадку
-    await send_question(update, user.id, bot)
+    # Показываем первую загадку вместе с заголовком
+    await send_question(update, player, bot, with_header=True)
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -684,44 +1937,73 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     message_text = update.message.text.strip().lower()
     bot: QuestBot = context.bot_data['quest_bot']
+    player = player_id(update)
+    member = team_member(update)
+
+    # Ограничиваем частоту ответов до любого логирования и сохранения (в группе - каждого участника)
+    allowed, notify = bot.answer_throttle.check(user.id)
+    if not allowed:
+        if notify:
+            await reply_optional(
+                update, bot,
+                f"⏳ Слишком много попыток! Передохни немного и попробуй через "
+                f"{bot.answer_throttle.retry_after(user.id)} сек."
+            )
+        return
 
-    progress = bot.get_user_progress(user.id)
-
-    # Логируем сообщение пользователя
-    progress.log_user_message(message_text)
+    # Проверяем, начал ли пользователь квест (случайные сообщения не создают прогресс).
+    # В группе обычная переписка до начала и после конца квеста остается без ответа
+    progress = bot.peek_user_progress(player)
+    if not progress or not progress.has_started_quest:
+        if member is None:
+            await update.message.reply_text(
+                "🎮 Сначала начни квест! Нажми /start чтобы начать.",
+                parse_mode='HTML'
+            )
+        return
 
-    # Проверяем, начал ли пользователь квест
-    if not progress.has_started_quest:
-        await update.message.reply_text(
-            "🎮 Сначала начни квест! Нажми /start чтобы начать.",
-            parse_mode='Markdown'
-        )
+    # Тот же ответ, что только что засчитан другому участнику, - склеиваем с ним
+    if member is not None and bot.teams.is_late_answer(player, message_text):
         return
 
-    question = bot.get_current_question(user.id)
+    progress = bot.get_user_progress(player)
+
+    # Логируем сообщение пользователя
+    progress.log_user_message(message_text, member)
+
+    question = bot.get_current_question(player)
 
     if not question:
-        await update.message.reply_text("🎉 Квест завершен! Нажми /restart чтобы начать заново.")
+        if member is None:
+            await update.message.reply_text("🎉 Квест завершен! Нажми /restart чтобы начать заново.")
         return
 
     # Проверка ответа
     if message_text == question.answer.lower():
-        # Логируем правильный ответ
-        progress.log_correct_answer(question.id)
+        # Загадку уже отгадал кто-то из команды, а "Продолжить" еще не нажали
+        if member is not None and question.id in progress.solved_by:
+            bot.teams.counters['coalesced'] += 1
+            return
 
-        # Отмечаем вопрос как пройденный и проверяем подсказки
-        progress.mark_question_completed(question.id)
+        # Правильный ответ засчитывает вопрос (без подсказок, если их не было)
+        progress.answer_correct(question.id, member)
+        bot.answer_throttle.record_correct(user.id)
+        retire_question_message(bot, player)
+        if member is not None:
+            bot.teams.solved(player, message_text)
 
         # Получаем уникальное поздравление для этого вопроса
-        congratulation_text = CONGRATULATIONS.get(question.id, "🎉 *Правильно!* Отличная работа!")
+        congratulation_text = CONGRATULATIONS.get(question.id, "🎉 <b>Правильно!</b> Отличная работа!")
+        if member is not None:
+            congratulation_text += html("\n\n🥇 Первым ответил(а): <b>{}</b>", member[1])
 
         # Добавляем статистику к поздравлению
         total_completed, without_hints = progress.get_stats()
-        used_hints = len(progress.used_hints.get(question.id, []))
+        used_hints = progress.hints_taken(question.id)
 
-        stats_part = f"\n\n📈 *Статистика этой загадки:*\n"
+        stats_part = f"\n\n📈 <b>Статистика этой загадки:</b>\n"
         if used_hints == 0:
-            stats_part += f"✅ *Идеально!* Без подсказок!\n"
+            stats_part += f"✅ <b>Идеально!</b> Без подсказок!\n"
         elif used_hints == 1:
             stats_part += f"💡 Использована 1 подсказка\n"
         else:
@@ -730,14 +2012,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         full_congratulation = f"{congratulation_text}{stats_part}"
 
         # Для последнего вопроса показываем финальные результаты сразу
-        if question.id == len(QUESTIONS):
+        if progress.next_is_ending():
             # Сохраняем прогресс
-            progress.current_question += 1
+            progress.advance()
             progress.log_quest_completed()
             bot.save_progress()
 
             # Показываем поздравление
-            await update.message.reply_text(full_congratulation, parse_mode='Markdown')
+            await update.message.reply_text(full_congratulation, parse_mode='HTML')
 
             # Пауза перед финальными результатами
             await asyncio.sleep(2)
@@ -747,123 +2029,158 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Для не-последних вопросов показываем поздравление с кнопкой "Продолжить"
-        continue_keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("➡️ Продолжить", callback_data=f"next_{question.id}")]
-        ])
-
         await update.message.reply_text(
             full_congratulation,
-            parse_mode='Markdown',
-            reply_markup=continue_keyboard
+            parse_mode='HTML',
+            reply_markup=bot.keyboards.continue_to_next(question.id)
         )
 
     else:
         # Логируем неправильный ответ
-        progress.log_wrong_answer(question.id, message_text)
+        progress.log_wrong_answer(question.id, message_text, member)
+        bot.wrong_answers.add(question.id, message_text)
+        bot.answer_throttle.record_wrong(user.id)
 
-        await update.message.reply_text(
+        await reply_optional(
+            update, bot,
             "❌ Неправильно. Попробуй еще раз! \n\n Или может стоит воспользоваться подсказкой? 😉 ")
 
 
-async def handle_continue(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_continue(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback):
     """Обработчик нажатия кнопки 'Продолжить' после правильного ответа"""
     query = update.callback_query
-    await query.answer()
-
-    user = query.from_user
     bot: QuestBot = context.bot_data['quest_bot']
-
-    # Извлекаем данные из callback_data
-    try:
-        action, question_id_str = query.data.split('_')
-        question_id = int(question_id_str)
-    except ValueError:
-        logger.error(f"Неверный формат callback_data: {query.data}")
-        return
-
-    progress = bot.get_user_progress(user.id)
+    question_id = callback.question_id
+    player = player_id(update)
 
     # Проверяем, начал ли пользователь квест
-    if not progress.has_started_quest:
+    progress = bot.peek_user_progress(player)
+    if not progress or not progress.has_started_quest:
+        await query.answer()
         await query.edit_message_text(
             text="🎮 Сначала начни квест! Нажми /start чтобы начать.",
             reply_markup=None
         )
         return
 
+    # В группе "Продолжить" нажимают сразу несколько участников - следующую загадку показываем один раз
+    if is_team_chat(update.effective_chat) and progress.current_question != question_id \
+            and progress.visited & bit(question_id):
+        await query.answer("Уже продолжили 👇")
+        bot.strip_keyboard(query.message.chat_id, query.message.message_id)
+        return
+
+    await query.answer()
+    progress = bot.get_user_progress(player)
+
     # ВАЖНО: после правильного ответа current_question уже увеличен на 1
     # Поэтому проверяем, что question_id соответствует предыдущему вопросу
     # или что это следующий вопрос
-    expected_current = question_id + 1 if action == "next" else progress.current_question
+    expected_current = question_id + 1 if callback.action == Action.NEXT else progress.current_question
 
     # Если текущий вопрос не соответствует ожидаемому, все равно продолжаем
     # (это может быть из-за задержек или других проблем)
 
     # Увеличиваем номер текущего вопроса, если это нужно
     if progress.current_question == question_id:
-        progress.current_question += 1
-    elif progress.current_question < question_id:
+        progress.advance()
+    elif not progress.visited & bit(question_id):
         # Пользователь пытается перейти к вопросу, который еще не пройден
         # В этом случае просто показываем текущий вопрос
         await query.edit_message_text(
             text="Продолжай текущую загадку!",
             reply_markup=None
         )
-        await send_question(update, user.id, bot)
+        await send_question(update, player, bot)
         return
 
     bot.save_progress()
+    # Кнопка "Продолжить" свое отработала
+    bot.strip_keyboard(query.message.chat_id, query.message.message_id)
 
     # Показываем следующий вопрос
-    next_question = bot.get_current_question(user.id)
+    next_question = bot.get_current_question(player)
     if next_question:
-        # Отправляем новое сообщение с номером загадки
-        await query.message.reply_text(
-            text=f"❤️🧡💛️ *Загадка {next_question.id} из {len(QUESTIONS)}* 💛🧡❤️",
-            parse_mode='Markdown'
-        )
-
-        await send_question(update, user.id, bot)
+        # Отправляем следующую загадку вместе с номером одним сообщением
+        await send_question(update, player, bot, with_header=True)
     else:
         # Это последний вопрос завершен - показываем финальные результаты
         progress.log_quest_completed()
         await show_final_results_from_query(query, progress, bot, context)
 
 
+def duration_line(progress: UserProgress, bot: 'QuestBot') -> str:
+    """Строка итогов со временем прохождения и лимитом"""
+    duration = progress.quest_duration()
+    if duration is None:
+        return ""
+    line = f"• ⏱ Время: {format_duration(duration)}"
+    if bot.quest_time_limit > 0:
+        line += " (в лимите ✅)" if duration <= bot.quest_time_limit else " (вне лимита ⏰)"
+    return line + "\n"
+
+
+# Сколько участников команды перечислять в итогах
+TEAM_LINES_LIMIT = 15
+
+
+def team_lines(team: List[Tuple[str, int, Dict[str, int]]]) -> str:
+    """Строки о вкладе участников команды (см. UserProgress.team; вне группы пусто)"""
+    if not team:
+        return ""
+    lines = ["\n\n👥 <b>Команда:</b>"]
+    for name, solved, debt in team[:TEAM_LINES_LIMIT]:
+        line = html("• {}: отгадано {}", name, solved)
+        if any(debt.values()):
+            line += html("; подсказки: {}", str(UserDebt.from_dict(debt)).replace('\n', ', '))
+        lines.append(line)
+    if len(team) > TEAM_LINES_LIMIT:
+        lines.append(f"• и еще {len(team) - TEAM_LINES_LIMIT}")
+    return "\n".join(lines)
+
+
+def ending_line(progress: UserProgress) -> str:
+    """Строка с концовкой квеста (если концовок в графе несколько)"""
+    if len(QUEST_GRAPH.endings) < 2 or not progress.ending():
+        return ""
+    return f"• 🏁 Концовка: {escape_html(progress.ending())}\n"
+
+
 async def show_final_results(update, progress, bot, context):
     """Показать финальные результаты"""
     total_completed, without_hints = progress.get_stats()
 
     response = (
-        f"🎊 *ПОЗДРАВЛЯЮ С ЗАВЕРШЕНИЕМ КВЕСТА!* 🎊\n\n"
+        f"🎊 <b>ПОЗДРАВЛЯЮ С ЗАВЕРШЕНИЕМ КВЕСТА!</b> 🎊\n\n"
         f"Ты успешно прошел все {len(QUESTIONS)} загадок!\n\n"
-        f"📈 *Итоговая статистика:*\n"
+        f"📈 <b>Итоговая статистика:</b>\n"
         f"• 🎯 Пройдено заданий: {total_completed}\n"
         f"• ✅ Без подсказок: {without_hints}\n"
-        f"• 💡 С подсказками: {total_completed - without_hints}\n\n"
-        f"💝 *Твой долг:*\n{progress.debt}\n\n"
+        f"• 💡 С подсказками: {total_completed - without_hints}\n"
+        f"{duration_line(progress, bot)}{ending_line(progress)}\n"
+        f"💝 <b>Твой долг:</b>\n{progress.debt}{team_lines(progress.team())}\n\n"
     )
 
     if progress.debt.hugs > 0 or progress.debt.kisses > 0 or progress.debt.wishes > 0:
         response += (
-            f"🌟 *Напоминание:*\n"
+            f"🌟 <b>Напоминание:</b>\n"
             f"Все обещания нужно выполнить при первой встрече!✨\n"
         )
     else:
         response += (
-            f"🏆 *ВАУ! Идеальный результат!*\n"
+            f"🏆 <b>ВАУ! Идеальный результат!</b>\n"
             f"Ты прошел весь квест без единой подсказки!\n"
         )
 
     response += (
-        f"🧡 *Спасибо за участие!*\n"
+        f"🧡 <b>Спасибо за участие!</b>\n"
         f"Замечательный медвежонок, теплые воспоминания о наших совместных встречах и правда согревают мое сердце даже вдалеке от тебя 💛\n"
         f"Очень скучаю и жду нашей новой встречи 💛️\n\n"
         f"P.S.: даже если у тебя не оказалось долгов по итогу прохождения квеста, то это не повод не заообнимать и не зацеловать меня при первой встрече 💛\n\n"
         f"Нажми /restart чтобы пройти квест еще раз!"
     )
 
-    await send_message(update, response, parse_mode='Markdown')
+    await send_message(update, response, parse_mode='HTML')
 
     # Отправляем результаты администратору
     await bot.send_results_to_admin(progress, context)
@@ -874,62 +2191,64 @@ async def show_final_results_from_query(query, progress, bot, context):
     total_completed, without_hints = progress.get_stats()
 
     response = (
-        f"🎊 *ПОЗДРАВЛЯЮ С ЗАВЕРШЕНИЕМ КВЕСТА!* 🎊\n\n"
+        f"🎊 <b>ПОЗДРАВЛЯЮ С ЗАВЕРШЕНИЕМ КВЕСТА!</b> 🎊\n\n"
         f"Ты успешно прошел все {len(QUESTIONS)} загадок!\n\n"
-        f"📈 *Итоговая статистика:*\n"
+        f"📈 <b>Итоговая статистика:</b>\n"
         f"• 🎯 Пройдено загадок: {total_completed}\n"
         f"• ✅ Без подсказок: {without_hints}\n"
-        f"• 💡 С подсказками: {total_completed - without_hints}\n\n"
-        f"💝 *Твой долг:*\n{progress.debt}\n\n"
+        f"• 💡 С подсказками: {total_completed - without_hints}\n"
+        f"{duration_line(progress, bot)}{ending_line(progress)}\n"
+        f"💝 <b>Твой долг:</b>\n{progress.debt}{team_lines(progress.team())}\n\n"
     )
 
     if progress.debt.hugs > 0 or progress.debt.kisses > 0 or progress.debt.wishes > 0:
         response += (
-            f"🌟 *Напоминание:*\n"
+            f"🌟 <b>Напоминание:</b>\n"
             f"Все обещания нужно выполнить при первой встрече!\n"
         )
     else:
         response += (
-            f"🏆 *ВАУ! Идеальный результат!*\n"
+            f"🏆 <b>ВАУ! Идеальный результат!</b>\n"
             f"Ты прошел весь квест без единой подсказки!\n"
         )
 
     response += (
-        f"🧡 *Спасибо за участие!*\n"
+        f"🧡 <b>Спасибо за участие!</b>\n"
         f"Замечательный медвежонок, теплые воспоминания о наших совместных встречах и правда согревают мое сердце даже вдалеке от тебя 💛\n"
         f"Очень скучаю и жду нашей новой встречи 💛\n\n"
         f"P.S.: даже если у тебя не оказалось долгов по итогу прохождения квеста, то это не повод не заообнимать и не зацеловать меня при первой встрече 💛\n\n"
         f"Нажми /restart чтобы пройти квест еще раз!"
     )
 
-    await query.message.reply_text(response, parse_mode='Markdown')
+    await query.message.reply_text(response, parse_mode='HTML')
 
     # Отправляем результаты администратору
     await bot.send_results_to_admin(progress, context)
 
 
-async def handle_hint(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_hint(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback):
     """Обработчик нажатий на подсказки"""
     query = update.callback_query
-    await query.answer()
-
-    user = query.from_user
     bot: QuestBot = context.bot_data['quest_bot']
+    question_id, hint_num = callback.question_id, callback.arg
+    player = player_id(update)
+    if hint_num not in HINT_DEBT:
+        await query.answer("Эта кнопка устарела 🙈")
+        return
 
-    # Извлекаем данные из callback_data
-    try:
-        _, question_id_str, hint_num_str = query.data.split('_')
-        question_id = int(question_id_str)
-        hint_num = int(hint_num_str)
-    except ValueError:
-        logger.error(f"Неверный формат callback_data: {query.data}")
+    # Кнопка с пройденного вопроса - отвечаем тостом, не загружая прогресс
+    if is_superseded_press(bot, player, query.message, callback):
+        await answer_superseded_press(query, bot)
         return
 
-    progress = bot.get_user_progress(user.id)
-    question = QUESTIONS[question_id - 1]
+    question = QUESTIONS_BY_ID[question_id]
 
     # Проверяем, начал ли пользователь квест
-    if not progress.has_started_quest:
+    progress = bot.peek_user_progress(player)
+    if await reject_stale_press(query, bot, progress, callback):
+        return
+    if not progress or not progress.has_started_quest:
+        await query.answer()
         await query.edit_message_text(
             text="🎮 Сначала начни квест! Нажми /start чтобы начать.",
             reply_markup=None
@@ -938,64 +2257,47 @@ async def handle_hint(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Проверяем, что пользователь на текущем вопросе
     if progress.current_question != question_id:
-        await query.edit_message_text(
-            text="Эта загадка уже пройдена. Продолжай текущую!",
-            reply_markup=None
-        )
+        await answer_superseded_press(query, bot)
         return
 
-    # Добавляем подсказку в использованные
-    progress.add_hint_used(question_id, hint_num)
+    await query.answer()
+    progress = bot.get_user_progress(player)
+
+    # Добавляем подсказку в использованные (в группе долг записывается и на нажавшего)
+    progress.add_hint_used(question_id, hint_num, team_member(update))
 
     # Формируем новый текст сообщения
-    text = bot.get_question_text(user.id, question)
+    text = bot.get_question_text(player, question)
 
     # Обновляем клавиатуру
-    keyboard = bot.get_question_keyboard(user.id, question_id)
+    keyboard = bot.get_question_keyboard(player, question_id)
 
-    # ОБНОВЛЯЕМ СООБЩЕНИЕ
-    try:
-        await query.edit_message_caption(
-            caption=text,
-            reply_markup=keyboard,
-            parse_mode='Markdown'
-        )
-    except Exception as e:
-        # Если сообщение без фото или другая ошибка
-        try:
-            await query.edit_message_text(
-                text=text,
-                reply_markup=keyboard,
-                parse_mode='Markdown'
-            )
-        except Exception as e2:
-            logger.error(f"Ошибка при обновлении сообщения: {e2}")
-            await query.message.reply_text(text, reply_markup=keyboard, parse_mode='Markdown')
+    # ОБНОВЛЯЕМ СООБЩЕНИЕ (повторное нажатие на ту же подсказку ничего не меняет и не редактирует)
+    await edit_question_message(query, bot, player, question_id, text, keyboard)
 
     bot.save_progress()
 
 
-async def handle_solution(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_solution(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback):
     """Обработчик нажатий на кнопку 'Решение'"""
     query = update.callback_query
-    await query.answer()
-
-    user = query.from_user
     bot: QuestBot = context.bot_data['quest_bot']
+    question_id = callback.question_id
+    player = player_id(update)
 
-    # Извлекаем данные из callback_data
-    try:
-        _, question_id_str = query.data.split('_')
-        question_id = int(question_id_str)
-    except ValueError:
-        logger.error(f"Неверный формат callback_data: {query.data}")
+    # Кнопка с пройденного вопроса - отвечаем тостом, не загружая прогресс
+    if is_superseded_press(bot, player, query.message, callback):
+        await answer_superseded_press(query, bot)
         return
 
-    progress = bot.get_user_progress(user.id)
-    question = QUESTIONS[question_id - 1]
+    question = QUESTIONS_BY_ID[question_id]
 
     # Проверяем, начал ли пользователь квест
-    if not progress.has_started_quest:
+    progress = bot.peek_user_progress(player)
+    if await reject_stale_press(query, bot, progress, callback):
+        return
+    if not progress or not progress.has_started_quest:
+        await query.answer()
         await query.edit_message_text(
             text="🎮 Сначала начни квест! Нажми /start чтобы начать.",
             reply_markup=None
@@ -1004,63 +2306,48 @@ async def handle_solution(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Проверяем, что пользователь на текущем вопросе
     if progress.current_question != question_id:
-        await query.edit_message_text(
-            text="Эта загадка уже пройдена. Продолжай текущую)!",
-            reply_markup=None
-        )
+        await answer_superseded_press(query, bot)
         return
 
-    # Проверяем, что обе подсказки использованы
-    used_hints = progress.used_hints.get(question_id, [])
-    if len(used_hints) < 2:
+    # Проверяем, что обе подсказки использованы (до ответа на нажатие - ответить можно только один раз)
+    if progress.hints_taken(question_id) < 2:
         await query.answer("Сначала используй обе подсказки!", show_alert=True)
         return
 
-    # Добавляем просмотр решения
-    progress.add_solution_shown(question_id)
+    await query.answer()
+    progress = bot.get_user_progress(player)
 
-    # Отмечаем вопрос как пройденный (так как показано решение)
-    progress.mark_question_completed(question_id)
+    # Добавляем просмотр решения (вопрос засчитывается как пройденный с подсказками)
+    progress.add_solution_shown(question_id, team_member(update))
 
     # Получаем уникальное ободряющее сообщение для этого вопроса
     encouragement_text = ENCOURAGEMENTS.get(question_id, "В любом случае, ты молодец!")
 
     # Для последнего вопроса показываем финальные результаты
-    if question_id == len(QUESTIONS):
-        progress.current_question += 1
+    if progress.next_is_ending():
+        progress.advance()
         progress.log_quest_completed()
 
         # Формируем сообщение с решением
-        text = bot.get_question_text(user.id, question)
-        text += f"\n*Ответ:* \n🔴 {question.answer}"
+        text = bot.get_question_text(player, question)
+        text += f"\n<b>Ответ:</b> \n🔴 {escape_html(question.answer)}"
 
         # Создаем сообщение о наказании с уникальным ободряющим текстом
         penalty_text = (
-            f"🪄 *Уи, теперь ты должен желание!*\n\n"
-            f"💌 *Что это значит:*\n"
+            f"🪄 <b>Уи, теперь ты должен желание!</b>\n\n"
+            f"💌 <b>Что это значит:</b>\n"
             f"Ёжик может загадать одно желание,\n"
             f"которое тебе нужно будет выполнить! ❤️\n\n"
-            f"💔 *Но это совсем не повод расстраиваться!*\n"
+            f"💔 <b>Но это совсем не повод расстраиваться!</b>\n"
             f"Задачки неидеальны, и если не удалось найти решение, то всего скорее они просто некачественно составлены)\n"
             f"{encouragement_text}"
         )
 
         # Обновляем сообщение с вопросом и решением
-        try:
-            await query.edit_message_caption(
-                caption=text,
-                reply_markup=None,
-                parse_mode='Markdown'
-            )
-        except:
-            await query.edit_message_text(
-                text=text,
-                reply_markup=None,
-                parse_mode='Markdown'
-            )
+        await edit_question_message(query, bot, player, question_id, text, None)
 
         # Отправляем сообщение о наказании
-        await query.message.reply_text(penalty_text, parse_mode='Markdown')
+        await query.message.reply_text(penalty_text, parse_mode='HTML')
 
         # Пауза перед финальными результатами
         await asyncio.sleep(2)
@@ -1071,66 +2358,43 @@ async def handle_solution(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Для не-последних вопросов показываем решение с кнопкой "Продолжить"
-    progress.current_question += 1
+    progress.advance()
 
     # Формируем сообщение с решением
-    text = bot.get_question_text(user.id, question)
-    text += f"\n🔴 *Ответ:* {question.answer}"
+    text = bot.get_question_text(player, question)
+    text += f"\n🔴 <b>Ответ:</b> {escape_html(question.answer)}"
 
     # Создаем сообщение о наказании с уникальным ободряющим текстом
     penalty_text = (
-        f"🪄 *Уи, теперь ты должен одно желание!*\n\n"
-        f"💌 *Что это значит:*\n"
+        f"🪄 <b>Уи, теперь ты должен одно желание!</b>\n\n"
+        f"💌 <b>Что это значит:</b>\n"
         f"Ёжик может загадать одно желание,\n"
         f"которое тебе нужно будет выполнить! ❤️\n\n"
-        f"💔 *Это не повод расстраиваться!*\n"
+        f"💔 <b>Это не повод расстраиваться!</b>\n"
         f"{encouragement_text}\n\n"
         f"Нажми 'Продолжить' для перехода к следующей загадке:"
     )
 
-    continue_keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("➡️ Продолжить", callback_data=f"next_{question_id}")]
-    ])
-
     # Обновляем сообщение с вопросом и решением
-    try:
-        await query.edit_message_caption(
-            caption=text,
-            reply_markup=None,
-            parse_mode='Markdown'
-        )
-    except:
-        await query.edit_message_text(
-            text=text,
-            reply_markup=None,
-            parse_mode='Markdown'
-        )
+    await edit_question_message(query, bot, player, question_id, text, None)
 
     # Отправляем сообщение о наказании с кнопкой продолжить
-    await query.message.reply_text(penalty_text, parse_mode='Markdown', reply_markup=continue_keyboard)
+    await query.message.reply_text(penalty_text, parse_mode='HTML', reply_markup=bot.keyboards.continue_to_next(question_id))
 
     bot.save_progress()
 
 
 async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Сброс прогресса и начало заново"""
-    user = update.effective_user
     bot: QuestBot = context.bot_data['quest_bot']
+    player = player_id(update)
+    if not await may_manage_team(update, context):
+        return
 
-    # Логируем сброс прогресса
-    old_progress = bot.get_user_progress(user.id)
-    user_actions_logger.info(
-        'RESTART',
-        extra={
-            'user_id': user.id,
-            'action': 'RESTART',
-            'details': f'Сброс прогресса. Старый прогресс: {old_progress.current_question} вопрос'
-        }
-    )
-
-    # Сбрасываем прогресс
-    bot.user_progress[user.id] = UserProgress(user.id)
-    bot.save_progress()
+    # Сбрасываем прогресс событием RESTART (если пользователь еще не играл, сбрасывать нечего)
+    if bot.peek_user_progress(player):
+        bot.get_user_progress(player).restart()
+        bot.save_progress()
 
     response_text = (
         "🔄 Прогресс сброшен! Все долги обнулены.\n"
@@ -1143,99 +2407,114 @@ async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать подробную статистику"""
-    user = update.effective_user
     bot: QuestBot = context.bot_data['quest_bot']
 
-    progress = bot.get_user_progress(user.id)
-    total_completed, without_hints = progress.get_stats()
+    # Итоги без загрузки прогресса в память (у игроков из архива - без распаковки истории)
+    summary = bot.progress_summary(player_id(update))
+    if not summary:
+        await send_message(update, "🎮 Сначала начни квест! Нажми /start чтобы начать.")
+        return
+    total_completed, without_hints = summary['completed'], summary['without_hints']
+    debt = UserDebt.from_dict(summary['debt'])
 
-    if progress.current_question > len(QUESTIONS):
+    if summary['finished']:
         stats_text = (
-            f"*Квест завершен!*\n\n"
-            f"📈 *Итоговая статистика:*\n"
+            f"<b>Квест завершен!</b>\n\n"
+            f"📈 <b>Итоговая статистика:</b>\n"
             f"• 🎯 Пройдено заданий: {total_completed}/{len(QUESTIONS)}\n"
             f"• ✅ Без подсказок: {without_hints}\n"
             f"• 💡 С подсказками: {total_completed - without_hints}\n"
-            f"• 🔴 Показано решений: {len(progress.showed_solutions)}\n\n"
-            f"💝 *Твой долг тепла:*\n{progress.debt}\n\n"
+            f"• 🔴 Показано решений: {summary['solutions']}\n\n"
+            f"💝 <b>Твой долг тепла:</b>\n{debt}\n\n"
         )
 
-        if progress.debt.hugs == 0 and progress.debt.kisses == 0 and progress.debt.wishes == 0:
-            stats_text += "🏆 *Идеальный результат!* Ты прошел квест без долгов!\n\n"
+        if debt.is_empty():
+            stats_text += "🏆 <b>Идеальный результат!</b> Ты прошел квест без долгов!\n\n"
 
         stats_text += "Нажми /restart чтобы начать заново."
     else:
-        question = bot.get_current_question(user.id)
-        current_hints = len(progress.used_hints.get(progress.current_question, []))
+        question = QUESTIONS_BY_ID[summary['current_question']]
 
         stats_text = (
-            f"*Квест: В ожидании тепла*\n\n"
-            f"📈 *Статистика:*\n"
+            f"<b>Квест: В ожидании тепла</b>\n\n"
+            f"📈 <b>Статистика:</b>\n"
             f"• 📈 Прогресс: {total_completed}/{len(QUESTIONS)}\n"
             f"• ✅ Без подсказок: {without_hints} загадок\n"
             f"• 💡 С подсказками: {total_completed - without_hints}\n"
-            f"• 🔴 Показано решений: {len(progress.showed_solutions)}\n\n"
-            f"🎯 *Текущий загадка:* {progress.current_question}\n"
-            f"🔍 Использовано подсказок: {current_hints}/2\n\n"
-            f"💝 *Твой долг:*\n{progress.debt}\n\n"
+            f"• 🔴 Показано решений: {summary['solutions']}\n\n"
+            f"🎯 <b>Текущий загадка:</b> {summary['current_question']}\n"
+            f"🔍 Использовано подсказок: {summary['current_hints']}/2\n"
         )
+        if summary['question_started_at']:
+            elapsed = seconds_between(summary['question_started_at'], now_ms())
+            stats_text += f"⏱ Над этой загадкой: {format_duration(elapsed)}\n"
+        stats_text += f"\n💝 <b>Твой долг:</b>\n{debt}\n\n"
 
-        if progress.debt.hugs > 0 or progress.debt.kisses > 0 or progress.debt.wishes > 0:
+        if not debt.is_empty():
             stats_text += (
-                "🌟 *Напоминание:*\n"
+                "🌟 <b>Напоминание:</b>\n"
                 "Каждая подсказка и ответ - это обещание тепла и нежности!\n"
                 "Выполни все при первой встрече! ✨\n\n"
             )
 
-        stats_text += f" *Текущая загадка:* {question.text[:60]}..."
+        stats_text += f" <b>Текущая загадка:</b> {question.preview}..."
 
-    await send_message(update, stats_text, parse_mode='Markdown')
+    await send_message(update, stats_text, parse_mode='HTML')
 
 
 async def debt_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать информацию о долгах"""
-    user = update.effective_user
     bot: QuestBot = context.bot_data['quest_bot']
 
-    progress = bot.get_user_progress(user.id)
-    total_completed, without_hints = progress.get_stats()
+    summary = bot.progress_summary(player_id(update))
+    if not summary:
+        await send_message(update, "🎮 Сначала начни квест! Нажми /start чтобы начать.")
+        return
+    total_completed, without_hints = summary['completed'], summary['without_hints']
+    debt = UserDebt.from_dict(summary['debt'])
 
     debt_text = (
-        f"💝 *Твой долг тепла:*\n\n"
-        f"{progress.debt}\n\n"
+        f"💝 <b>Твой долг тепла:</b>\n\n"
+        f"{debt}\n\n"
     )
 
-    if progress.debt.hugs > 0 or progress.debt.kisses > 0 or progress.debt.wishes > 0:
+    if not debt.is_empty():
         debt_text += (
-            f"📊 *Контекст:*\n"
+            f"📊 <b>Контекст:</b>\n"
             f"• 🎯 Пройдено загадок: {total_completed}\n"
             f"• ✅ Без подсказок: {without_hints}\n"
             f"• 💡 С подсказками: {total_completed - without_hints}\n"
-            f"• 🔴 Показано решений: {len(progress.showed_solutions)}\n\n"
-            f"🌟 *Важно:*\n"
+            f"• 🔴 Показано решений: {summary['solutions']}\n\n"
+            f"🌟 <b>Важно:</b>\n"
             f"Все обещания нужно выполнить при первой встрече!💕\n"
         )
     else:
         debt_text += (
-            f"🎉 *Ура! У тебя нет долгов!*\n"
+            f"🎉 <b>Ура! У тебя нет долгов!</b>\n"
             f"Ты молодец! Продолжай в том же духе!\n\n"
             f"📈 Статистика: {without_hints}/{total_completed} без подсказок\n\n"
         )
+    # В группе долг общий - показываем, кто сколько добавил
+    debt_text += team_lines(summary['team'])
 
-    await send_message(update, debt_text, parse_mode='Markdown')
+    await send_message(update, debt_text, parse_mode='HTML')
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Помощь по командам"""
     help_text = (
-        "🧡 *Квест: В ожидании тепла*\n\n"
-        "📋 *Доступные команды:*\n\n"
+        "🧡 <b>Квест: В ожидании тепла</b>\n\n"
+        "📋 <b>Доступные команды:</b>\n\n"
         "/start - Начать или продолжить квест\n"
         "/restart - Начать квест заново (обнуляет долги)\n"
         "/stats - Подробная статистика\n"
         "/debt - Показать текущий долг\n"
+        "/debt_history - История начислений и погашений долга\n"
+        "/remind - Включить или выключить напоминания\n"
+        "/leaderboard - Таблица лидеров (участие: /leaderboard on)\n"
+        "/repay &lt;вид&gt; &lt;сколько&gt; - Отметить, что часть долга выполнена\n"
         "/help - Показать это сообщение\n\n"
-        "📖 *Особые правила квеста:*\n"
+        "📖 <b>Особые правила квеста:</b>\n"
         "1. Отвечай на загадки, отправляя ответы текстом\n"
         "2. Если нужна помощь - используй подсказки:\n"
         "   • 🧸 Первая подсказка: +5 минут обнимашек для ёжика\n"
@@ -1244,46 +2523,296 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "   • 🔴 Ответ: +1 исполнение желания ёжика\n"
         "4. Чем меньше подсказок - тем лучше результат!\n"
         "5. Все долги нужно выполнить при первой встрече! ⏰\n\n"
-        "📝 *Важно:*\n"
+        "📝 <b>Важно:</b>\n"
         "• Ответы вводи строчными буквами\n"
         "• Без лишних символов и пробелов\n"
         "• Прогресс сохраняется автоматически\n\n"
-        "🧡 *Скучаю по тебе и жду встречи!* 🧡"
+        "👥 <b>В группе</b> квест общий: засчитывается первый правильный ответ, "
+        "подсказки записываются на того, кто их взял, а /restart и долги - у администраторов чата\n\n"
+        "🧡 <b>Скучаю по тебе и жду встречи!</b> 🧡"
     )
 
-    await send_message(update, help_text, parse_mode='Markdown')
+    await send_message(update, help_text, parse_mode='HTML')
 
 
 async def clear_debt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для отметки выполнения долгов"""
-    user = update.effective_user
     bot: QuestBot = context.bot_data['quest_bot']
+    player = player_id(update)
 
-    progress = bot.get_user_progress(user.id)
-    old_debt = str(progress.debt)
+    progress = bot.peek_user_progress(player)
+    if not progress:
+        await send_message(update, "🎮 Сначала начни квест! Нажми /start чтобы начать.")
+        return
+    if not await may_manage_team(update, context):
+        return
 
-    # Логируем очистку долга
-    user_actions_logger.info(
-        'CLEAR_DEBT',
-        extra={
-            'user_id': user.id,
-            'action': 'CLEAR_DEBT',
-            'details': f'Очистка долга. Было: {old_debt}'
-        }
-    )
+    progress = bot.get_user_progress(player)
+    old_debt = str(progress.debt)
 
-    # Обнуляем долги
-    progress.debt = UserDebt()
+    # Обнуляем долги событием DEBT_CLEARED
+    progress.clear_debt()
     bot.save_progress()
 
     response = (
-        f"💝 *Долги выполнены!*\n\n"
-        f"🎁 *Было:* {old_debt}\n"
-        f"✨ *Стало:* {progress.debt}\n\n"
+        f"💝 <b>Долги выполнены!</b>\n\n"
+        f"🎁 <b>Было:</b> {old_debt}\n"
+        f"✨ <b>Стало:</b> {progress.debt}\n\n"
         f"Молодец! Все обещания выполнены! 💕\n"
     )
 
-    await send_message(update, response, parse_mode='Markdown')
+    await send_message(update, response, parse_mode='HTML')
+
+
+LEADERBOARD_PAGE_SIZE = 10
+
+
+# Курсор листания в хвосте callback_data: назад ли, и ключ крайней показанной строки
+# (решений, подсказок, время, user_id) - следующая страница читается по индексу мест с этого ключа
+LEADERBOARD_CURSOR = struct.Struct('>?HHdq')
+
+
+def render_leaderboard(bot: 'QuestBot', viewer_id: int, page: int,
+                       cursor: bytes = b'') -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Страница таблицы лидеров и кнопки листания.
+
+    Кнопки несут курсор, по номеру страницы (/leaderboard 5) ключ начала ищется по индексу.
+    Несохраненные результаты берутся из памяти, без сохранения.
+    """
+    after = before = None
+    if len(cursor) == LEADERBOARD_CURSOR.size:
+        backward, *key = LEADERBOARD_CURSOR.unpack(cursor)
+        if backward:
+            before = tuple(key)
+        else:
+            after = tuple(key)
+    elif page > 1:
+        after = bot.store.leaderboard_key_at(QUEST_ID, (page - 1) * LEADERBOARD_PAGE_SIZE - 1)
+        if after is None:
+            page = 1
+    rows, total, place = bot.store.leaderboard_view(
+        QUEST_ID, LEADERBOARD_PAGE_SIZE, viewer_id, after, before, bot.pending_leaderboard())
+    if not rows and total:
+        # Таблица сдвинулась, и за курсором пусто - показываем первую страницу
+        page, rows, total, place = 1, *bot.store.leaderboard_view(
+            QUEST_ID, LEADERBOARD_PAGE_SIZE, viewer_id, pending=bot.pending_leaderboard())
+    pages = max(1, -(-total // LEADERBOARD_PAGE_SIZE))
+    page = min(max(1, page), pages)
+    is_admin = viewer_id == bot.admin_user_id
+
+    text = f"🏆 <b>Таблица лидеров</b> (страница {page} из {pages})\n\n"
+    if not total:
+        text += "Пока здесь никого нет - стань первым!\n"
+    for i, row in enumerate(rows):
+        text += html(
+            "{}. <b>{}</b> - решений {}, подсказок {}, {}",
+            (page - 1) * LEADERBOARD_PAGE_SIZE + i + 1, row['name'], row['solutions'], row['hints'],
+            format_duration(row['duration'])
+        )
+        if is_admin:
+            text += html(" <code>{}</code>", row['user_id'])
+        text += "\n"
+
+    if place:
+        text += f"\n⭐ Ты на {place} месте из {total}"
+    else:
+        text += "\nХочешь в таблицу? Пройди квест и включи участие: /leaderboard on [имя]"
+
+    buttons = []
+    if page > 1 and rows:
+        cursor = LEADERBOARD_CURSOR.pack(True, *leaderboard_key(rows[0]))
+        buttons.append(InlineKeyboardButton("◀️", callback_data=encode_callback(
+            Callback(Action.LEADERBOARD_PAGE, arg=min(page - 1, 0xFFFF), extra=cursor))))
+    if page < pages and rows:
+        cursor = LEADERBOARD_CURSOR.pack(False, *leaderboard_key(rows[-1]))
+        buttons.append(InlineKeyboardButton("▶️", callback_data=encode_callback(
+            Callback(Action.LEADERBOARD_PAGE, arg=min(page + 1, 0xFFFF), extra=cursor))))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Таблица лидеров: /leaderboard [страница], /leaderboard on [имя], /leaderboard off"""
+    user = update.effective_user
+    bot: QuestBot = context.bot_data['quest_bot']
+    argument = context.args[0].lower() if context.args else None
+    player = player_id(update)
+
+    if argument in ('on', 'off'):
+        if not bot.peek_user_progress(player):
+            await send_message(update, "🎮 Сначала начни квест! Нажми /start чтобы начать.")
+            return
+        progress = bot.get_user_progress(player)
+        if argument == 'on':
+            # Команда по умолчанию участвует под названием группы
+            default_name = update.effective_chat.title if is_team_chat(update.effective_chat) else user.first_name
+            name = ' '.join(context.args[1:]).strip() or default_name or f"Игрок {player}"
+            progress.set_leaderboard(name[:32])
+            note = html("🏆 Ты участвуешь в таблице лидеров как <b>{}</b>.", name[:32])
+            if not progress.is_finished():
+                note += "\nРезультат появится, когда пройдешь квест."
+        else:
+            progress.set_leaderboard(None)
+            note = "Ты больше не участвуешь в таблице лидеров."
+        bot.save_progress()
+        await send_message(update, note)
+        return
+
+    page = int(argument) if argument and argument.isdigit() else 1
+    text, keyboard = render_leaderboard(bot, player, page)
+    await send_message(update, text, reply_markup=keyboard)
+
+
+async def handle_leaderboard_page(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback):
+    """Листание таблицы лидеров кнопками"""
+    query = update.callback_query
+    bot: QuestBot = context.bot_data['quest_bot']
+    await query.answer()
+
+    text, keyboard = render_leaderboard(bot, player_id(update), callback.arg, callback.extra)
+    try:
+        await query.edit_message_text(text=text, reply_markup=keyboard, parse_mode='HTML')
+    except Exception as e:
+        logger.error(f"Ошибка при листании таблицы лидеров: {e}")
+
+
+async def remind(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Включить или выключить напоминания: /remind [on|off]"""
+    bot: QuestBot = context.bot_data['quest_bot']
+    player = player_id(update)
+
+    if not bot.peek_user_progress(player):
+        await send_message(update, "🎮 Сначала начни квест! Нажми /start чтобы начать.")
+        return
+
+    progress = bot.get_user_progress(player)
+    argument = context.args[0].lower() if context.args else None
+    if argument in ('on', 'вкл'):
+        enabled = True
+    elif argument in ('off', 'выкл'):
+        enabled = False
+    else:
+        enabled = not progress.reminders
+
+    if enabled != progress.reminders:
+        progress.set_reminders(enabled)
+        bot.save_progress()
+
+    if enabled:
+        await send_message(
+            update,
+            f"🔔 Напоминания включены: если пропадешь на {format_duration(bot.nudge_after)}, я напомню о квесте.\n"
+            f"Выключить: /remind off"
+        )
+    else:
+        await send_message(update, "🔕 Напоминания выключены. Включить: /remind on")
+
+
+def _ledger_amounts(amounts: Dict[str, int]) -> str:
+    return str(UserDebt.from_dict(amounts)).replace('\n', ', ')
+
+
+LEDGER_REASONS = {
+    'HINT_USED': 'подсказка {hint_num} к загадке {question_id}',
+    'SOLUTION_SHOWN': 'решение загадки {question_id}',
+    'DEBT_CLEARED': 'все долги выполнены',
+    'DEBT_REPAID': 'часть долга выполнена',
+    'RESTART': 'списано при /restart',
+    'OPENING': 'долг до появления истории',
+}
+
+
+async def repay(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Частичное погашение долга: /repay <вид> <сколько>"""
+    bot: QuestBot = context.bot_data['quest_bot']
+    player = player_id(update)
+
+    progress = bot.peek_user_progress(player)
+    if not progress:
+        await send_message(update, "🎮 Сначала начни квест! Нажми /start чтобы начать.")
+        return
+
+    kind = DEBT_KINDS.get(context.args[0].lower()) if context.args else None
+    try:
+        amount = int(context.args[1]) if len(context.args or []) > 1 else 0
+    except ValueError:
+        amount = 0
+    if kind is None or amount <= 0:
+        await send_message(
+            update,
+            "❌ Укажи, что выполнено: /repay &lt;обнимашки|поцелуи|желания&gt; &lt;сколько&gt;\n"
+            "Например: /repay поцелуи 3"
+        )
+        return
+
+    if not await may_manage_team(update, context):
+        return
+
+    progress = bot.get_user_progress(player)
+    repaid = progress.repay(kind, amount)
+    if repaid == 0:
+        await send_message(update, "🎉 Такого долга у тебя нет!")
+        return
+    bot.save_progress()
+
+    await send_message(
+        update,
+        f"💝 <b>Засчитано:</b> {_ledger_amounts({kind: repaid})}\n\n"
+        f"✨ <b>Осталось:</b>\n{progress.debt}"
+    )
+
+
+async def debt_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Последние начисления и погашения долга"""
+    bot: QuestBot = context.bot_data['quest_bot']
+    player = player_id(update)
+
+    if not bot.peek_user_progress(player):
+        await send_message(update, "🎮 Сначала начни квест! Нажми /start чтобы начать.")
+        return
+
+    # Проводки пишутся при сохранении: к сохраненным добавляем еще не записанные из памяти
+    progress = bot.user_progress[player]
+    pending = sorted(progress.ledger_in(progress.action_log.pending), key=lambda entry: (entry.seq, entry.entry))
+    entries = (bot.store.load_ledger(player, 15) + [entry.to_dict() for entry in pending])[-15:]
+    if not entries:
+        await send_message(update, "📭 Долгов еще не было.")
+        return
+
+    lines = ["📒 <b>История долга:</b>\n"]
+    for entry in entries:
+        sign = "➕" if entry['entry'] == 'debit' else "➖"
+        reason = LEDGER_REASONS.get(entry['reason'], entry['reason']).format(
+            question_id=entry['question_id'], hint_num=entry['hint_num'])
+        lines.append(html("{} {} - {} ({})", sign, _ledger_amounts(entry['amounts']), reason,
+                          entry['timestamp'][:10]))
+
+    await send_message(update, "\n".join(lines))
+
+
+async def debt_totals(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Итоги долгов по всем пользователям (только для администратора)"""
+    user = update.effective_user
+    bot: QuestBot = context.bot_data['quest_bot']
+
+    if user.id != bot.admin_user_id:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+
+    # Итоги в хранилище плюс проводки, которые еще не сохранены
+    totals = bot.store.debt_totals()
+    for progress in bot.unsaved():
+        for entry in progress.ledger_in(progress.action_log.pending):
+            for kind in totals[entry.entry]:
+                totals[entry.entry][kind] += entry.amounts.get(kind, 0)
+    outstanding = {kind: totals['debit'][kind] - totals['credit'][kind] for kind in totals['debit']}
+
+    await update.message.reply_text(
+        f"📒 <b>Долги всех пользователей</b>\n\n"
+        f"➕ <b>Начислено:</b>\n{UserDebt.from_dict(totals['debit'])}\n\n"
+        f"➖ <b>Погашено:</b>\n{UserDebt.from_dict(totals['credit'])}\n\n"
+        f"💝 <b>Осталось:</b>\n{UserDebt.from_dict(outstanding)}",
+        parse_mode='HTML'
+    )
 
 
 async def get_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1301,11 +2830,11 @@ async def get_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
             lines = f.readlines()
             last_lines = lines[-20:] if len(lines) > 20 else lines
 
-        logs_text = "📋 *Последние 20 действий из лога:*\n\n"
+        logs_text = "📋 <b>Последние 20 действий из лога:</b>\n\n"
         for line in last_lines:
-            logs_text += f"`{line.strip()}`\n"
+            logs_text += f"<code>{escape_html(line.strip())}</code>\n"
 
-        await update.message.reply_text(logs_text, parse_mode='Markdown')
+        await update.message.reply_text(logs_text, parse_mode='HTML')
 
     except FileNotFoundError:
         await update.message.reply_text("📭 Лог-файл не найден.")
@@ -1331,29 +2860,32 @@ async def get_user_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = int(context.args[0])
         bot: QuestBot = context.bot_data['quest_bot']
 
-        if user_id in bot.user_progress:
-            progress = bot.user_progress[user_id]
+        progress = bot.peek_user_progress(user_id)
+        if progress:
             recent_actions = progress.action_log.get_recent_actions(15)
 
             if recent_actions:
-                logs_text = f"📋 *Последние 15 действий пользователя {user_id}:*\n\n"
+                parts = [f"📋 <b>Последние 15 действий пользователя {user_id}:</b>\n\n"]
                 for action in recent_actions:
-                    timestamp = action['timestamp'][:19].replace('T', ' ')
-                    logs_text += f"⏰ *{timestamp}*\n"
-                    logs_text += f"🔹 *Действие:* {action['action']}\n"
-                    logs_text += f"📝 *Детали:* {action['details']}\n"
-                    if action.get('data'):
-                        logs_text += f"📊 *Данные:* {action['data']}\n"
-                    logs_text += "━━━━━━━━━━━━━━━━━━━━\n"
-
-                # Разбиваем на части, если сообщение слишком длинное
-                if len(logs_text) > 4000:
-                    parts = [logs_text[i:i + 4000] for i in range(0, len(logs_text), 4000)]
-                    for part in parts:
-                        await update.message.reply_text(part, parse_mode='Markdown')
+                    # Детали и данные содержат текст пользователя - html() их экранирует
+                    entry = html(
+                        "⏰ <b>{}</b>\n🔹 <b>Действие:</b> {}\n📝 <b>Детали:</b> {}\n",
+                        format_ms(action.ts), action.name, action.details
+                    )
+                    if action.data:
+                        entry += html("📊 <b>Данные:</b> {}\n", action.data)
+                    entry += "━━━━━━━━━━━━━━━━━━━━\n"
+
+                    # Разбиваем на части по записям, чтобы не разрезать HTML-теги
+                    if len(parts[-1]) + len(entry) > 4000:
+                        parts.append(entry)
+                    else:
+                        parts[-1] += entry
+
+                for i, part in enumerate(parts):
+                    if i:
                         await asyncio.sleep(0.5)
-                else:
-                    await update.message.reply_text(logs_text, parse_mode='Markdown')
+                    await update.message.reply_text(part, parse_mode='HTML')
             else:
                 await update.message.reply_text(f"📭 У пользователя {user_id} нет записей в логе.")
         else:
@@ -1365,49 +2897,460 @@ async def get_user_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"❌ Ошибка: {e}")
 
 
-def main():
-    """Запуск бота"""
-    # Токен вашего бота
-    load_dotenv()
-    TOKEN = os.getenv("BOT_TOKEN")
+def _debt_line(debt: Dict) -> str:
+    return str(UserDebt.from_dict(debt)).replace('\n', ', ')
+
+
+async def attempts_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """История попыток пользователя: число попыток, лучший результат и весь долг (только для администратора)"""
+    user = update.effective_user
+    bot: QuestBot = context.bot_data['quest_bot']
+
+    if user.id != bot.admin_user_id:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+
+    if not context.args:
+        await update.message.reply_text("❌ Укажите ID пользователя: /attempts <user_id>")
+        return
+
+    try:
+        user_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат ID пользователя.")
+        return
+
+    progress = bot.peek_user_progress(user_id)
+    if progress is None:
+        await update.message.reply_text(f"❌ Пользователь {user_id} не найден.")
+        return
+
+    # Архив попыток пополняется при сохранении: добавляем и еще не записанные попытки
+    attempts = bot.store.load_attempts(user_id) + progress.attempts_in(progress.action_log.pending)
+    current = progress.attempt_summary()
+    current['ended_at'] = None
+    attempts.append(current)
+
+    best = max(attempts, key=lambda a: (a['completed'], a['without_hints'], -a['solutions']))
+    total_debt = UserDebt()
+    for attempt in attempts:
+        total_debt.hugs += attempt['debt'].get('hugs', 0)
+        total_debt.kisses += attempt['debt'].get('kisses', 0)
+        total_debt.wishes += attempt['debt'].get('wishes', 0)
+
+    text = html(
+        "🔁 <b>Попытки пользователя {}</b>\n\n"
+        "Всего попыток: <b>{}</b>\n"
+        "Лучшая: №{} - пройдено {} из {}, без подсказок {}\n\n"
+        "💝 <b>Долг за все попытки:</b>\n{}\n\n",
+        user_id, len(attempts), best['attempt'], best['completed'], len(QUESTIONS),
+        best['without_hints'], total_debt
+    )
+    for attempt in attempts[-10:]:
+        status = "🏁" if attempt['finished'] else ("▶️" if attempt['ended_at'] is None else "⏹")
+        text += html(
+            "{} №{} ({}): {} из {}, без подсказок {}, решений {}; {}\n",
+            status, attempt['attempt'], attempt['started_at'][:10], attempt['completed'], len(QUESTIONS),
+            attempt['without_hints'], attempt['solutions'], _debt_line(attempt['debt'])
+        )
+
+    await update.message.reply_text(text, parse_mode='HTML')
+
+
+BULK_USAGE = {
+    'broadcast': "/broadcast &lt;сегмент&gt; &lt;текст&gt;",
+    'clear_debt': "/bulk_clear_debt &lt;сегмент&gt;",
+    'reset': "/bulk_reset &lt;сегмент&gt;",
+}
+SEGMENTS_HELP = "Сегменты: all, active (играют), finished (прошли), idle:N (неактивны дольше N дней)"
+
+
+async def submit_bulk_job(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str):
+    """Запуск массовой задачи по сегменту пользователей (только для администратора)"""
+    user = update.effective_user
+    bot: QuestBot = context.bot_data['quest_bot']
+
+    if user.id != bot.admin_user_id:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+
+    from bulk_jobs import BulkJob, parse_segment
+
+    runner = bot.bulk_runner()
+    if runner.running:
+        await update.message.reply_text(
+            f"⏳ Уже выполняется задача:\n\n{runner.job.describe()}\n\nОтменить: /bulk_cancel")
+        return
+
+    # Текст рассылки берем из сообщения целиком, чтобы сохранить переносы строк
+    parts = update.message.text.split(maxsplit=2)
+    segment = parse_segment(parts[1]) if len(parts) > 1 else None
+    text = parts[2].strip() if len(parts) > 2 else ''
+    if segment is None or (kind == 'broadcast') != bool(text):
+        await update.message.reply_text(f"❌ Использование: {BULK_USAGE[kind]}\n{SEGMENTS_HELP}", parse_mode='HTML')
+        return
+
+    # Сегмент выбирается из хранилища - сначала сбрасываем несохраненный прогресс
+    bot.flush()
+    job = BulkJob(kind, segment[0], idle_days=segment[1], text=text, admin_chat_id=update.effective_chat.id)
+    status = await update.message.reply_text("📦 Запускаю задачу...")
+    job.status_message_id = status.message_id
+    runner.submit(job)
+    await bot.report_bulk_job(job, False)
+
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка сообщения сегменту пользователей: /broadcast <сегмент> <текст>"""
+    await submit_bulk_job(update, context, 'broadcast')
+
+
+async def bulk_clear_debt(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Очистка долгов сегмента пользователей: /bulk_clear_debt <сегмент>"""
+    await submit_bulk_job(update, context, 'clear_debt')
+
+
+async def bulk_reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сброс прогресса сегмента пользователей: /bulk_reset <сегмент>"""
+    await submit_bulk_job(update, context, 'reset')
+
+
+async def bulk_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Состояние последней массовой задачи (только для администратора)"""
+    user = update.effective_user
+    bot: QuestBot = context.bot_data['quest_bot']
+
+    if user.id != bot.admin_user_id:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+
+    job = bot.bulk_runner().job
+    await update.message.reply_text(job.describe() if job else "Массовых задач еще не было.")
+
+
+async def bulk_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отмена выполняющейся массовой задачи (только для администратора)"""
+    user = update.effective_user
+    bot: QuestBot = context.bot_data['quest_bot']
+
+    if user.id != bot.admin_user_id:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+
+    runner = bot.bulk_runner()
+    if not runner.running:
+        await update.message.reply_text("Сейчас нет выполняющейся задачи.")
+        return
+    await runner.cancel()
+    await update.message.reply_text(runner.job.describe())
+
+
+async def metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Хранилище, фоновые очереди, командный режим и пулы соединений с Telegram (только для администратора)"""
+    user = update.effective_user
+    bot: QuestBot = context.bot_data['quest_bot']
+
+    if user.id != bot.admin_user_id:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+
+    hot, cold = bot.store.count_tiers()
+    lines = [f"🗄 <b>Хранилище:</b> в памяти {len(bot.user_progress)}, горячий уровень {hot}, холодный {cold}"]
+    for partition, users, size in bot.store.cold_partitions():
+        lines.append(f"  архив {partition}: {users} игроков, {size / 1024:.0f} КБ")
+
+    stripper = bot.keyboard_stripper
+    if stripper is not None:
+        lines.append(
+            f"\n🧹 <b>Устаревшие кнопки:</b> в очереди {len(stripper.queue)}, снято {stripper.counters['stripped']}, "
+            f"не удалось снять {stripper.counters['failed']}, пауз по RetryAfter {stripper.counters['retry_after']}"
+        )
+    else:
+        lines.append("\n🧹 <b>Устаревшие кнопки:</b> не запущено (бот работает без polling)")
+    lines.append(
+        f"\n👥 <b>Командный режим:</b> ответов в группы {bot.teams.counters['replies']}, "
+        f"подавлено {bot.teams.counters['suppressed']}, "
+        f"склеено одновременных правильных ответов {bot.teams.counters['coalesced']}, "
+        f"обновлений ждали своей очереди {bot.player_locks.counters['waited']}"
+    )
+    lines.append("\n🌐 <b>Пулы соединений с Telegram</b>")
+    for name, stats in bot.http_stats.items():
+        summary = stats.summary()
+        lines.append(
+            f"\n<b>{name}</b> (размер {summary['size']}):\n"
+            f"Запросов: {summary['requests']}, сейчас в работе: {summary['in_flight']}, "
+            f"пик: {summary['peak_in_flight']}\n"
+            f"Ожидание соединения: среднее {summary['wait_avg_ms']:.1f} мс, p50 {summary['wait_p50_ms']:.1f} мс, "
+            f"p95 {summary['wait_p95_ms']:.1f} мс, максимум {summary['wait_max_ms']:.1f} мс\n"
+            f"Таймаутов пула: {summary['pool_timeouts']}"
+        )
+    await update.message.reply_text("\n".join(lines), parse_mode='HTML')
+
+
+async def throttle_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Счетчики ограничителя ответов (только для администратора)"""
+    user = update.effective_user
+    bot: QuestBot = context.bot_data['quest_bot']
+
+    if user.id != bot.admin_user_id:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+
+    throttle = bot.answer_throttle
+    now = time.monotonic()
+    blocked = sum(1 for bucket in throttle.buckets.values() if bucket.blocked_until > now)
+
+    await update.message.reply_text(
+        f"🚦 Ограничение ответов:\n\n"
+        f"Принято ответов: {throttle.counters['allowed']}\n"
+        f"Отклонено: {throttle.counters['throttled']}\n"
+        f"Пауз после ошибок: {throttle.counters['backoffs']}\n"
+        f"Предупреждений отправлено: {throttle.counters['notices']}\n"
+        f"Отслеживается пользователей: {len(throttle.buckets)}\n"
+        f"Сейчас на паузе: {blocked}"
+    )
+
+
+async def wrong_answers_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Самые частые неправильные ответы на вопрос (только для администратора)"""
+    user = update.effective_user
+    bot: QuestBot = context.bot_data['quest_bot']
+
+    if user.id != bot.admin_user_id:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+
+    if not context.args:
+        await update.message.reply_text("❌ Укажите номер загадки: /wrong_answers <question_id> [k]")
+        return
+
+    try:
+        question_id = int(context.args[0])
+        k = int(context.args[1]) if len(context.args) > 1 else 10
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат номера загадки.")
+        return
 
-    # Создаем приложение
-    application = Application.builder() \
-        .token(TOKEN) \
-        .build()
+    top = bot.wrong_answers.top(question_id, k)
+    if not top:
+        await update.message.reply_text(f"📭 Для загадки {question_id} неправильных ответов нет.")
+        return
+
+    lines = [f"❌ Частые неправильные ответы на загадку {question_id} "
+             f"(всего: {bot.wrong_answers.total(question_id)}):", ""]
+    for answer, count in top:
+        lines.append(f"{count} × {answer}")
+
+    await update.message.reply_text("\n".join(lines))
+
+
+async def export_actions_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выгрузить все действия в колоночный файл (только для администратора)"""
+    user = update.effective_user
+    bot: QuestBot = context.bot_data['quest_bot']
+
+    if user.id != bot.admin_user_id:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+
+    # Экспорт нужен редко и тянет pyarrow - импортируем только здесь, а не при запуске бота
+    import shutil
+    import tempfile
+    from export_actions import export_actions, iter_store_rows, FORMATS
+
+    fmt = context.args[0].lower() if context.args else 'auto'
+    if fmt not in FORMATS:
+        await update.message.reply_text(f"❌ Неизвестный формат. Доступны: {', '.join(FORMATS)}")
+        return
+
+    # Сбрасываем актуальный прогресс в хранилище и читаем его потоково в отдельном потоке,
+    # чтобы выгрузка не блокировала обработку обновлений
+    bot.flush()
+    export_dir = tempfile.mkdtemp(prefix='quest_export_')
+    try:
+        path, count = await asyncio.to_thread(
+            export_actions, iter_store_rows(bot.store.iter_actions()), os.path.join(export_dir, 'actions'), fmt
+        )
+        with open(path, 'rb') as f:
+            await update.message.reply_document(
+                document=f,
+                filename=os.path.basename(path),
+                caption=f"📦 Выгружено действий: {count}"
+            )
+    except Exception as e:
+        logger.error(f"Ошибка при экспорте действий: {e}")
+        await update.message.reply_text(f"❌ Ошибка при экспорте: {e}")
+    finally:
+        shutil.rmtree(export_dir, ignore_errors=True)
+
+
+async def post_init(application: Application):
+    """Запускается перед началом polling: перенос старого progress.json, таймеры и фоновый прогрев"""
+    quest_bot = application.bot_data['quest_bot']
+    await quest_bot.import_legacy_progress()
+    quest_bot.start_scheduler(application)
+    quest_bot.start_warmup()
+
+
+async def post_stop(application: Application):
+    """Запускается после остановки polling (в том числе по SIGTERM): сохранение и закрытие"""
+    await application.bot_data['quest_bot'].shutdown()
+
+
+def build_application(token: str, tune_http: bool = True) -> Application:
+    """Создает приложение с экземпляром бота и всеми обработчиками.
+
+    tune_http=False - стандартный HTTP-клиент, без пулов для polling (режим одного обновления)
+    """
+    # Обновления разных игроков и групп обрабатываются параллельно (одного - по очереди, см. QuestBot.track),
+    # чтобы группа, где перебирают ответы, не задерживала остальных
+    builder = Application.builder() \
+        .token(token) \
+        .concurrent_updates(env_int('CONCURRENT_UPDATES', 32)) \
+        .post_init(post_init) \
+        .post_stop(post_stop)
+    http_stats = {}
+    if tune_http:
+        # Отдельные пулы соединений для getUpdates и для отправки
+        from telegram_http import configure as configure_http
+        http_stats = configure_http(builder)
+    application = builder.build()
 
     # Создаем экземпляр бота и сохраняем в bot_data
     quest_bot = QuestBot()
+    quest_bot.http_stats = http_stats
     application.bot_data['quest_bot'] = quest_bot
-
-    # Регистрируем обработчики
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("restart", restart))
-    application.add_handler(CommandHandler("stats", stats))
-    application.add_handler(CommandHandler("debt", debt_info))
-    application.add_handler(CommandHandler("clear_debt", clear_debt))
-    application.add_handler(CommandHandler("help", help_command))
+    track = quest_bot.track
+
+    # Регистрируем обработчики (track позволяет дождаться их при остановке)
+    application.add_handler(CommandHandler("start", track(start)))
+    application.add_handler(CommandHandler("restart", track(restart)))
+    application.add_handler(CommandHandler("stats", track(stats)))
+    application.add_handler(CommandHandler("debt", track(debt_info)))
+    application.add_handler(CommandHandler("clear_debt", track(clear_debt)))
+    application.add_handler(CommandHandler("repay", track(repay)))
+    application.add_handler(CommandHandler("debt_history", track(debt_history)))
+    application.add_handler(CommandHandler("remind", track(remind)))
+    application.add_handler(CommandHandler("leaderboard", track(leaderboard)))
+    application.add_handler(CommandHandler("help", track(help_command)))
 
     # Команды для администратора
-    application.add_handler(CommandHandler("logs", get_logs))
-    application.add_handler(CommandHandler("user_logs", get_user_logs))
+    application.add_handler(CommandHandler("logs", track(get_logs)))
+    application.add_handler(CommandHandler("user_logs", track(get_user_logs)))
+    application.add_handler(CommandHandler("wrong_answers", track(wrong_answers_command)))
+    application.add_handler(CommandHandler("debt_totals", track(debt_totals)))
+    application.add_handler(CommandHandler("attempts", track(attempts_command)))
+    application.add_handler(CommandHandler("throttle_stats", track(throttle_stats)))
+    application.add_handler(CommandHandler("metrics", track(metrics)))
+    application.add_handler(CommandHandler("broadcast", track(broadcast)))
+    application.add_handler(CommandHandler("bulk_clear_debt", track(bulk_clear_debt)))
+    application.add_handler(CommandHandler("bulk_reset", track(bulk_reset)))
+    application.add_handler(CommandHandler("bulk_status", track(bulk_status)))
+    application.add_handler(CommandHandler("bulk_cancel", track(bulk_cancel)))
+    application.add_handler(CommandHandler("export_actions", track(export_actions_command)))
+
+    # Все кнопки - через один обработчик: действие из callback_data выбирает функцию по таблице
+    router = CallbackRouter(len(QUESTIONS))
+    router.route(Action.START_QUEST, handle_start_quest)
+    router.route(Action.HINT, handle_hint)
+    router.route(Action.SOLUTION, handle_solution)
+    # "Продолжить": next - новые кнопки, continue - из старых сообщений
+    router.route(Action.NEXT, handle_continue)
+    router.route(Action.CONTINUE, handle_continue)
+    router.route(Action.LEADERBOARD_PAGE, handle_leaderboard_page)
+    application.add_handler(CallbackQueryHandler(track(router.dispatch)))
 
-    # Обработчик кнопки "Начать квест"
-    application.add_handler(CallbackQueryHandler(handle_start_quest, pattern=r"^start_quest$"))
+    # Обработчик текстовых сообщений
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, track(handle_message)))
+    return application
 
-    # Обработчик подсказок
-    application.add_handler(CallbackQueryHandler(handle_hint, pattern=r"^hint_"))
 
-    # Обработчик решений
-    application.add_handler(CallbackQueryHandler(handle_solution, pattern=r"^solution_"))
+def read_update(source: str) -> dict:
+    """Одно обновление Telegram в JSON из файла ('-' - из stdin)"""
+    if source == '-':
+        return json.load(sys.stdin)
+    with open(source, encoding='utf-8') as f:
+        return json.load(f)
 
-    # Обработчик кнопки "Продолжить" (обрабатывает как next_ так и continue_ для обратной совместимости)
-    application.add_handler(CallbackQueryHandler(handle_continue, pattern=r"^(next|continue)_"))
 
-    # Обработчик текстовых сообщений
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+def receive_update(port: int, host: str = '127.0.0.1', secret: str = '') -> dict:
+    """Принимает одно обновление POST-запросом, как webhook Telegram, и возвращает его.
+
+    Если задан secret, запрос без такого же заголовка X-Telegram-Bot-Api-Secret-Token
+    (его ставит Telegram при setWebhook с secret_token) отклоняется с 403.
+    """
+    import hmac
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    received = {}
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if secret and not hmac.compare_digest(token.encode(), secret.encode()):
+                logger.warning(f"Отклонено обновление без верного секрета от {self.client_address[0]}")
+                self.send_response(403)
+                self.end_headers()
+                return
+            try:
+                received['update'] = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                self.send_response(200)
+            except ValueError:
+                self.send_response(400)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    with HTTPServer((host, port), WebhookHandler) as server:
+        while 'update' not in received:
+            server.handle_request()
+    return received['update']
+
+
+async def process_once(application: Application, data: dict):
+    """Обрабатывает одно обновление без polling, сохраняет прогресс и завершает работу.
+
+    Таймеры и фоновые задачи в этом режиме не запускаются: сроки только
+    записываются в хранилище, а срабатывают в обычном режиме polling.
+    """
+    quest_bot: QuestBot = application.bot_data['quest_bot']
+    async with application:
+        quest_bot.application = application
+        await quest_bot.import_legacy_progress()
+        await application.process_update(Update.de_json(data, application.bot))
+        await quest_bot.shutdown()
+
+
+def main():
+    """Запуск бота"""
+    parser = argparse.ArgumentParser(description="Квест-бот 'В ожидании тепла'")
+    parser.add_argument('--once', metavar='FILE', nargs='?', const='-',
+                        help="обработать одно обновление (JSON из файла, без значения - из stdin) и выйти")
+    parser.add_argument('--once-port', metavar='PORT', type=int,
+                        help="принять одно обновление POST-запросом на этот порт, обработать и выйти")
+    parser.add_argument('--once-host', metavar='HOST', default='127.0.0.1',
+                        help="адрес для --once-port (по умолчанию только локальный; "
+                             "на внешнем адресе нужен WEBHOOK_SECRET_TOKEN)")
+    args = parser.parse_args()
+
+    # Токен вашего бота
+    load_dotenv()
+    once = args.once is not None or args.once_port
+    secret = os.getenv('WEBHOOK_SECRET_TOKEN', '')
+    if args.once_port and not secret and args.once_host not in ('127.0.0.1', 'localhost', '::1'):
+        parser.error("--once-host на внешнем адресе требует WEBHOOK_SECRET_TOKEN в окружении")
+    application = build_application(os.getenv("BOT_TOKEN"), tune_http=not once)
+
+    if once:
+        if args.once_port:
+            data = receive_update(args.once_port, args.once_host, secret)
+        else:
+            data = read_update(args.once)
+        asyncio.run(process_once(application, data))
+        return
 
     # Запуск бота
+    quest_bot = application.bot_data['quest_bot']
     logger.info("🧡 Квест-бот 'В ожидании тепла' запущен...")
     logger.info(f"📊 Логи действий будут сохраняться в user_actions.log")
     logger.info(f"📨 Результаты будут отправляться пользователю {quest_bot.admin_user_id}")
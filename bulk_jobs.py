@@ -0,0 +1,193 @@
+"""Массовые операции администратора: рассылка, очистка долгов, сброс прогресса.
+
+Задача обходит сегмент пользователей (все, играющие, прошедшие, неактивные
+дольше N дней) пачками по возрастанию user_id, начиная с отрицательных id
+групп. Изменения пачки и состояние задачи с курсором (последний
+обработанный user_id) записываются одной транзакцией, поэтому после
+перезапуска бота задача продолжается с места остановки и не применяет
+пачку повторно. Одновременно выполняется одна задача.
+Если пачка падает с ошибкой, задача помечается failed (с текстом ошибки и
+курсором) и администратору уходит итоговое сообщение.
+
+Рассылка идет не быстрее заданного числа сообщений в секунду, чтобы не
+упираться в лимиты Telegram и не задерживать ответы игрокам.
+"""
+import asyncio
+import logging
+import time
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from storage import SEGMENTS, ProgressChanges, ProgressStore
+
+logger = logging.getLogger(__name__)
+
+META_KEY = 'bulk_job'
+
+KINDS = {
+    'broadcast': 'рассылка',
+    'clear_debt': 'очистка долгов',
+    'reset': 'сброс прогресса',
+}
+SEGMENT_NAMES = {
+    'all': 'все',
+    'active': 'играющие',
+    'finished': 'прошедшие квест',
+    'idle': 'неактивные',
+}
+
+
+@dataclass
+class BulkJob:
+    kind: str
+    segment: str
+    idle_days: int = 0
+    idle_before: float = 0.0  # граница неактивности фиксируется при запуске задачи
+    text: str = ''  # текст рассылки
+    admin_chat_id: int = 0
+    status_message_id: Optional[int] = None  # сообщение администратору, которое обновляется по ходу задачи
+    cursor: Optional[int] = None  # последний обработанный user_id, None - задача еще не начата
+    total: int = 0
+    processed: int = 0
+    failed: int = 0
+    started_at: float = 0.0
+    status: str = 'running'  # running, done, cancelled, failed
+    error: str = ''  # почему задача остановлена (status='failed')
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'BulkJob':
+        return cls(**data)
+
+    def describe(self) -> str:
+        segment = SEGMENT_NAMES[self.segment]
+        if self.segment == 'idle':
+            segment += f" дольше {self.idle_days} дн."
+        statuses = {'running': "⏳ выполняется", 'done': "✅ завершена", 'cancelled': "⛔ отменена",
+                    'failed': "❌ остановлена из-за ошибки"}
+        elapsed = int(time.time() - self.started_at)
+        text = (
+            f"📦 Задача: {KINDS[self.kind]}, сегмент: {segment}\n"
+            f"Статус: {statuses[self.status]}\n"
+            f"Обработано: {self.processed} из {self.total}, ошибок: {self.failed}\n"
+            f"Прошло: {elapsed} с"
+        )
+        if self.error:
+            text += f"\nОшибка: {self.error}"
+        return text
+
+
+def parse_segment(text: str) -> Optional[Tuple[str, int]]:
+    """'all', 'active', 'finished' или 'idle:N' (N дней) -> (сегмент, дни)"""
+    name, _, days = text.lower().partition(':')
+    if name not in SEGMENTS:
+        return None
+    if name == 'idle':
+        return (name, int(days)) if days.isdigit() and int(days) > 0 else None
+    return (name, 0) if not days else None
+
+
+# Обработчик пачки: (задача, user_id) -> (изменения прогресса, сколько не удалось)
+BatchHandler = Callable[[BulkJob, List[int]], Awaitable[Tuple[List[ProgressChanges], int]]]
+ReportHandler = Callable[[BulkJob, bool], Awaitable[None]]
+
+
+class BulkJobRunner:
+    """Выполняет одну массовую задачу в фоне, сохраняя курсор после каждой пачки"""
+
+    def __init__(self, store: ProgressStore, process: BatchHandler, report: ReportHandler,
+                 first_ending: int, rate: float = 20.0, batch_size: int = 500, report_interval: float = 10.0):
+        self.store = store
+        self.process = process
+        self.report = report
+        self.first_ending = first_ending  # первый номер концовки графа: с него квест пройден
+        self.rate = rate  # сообщений рассылки в секунду
+        self.batch_size = batch_size
+        self.report_interval = report_interval
+        self.job: Optional[BulkJob] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def load(self):
+        data = self.store.get_meta(META_KEY)
+        self.job = BulkJob.from_dict(data) if data else None
+
+    @property
+    def running(self) -> bool:
+        return self.job is not None and self.job.status == 'running'
+
+    def submit(self, job: BulkJob):
+        """Запускает новую задачу (предыдущая должна быть завершена)"""
+        job.started_at = time.time()
+        if job.segment == 'idle':
+            job.idle_before = job.started_at - job.idle_days * 24 * 60 * 60
+        job.total = self.store.count_users(job.segment, self.first_ending, job.idle_before)
+        self.job = job
+        self.store.set_meta(META_KEY, job.to_dict())
+        self.start()
+
+    def start(self):
+        """Запускает (или продолжает после перезапуска) текущую задачу"""
+        if self.running and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.run())
+
+    async def cancel(self):
+        if not self.running:
+            return
+        await self.stop()
+        self.job.status = 'cancelled'
+        self.store.set_meta(META_KEY, self.job.to_dict())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def _batch_size(self, job: BulkJob) -> int:
+        # Пачка рассылки - примерно секунда отправки при заданной частоте
+        return max(1, int(self.rate)) if job.kind == 'broadcast' else self.batch_size
+
+    async def run(self):
+        job = self.job
+        last_report = time.monotonic()
+        try:
+            while True:
+                user_ids = self.store.select_users(job.segment, job.cursor, self._batch_size(job),
+                                                   self.first_ending, job.idle_before)
+                if not user_ids:
+                    break
+
+                started = time.monotonic()
+                changes, failed = await self.process(job, user_ids)
+                job.cursor = user_ids[-1]
+                job.processed += len(user_ids)
+                job.failed += failed
+                self.store.save_changes(changes, meta={META_KEY: job.to_dict()})
+
+                if time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    await self.report(job, False)
+                if job.kind == 'broadcast':
+                    await asyncio.sleep(max(0.0, len(user_ids) / self.rate - (time.monotonic() - started)))
+                else:
+                    await asyncio.sleep(0)  # не занимаем цикл событий целиком
+        except Exception as e:
+            # Задача не должна остаться 'running': иначе новые не запустить, а после перезапуска
+            # бот снова упадет на той же пачке. Курсор - после последней удачной пачки
+            logger.error(f"Ошибка массовой задачи {job.kind}, остановлена на user_id {job.cursor}: {e}")
+            job.status = 'failed'
+            job.error = f"{type(e).__name__}: {e}"[:200]
+        else:
+            job.status = 'done'
+            logger.info(f"Массовая задача {job.kind} завершена: {job.processed}, ошибок {job.failed}")
+
+        try:
+            self.store.set_meta(META_KEY, job.to_dict())
+        except Exception as e:
+            logger.error(f"Не удалось сохранить состояние массовой задачи: {e}")
+        await self.report(job, True)
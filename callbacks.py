@@ -0,0 +1,136 @@
+"""Компактный формат callback_data и маршрутизация нажатий на кнопки.
+
+callback_data кнопки - это '.' и base64url (без '=') семи байт:
+    версия, действие, квест, вопрос, аргумент (2 байта), nonce
+Это 11 символов вместо строк вида "solution_10", и все поля разбираются
+одним struct.unpack. Nonce - состояние клавиатуры вопроса на момент
+отрисовки: кнопка из устаревшего сообщения отличается от актуальной.
+
+За этими байтами может идти хвост extra - данные, которые не влезают в
+поля (например, курсор листания таблицы лидеров). Его формат знает тот, кто
+кнопку отрисовал; callback_data Telegram ограничен 64 байтами.
+
+Кнопки старого формата ("hint_3_1", "next_2" и т.д.) в уже отправленных
+сообщениях по-прежнему разбираются, но без nonce.
+"""
+import base64
+import binascii
+import logging
+import struct
+from enum import IntEnum
+from typing import Awaitable, Callable, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_VERSION = 1
+PREFIX = '.'
+NO_NONCE = 0xFF
+
+# Номер квеста в callback_data (пока квест один)
+MAIN_QUEST = 0
+
+_PACKED = struct.Struct('>BBBBHB')
+
+
+class Action(IntEnum):
+    START_QUEST = 1
+    HINT = 2
+    SOLUTION = 3
+    NEXT = 4
+    CONTINUE = 5
+    LEADERBOARD_PAGE = 6
+
+
+class Callback(NamedTuple):
+    action: Action
+    question_id: int = 0
+    arg: int = 0
+    nonce: Optional[int] = None
+    quest: int = MAIN_QUEST
+    extra: bytes = b''
+
+
+def encode(callback: Callback) -> str:
+    """Упаковывает нажатие в callback_data"""
+    packed = _PACKED.pack(
+        CALLBACK_VERSION, callback.action, callback.quest, callback.question_id, callback.arg,
+        NO_NONCE if callback.nonce is None else callback.nonce
+    ) + callback.extra
+    return PREFIX + base64.urlsafe_b64encode(packed).rstrip(b'=').decode('ascii')
+
+
+def decode(data: str) -> Optional[Callback]:
+    """Разбирает callback_data. None - данные битые или от несовместимой версии"""
+    if not data.startswith(PREFIX):
+        return _decode_legacy(data)
+    try:
+        raw = data[len(PREFIX):]
+        packed = base64.urlsafe_b64decode(raw + '=' * (-len(raw) % 4))
+        version, action, quest, question_id, arg, nonce = _PACKED.unpack(packed[:_PACKED.size])
+        if version != CALLBACK_VERSION:
+            return None
+        return Callback(Action(action), question_id, arg, None if nonce == NO_NONCE else nonce, quest,
+                        packed[_PACKED.size:])
+    except (binascii.Error, struct.error, ValueError):
+        return None
+
+
+_LEGACY_ACTIONS = {
+    'hint': Action.HINT,
+    'solution': Action.SOLUTION,
+    'next': Action.NEXT,
+    'continue': Action.CONTINUE,
+    'lb': Action.LEADERBOARD_PAGE,
+}
+
+
+def _decode_legacy(data: str) -> Optional[Callback]:
+    """Кнопки, отправленные до перехода на компактный формат"""
+    if data == 'start_quest':
+        return Callback(Action.START_QUEST)
+    name, _, rest = data.partition('_')
+    action = _LEGACY_ACTIONS.get(name)
+    try:
+        numbers = [int(part) for part in rest.split('_')]
+    except ValueError:
+        return None
+    if action is None:
+        return None
+    if action == Action.HINT and len(numbers) == 2:
+        return Callback(action, numbers[0], numbers[1])
+    if action == Action.LEADERBOARD_PAGE and len(numbers) == 1:
+        return Callback(action, arg=numbers[0])
+    if action in (Action.SOLUTION, Action.NEXT, Action.CONTINUE) and len(numbers) == 1:
+        return Callback(action, numbers[0])
+    return None
+
+
+CallbackHandler = Callable[..., Awaitable[None]]
+
+
+class CallbackRouter:
+    """Один обработчик на все кнопки: действие из callback_data - индекс в таблице"""
+
+    def __init__(self, question_count: int):
+        self.question_count = question_count
+        self.handlers: List[Optional[CallbackHandler]] = [None] * (max(Action) + 1)
+        self.rejected = 0
+
+    def route(self, action: Action, handler: CallbackHandler):
+        self.handlers[action] = handler
+
+    async def dispatch(self, update, context):
+        query = update.callback_query
+        callback = decode(query.data or '')
+
+        # Битые, чужие и несуществующие кнопки отклоняем, не трогая прогресс
+        handler = self.handlers[callback.action] if callback else None
+        if (handler is None or callback.quest != MAIN_QUEST
+                or callback.question_id > self.question_count
+                or (callback.action in (Action.HINT, Action.SOLUTION) and callback.question_id == 0)):
+            self.rejected += 1
+            logger.warning(f"Отклонено нажатие с callback_data={query.data!r}")
+            await query.answer("Эта кнопка устарела 🙈")
+            return
+
+        await handler(update, context, callback)
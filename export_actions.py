@@ -0,0 +1,190 @@
+"""Экспорт действий пользователей в колоночный файл для офлайн-анализа.
+
+Поддерживаются Parquet и Arrow IPC (нужен pyarrow) и CSV как запасной
+вариант. Записи читаются и пишутся пачками, поэтому память не растет
+с числом событий.
+
+Источником может быть хранилище бота (progress.db) или старый progress.json.
+Текст действия (details) в журнале не хранится и выводится из кода и данных.
+
+Пример запуска:
+    python export_actions.py --source progress.db --output actions.parquet
+"""
+import argparse
+import csv
+import logging
+import os
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from actions import ActionRecord, ms_to_datetime
+from progress_stream import iter_progress_records
+
+try:
+    import pyarrow as pa
+except ImportError:  # pyarrow необязателен, без него пишем CSV
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('user_id', 'timestamp', 'action', 'question_id', 'hint_num', 'user_answer', 'details')
+FORMATS = ('auto', 'parquet', 'arrow', 'csv')
+EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow', 'csv': '.csv'}
+DEFAULT_BATCH_SIZE = 10_000
+
+ActionRow = Tuple[int, datetime, str, Optional[int], Optional[int], Optional[str], str]
+
+
+def action_row(user_id: int, action: ActionRecord) -> ActionRow:
+    """Строка экспорта для одного действия пользователя"""
+    data = action.data
+    question_id = data.get('question_id')
+    hint_num = data.get('hint_num')
+    return (
+        int(user_id),
+        ms_to_datetime(action.ts),
+        action.name,
+        int(question_id) if question_id is not None else None,
+        int(hint_num) if hint_num is not None else None,
+        data.get('user_answer'),
+        action.details,
+    )
+
+
+def iter_action_rows(records: Iterable[dict]) -> Iterator[ActionRow]:
+    """Разворачивает записи прогресса старого формата (progress.json) в строки действий"""
+    for record in records:
+        for action in record.get('action_log', {}).get('actions', []):
+            yield action_row(record['user_id'], ActionRecord.from_legacy(action))
+
+
+def _batched(rows: Iterable[ActionRow], batch_size: int) -> Iterator[List[ActionRow]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _arrow_schema():
+    return pa.schema([
+        ('user_id', pa.int64()),
+        ('timestamp', pa.timestamp('us', tz='UTC')),
+        ('action', pa.string()),
+        ('question_id', pa.int32()),
+        ('hint_num', pa.int8()),
+        ('user_answer', pa.string()),
+        ('details', pa.string()),
+    ])
+
+
+def _write_arrow(batches: Iterable[List[ActionRow]], output: str, fmt: str) -> int:
+    schema = _arrow_schema()
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(output, schema)
+    else:
+        import pyarrow.ipc as ipc
+        writer = ipc.new_file(output, schema)
+
+    count = 0
+    try:
+        for batch in batches:
+            columns = list(zip(*batch))
+            table = pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                schema=schema
+            )
+            writer.write_table(table)
+            count += len(batch)
+    finally:
+        writer.close()
+    return count
+
+
+def _write_csv(batches: Iterable[List[ActionRow]], output: str) -> int:
+    count = 0
+    with open(output, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        for batch in batches:
+            writer.writerows(
+                (user_id, timestamp.isoformat(), action,
+                 '' if question_id is None else question_id,
+                 '' if hint_num is None else hint_num,
+                 '' if user_answer is None else user_answer, details)
+                for user_id, timestamp, action, question_id, hint_num, user_answer, details in batch
+            )
+            count += len(batch)
+    return count
+
+
+def resolve_format(fmt: str, output: str) -> Tuple[str, str]:
+    """Выбирает итоговый формат и путь с учетом наличия pyarrow"""
+    if fmt == 'auto':
+        fmt = 'parquet' if pa is not None else 'csv'
+    elif fmt in ('parquet', 'arrow') and pa is None:
+        logger.warning(f"pyarrow не установлен, вместо {fmt} будет записан CSV")
+        fmt = 'csv'
+
+    root, ext = os.path.splitext(output)
+    if ext != EXTENSIONS[fmt]:
+        output = root + EXTENSIONS[fmt]
+    return fmt, output
+
+
+def export_actions(rows: Iterable[ActionRow], output: str, fmt: str = 'auto',
+                   batch_size: int = DEFAULT_BATCH_SIZE) -> Tuple[str, int]:
+    """Экспортирует строки действий. Возвращает (путь, число строк)"""
+    fmt, output = resolve_format(fmt, output)
+    batches = _batched(rows, batch_size)
+
+    if fmt == 'csv':
+        count = _write_csv(batches, output)
+    else:
+        count = _write_arrow(batches, output, fmt)
+
+    logger.info(f"Экспортировано {count} действий в {output}")
+    return output, count
+
+
+def iter_store_rows(actions: Iterable[Tuple[int, ActionRecord]]) -> Iterator[ActionRow]:
+    """Строки экспорта из журнала событий хранилища (ProgressStore.iter_actions)"""
+    for user_id, action in actions:
+        yield action_row(user_id, action)
+
+
+def iter_source_rows(source: str) -> Iterator[ActionRow]:
+    """Строки действий из хранилища SQLite или из JSON-файла"""
+    if source.endswith('.json'):
+        return iter_action_rows(iter_progress_records(source))
+
+    from storage import ProgressStore
+    return iter_store_rows(ProgressStore(source).iter_actions())
+
+
+def export_progress_file(source: str, output: str, fmt: str = 'auto',
+                         batch_size: int = DEFAULT_BATCH_SIZE) -> Tuple[str, int]:
+    """Экспортирует действия из хранилища или файла прогресса, читая его потоково"""
+    return export_actions(iter_source_rows(source), output, fmt, batch_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Экспорт действий пользователей квеста")
+    parser.add_argument('--source', default='progress.db', help="хранилище (.db) или файл прогресса (.json)")
+    parser.add_argument('--output', default='actions.parquet', help="куда записать результат")
+    parser.add_argument('--format', default='auto', choices=FORMATS, help="формат файла")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="сколько строк писать за раз")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    path, count = export_progress_file(args.source, args.output, args.format, args.batch_size)
+    print(f"{count} действий -> {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Безопасное форматирование сообщений для Telegram.
+
+Все сообщения бота отправляются с parse_mode='HTML'. Шаблоны пишутся
+вручную и считаются доверенными, а любые подставляемые значения (имена,
+ответы пользователей, логи) экранируются за один проход при подстановке,
+поэтому Telegram никогда не отклоняет сообщение из-за разметки.
+"""
+import re
+import string
+from typing import Callable
+
+# Разметка старого Markdown в доверенных текстах каталога: `код` и *жирный*
+_LEGACY_MARKDOWN = re.compile(r'`([^`]*)`|\*([^*]*)\*')
+
+
+def escape_html(text) -> str:
+    """Экранирует текст для parse_mode='HTML' (Telegram требует только &, < и >).
+
+    Почти все подставляемые строки (имена, ответы, числа) спецсимволов не
+    содержат: для них это три поиска символа без копирования, и строка
+    возвращается как есть. Замена делается только для найденных символов.
+    str.translate и регулярное выражение здесь медленнее (см. bench.py escaping).
+    """
+    text = str(text)
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+class Markup(str):
+    """Текст, уже готовый для отправки: при подстановке не экранируется повторно"""
+    __slots__ = ()
+
+
+class _EscapingFormatter(string.Formatter):
+    """str.format, который экранирует каждое подставляемое значение"""
+
+    def __init__(self, escape: Callable[[str], str]):
+        self.escape = escape
+
+    def format_field(self, value, format_spec):
+        formatted = format(value, format_spec)
+        if isinstance(value, Markup):
+            return formatted
+        return self.escape(formatted)
+
+
+_HTML_FORMATTER = _EscapingFormatter(escape_html)
+
+
+def html(template: str, *args, **kwargs) -> Markup:
+    """Подставляет значения в доверенный HTML-шаблон, экранируя их.
+
+    Пример: html("Привет, <b>{name}</b>!", name=user.first_name)
+    \"{{\" и \"}}\" в шаблоне дают литеральные фигурные скобки, как в str.format.
+    """
+    return Markup(_HTML_FORMATTER.vformat(template, args, kwargs))
+
+
+def legacy_markdown_to_html(text: str) -> Markup:
+    """Переводит доверенный текст со старой разметкой Markdown (*жирный*, `код`) в HTML"""
+    result = []
+    position = 0
+    for match in _LEGACY_MARKDOWN.finditer(text):
+        result.append(escape_html(text[position:match.start()]))
+        code_text, bold_text = match.groups()
+        if code_text is not None:
+            result.append(f"<code>{escape_html(code_text)}</code>")
+        else:
+            result.append(f"<b>{escape_html(bold_text)}</b>")
+        position = match.end()
+    result.append(escape_html(text[position:]))
+    return Markup(''.join(result))
+
+
+def strip_legacy_markdown(text: str) -> str:
+    """Убирает старую разметку Markdown, оставляя только текст"""
+    return _LEGACY_MARKDOWN.sub(lambda match: match.group(1) or match.group(2) or '', text)
@@ -0,0 +1,74 @@
+"""Перенос старого progress.json в хранилище бота (SQLite).
+
+Файл читается потоково по одной записи и пишется пачками, поэтому память
+не зависит от размера файла. Битые записи откладываются в карантин, а не
+прерывают перенос. По ходу печатается скорость переноса.
+
+Пример запуска:
+    python migrate_progress.py --source progress.json --target progress.db
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+from storage import ProgressStore
+
+try:
+    import resource
+except ImportError:  # нет на Windows - тогда пиковую память не показываем
+    resource = None
+
+
+def _peak_memory_mb() -> float:
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS - байты
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос progress.json в хранилище квест-бота")
+    parser.add_argument('--source', default='progress.json', help="файл прогресса старого формата")
+    parser.add_argument('--target', default='progress.db', help="хранилище, куда переносить")
+    parser.add_argument('--batch-size', type=int, default=500, help="сколько записей писать одной транзакцией")
+    parser.add_argument('--quarantine', help="куда откладывать битые записи (по умолчанию <source>.quarantine.jsonl)")
+    parser.add_argument('--report-every', type=float, default=5.0, help="как часто печатать скорость, секунд")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if not os.path.exists(args.source):
+        sys.exit(f"Файл {args.source} не найден")
+
+    store = ProgressStore(args.target)
+    if store.count():
+        store.close()
+        sys.exit(f"В {args.target} уже есть прогресс - перенос делается только в пустое хранилище")
+
+    size_mb = os.path.getsize(args.source) / (1024 * 1024)
+    started = time.monotonic()
+    last_report = started
+
+    def report(imported: int, quarantined: int):
+        nonlocal last_report
+        now = time.monotonic()
+        if now - last_report >= args.report_every:
+            last_report = now
+            print(f"  {imported} записей, {imported / (now - started):.0f} записей/с, "
+                  f"в карантине {quarantined}, пик памяти {_peak_memory_mb():.0f} МБ", flush=True)
+
+    try:
+        imported = store.import_json(args.source, args.batch_size, args.quarantine, on_batch=report)
+    finally:
+        store.close()
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    print(f"Перенесено {imported} записей ({size_mb:.1f} МБ) за {elapsed:.1f} с: "
+          f"{imported / elapsed:.0f} записей/с, {size_mb / elapsed:.1f} МБ/с, "
+          f"пик памяти {_peak_memory_mb():.0f} МБ")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""Потоковое чтение progress.json по одной записи пользователя.
+
+Файл прогресса - это один большой JSON-объект вида {user_id: запись}.
+Вместо json.load() всего файла мы читаем его кусками и отдаем записи
+по одной, так что в памяти одновременно находится только одна запись.
+
+Записи, которые не удалось разобрать, не останавливают чтение остальных:
+их исходный текст откладывается в файл карантина (JSON Lines).
+"""
+import json
+import re
+from typing import Iterator, Optional, TextIO, Tuple
+
+# Символы, которые влияют на вложенность вне строки
+_STRUCTURE_TOKEN = re.compile(r'[{}\[\]"]')
+# Символы, которые важны внутри строки
+_STRING_TOKEN = re.compile(r'["\\]')
+# Конец скалярного значения (число, true/false/null)
+_SCALAR_END = re.compile(r'[,}\]\s]')
+
+_WHITESPACE = ' \t\n\r'
+
+
+class _JsonStream:
+    """Буфер поверх файла, который умеет выделять очередное JSON-значение"""
+
+    def __init__(self, f: TextIO, chunk_size: int):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read_chunk(self) -> str:
+        if self.eof:
+            return ''
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        return chunk
+
+    def _refill(self) -> bool:
+        """Дочитать данные, отбросив уже обработанную часть буфера"""
+        chunk = self._read_chunk()
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _extend(self) -> bool:
+        """Дочитать данные, сохранив буфер целиком (внутри значения)"""
+        chunk = self._read_chunk()
+        if not chunk:
+            return False
+        self.buf += chunk
+        return True
+
+    def peek(self) -> str:
+        """Следующий значимый символ (без пробелов) или '' в конце файла"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._refill():
+                return ''
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Ожидался символ {char!r}, получен {found!r}")
+        self.pos += 1
+
+    def read_value(self) -> str:
+        """Возвращает исходный текст следующего JSON-значения"""
+        first = self.peek()
+        if not first:
+            raise ValueError("Неожиданный конец файла")
+
+        start = self.pos
+        if first == '"':
+            end = self._scan(start, depth=0, in_string=True, offset=1)
+        elif first in '{[':
+            end = self._scan(start, depth=0, in_string=False, offset=0)
+        else:
+            end = self._scan_scalar(start)
+
+        self.pos = end
+        return self.buf[start:end]
+
+    def _scan(self, start: int, depth: int, in_string: bool, offset: int) -> int:
+        i = start + offset
+        while True:
+            pattern = _STRING_TOKEN if in_string else _STRUCTURE_TOKEN
+            match = pattern.search(self.buf, i)
+            if not match:
+                i = len(self.buf)
+                if not self._extend():
+                    raise ValueError("Неожиданный конец файла внутри значения")
+                continue
+
+            char = match.group()
+            i = match.end()
+            if in_string:
+                if char == '\\':
+                    # Пропускаем экранированный символ (он может быть в следующем куске)
+                    if i >= len(self.buf) and not self._extend():
+                        raise ValueError("Неожиданный конец файла внутри строки")
+                    i += 1
+                    continue
+                in_string = False
+                if depth == 0:
+                    return i
+            elif char == '"':
+                in_string = True
+            elif char in '{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return i
+
+    def _scan_scalar(self, start: int) -> int:
+        while True:
+            match = _SCALAR_END.search(self.buf, start)
+            if match:
+                return match.start()
+            if not self._extend():
+                return len(self.buf)
+
+
+def iter_raw_records(f: TextIO, chunk_size: int = 1 << 16) -> Iterator[Tuple[str, str]]:
+    """Итерирует пары (ключ, исходный JSON записи) верхнего уровня объекта"""
+    stream = _JsonStream(f, chunk_size)
+    if not stream.peek():
+        return
+
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+
+    while True:
+        key = json.loads(stream.read_value())
+        stream.expect(':')
+        yield key, stream.read_value()
+
+        separator = stream.peek()
+        stream.pos += 1
+        if separator == '}':
+            return
+        if separator != ',':
+            raise ValueError(f"Ожидалась ',' или '}}', получен {separator!r}")
+
+
+def iter_raw_progress(path: str, chunk_size: int = 1 << 16) -> Iterator[Tuple[str, str]]:
+    """Итерирует пары (ключ, исходный JSON записи) из файла прогресса"""
+    with open(path, 'r', encoding='utf-8') as f:
+        yield from iter_raw_records(f, chunk_size)
+
+
+class Quarantine:
+    """Файл для записей, которые не удалось разобрать или перенести.
+
+    Создается только при первой плохой записи; каждая строка - JSON с ключом
+    записи, текстом ошибки и исходным текстом записи.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        self.f: Optional[TextIO] = None
+
+    def add(self, key: str, raw: str, error: Exception):
+        if self.f is None:
+            self.f = open(self.path, 'a', encoding='utf-8')
+        self.f.write(json.dumps({'key': key, 'error': repr(error), 'raw': raw}, ensure_ascii=False) + '\n')
+        self.count += 1
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def iter_progress_records(path: str, chunk_size: int = 1 << 16) -> Iterator[dict]:
+    """Итерирует записи прогресса пользователей из файла по одной"""
+    for _, raw in iter_raw_progress(path, chunk_size):
+        yield json.loads(raw)
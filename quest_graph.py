@@ -0,0 +1,205 @@
+"""Граф квеста: ветвления, побочные загадки, условия открытия и несколько концовок.
+
+Квест описывается переходами между шагами. Шаг - это номер загадки, а
+концовки получают номера после последней загадки: так прогресс с
+current_question больше номера последней загадки по-прежнему означает,
+что квест пройден.
+
+Переход выбирается по исходу загадки - тем же битам, что у состояния ее
+клавиатуры (взяты ли подсказки 1 и 2, показан ли ответ), - и по открытым
+шагам игрока. Открытые шаги и пройденные шаги хранятся битовыми масками:
+бит i - шаг i. Шаг открывается, когда игрок на него переходит, а также
+переходом с unlocks (например, побочная загадка открывается за решение
+без подсказок, а заходят в нее позже).
+
+При загрузке граф компилируется в таблицу: для каждого шага и каждого из
+восьми исходов заранее вычислен список подходящих переходов в порядке
+объявления. Выбор следующего шага - обращение по индексу и проверка маски
+у первого кандидата.
+
+Исходы всех загадок игрока тоже хранятся одним числом: по OUTCOME_WIDTH бит
+на шаг (биты шага i начинаются с i * OUTCOME_WIDTH). Сколько всего взято
+подсказок или показано решений - подсчет бит под маской графа.
+"""
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# Биты исхода загадки (они же биты состояния клавиатуры вопроса)
+HINT1_USED = 1
+HINT2_USED = 2
+SOLUTION_SHOWN = 4
+OUTCOMES = 8
+OUTCOME_WIDTH = 3
+
+# Номер подсказки -> бит исхода
+HINT_BITS = {1: HINT1_USED, 2: HINT2_USED}
+
+Condition = Callable[[int], bool]
+
+
+def always(outcome: int) -> bool:
+    return True
+
+
+def without_hints(outcome: int) -> bool:
+    return outcome == 0
+
+
+def with_hints(outcome: int) -> bool:
+    return bool(outcome & (HINT1_USED | HINT2_USED))
+
+
+def with_solution(outcome: int) -> bool:
+    return bool(outcome & SOLUTION_SHOWN)
+
+
+def without_solution(outcome: int) -> bool:
+    return not outcome & SOLUTION_SHOWN
+
+
+@dataclass(frozen=True)
+class Transition:
+    source: int
+    target: int
+    when: Condition = always  # условие на исход загадки source
+    requires: Tuple[int, ...] = ()  # шаги, которые должны быть открыты
+    unlocks: Tuple[int, ...] = ()  # шаги, которые открывает этот переход
+
+
+def bit(step: int) -> int:
+    return 1 << step
+
+
+def mask(steps: Iterable[int]) -> int:
+    result = 0
+    for step in steps:
+        result |= 1 << step
+    return result
+
+
+def count_bits(value: int) -> int:
+    return bin(value).count('1')
+
+
+def outcome_of(outcomes: int, step: int) -> int:
+    """Исход шага step из упакованных исходов всех шагов"""
+    return (outcomes >> (step * OUTCOME_WIDTH)) & (OUTCOMES - 1)
+
+
+def with_outcome(outcomes: int, step: int, flags: int) -> int:
+    """Упакованные исходы с добавленными битами flags у шага step"""
+    return outcomes | (flags << (step * OUTCOME_WIDTH))
+
+
+# Кандидат перехода в таблице: (маска требуемых шагов, цель, маска открываемых шагов)
+Candidate = Tuple[int, int, int]
+
+
+class QuestGraph:
+    """Скомпилированный граф: таблица переходов по (шаг, исход) и концовки"""
+
+    def __init__(self, start: int, steps: List[int], endings: Dict[int, str],
+                 table: Dict[int, List[Tuple[Candidate, ...]]]):
+        self.start = start
+        self.steps = steps
+        self.endings = endings  # номер концовки -> название
+        self.table = table  # шаг -> кандидаты для каждого из 8 исходов
+        self.step_mask = mask(steps)
+        # Концовки нумеруются после загадок: номер от first_ending и выше - квест пройден
+        self.first_ending = min(endings)
+        # Бит исхода -> маска этого бита у всех шагов в упакованных исходах
+        self.outcome_masks = {
+            flag: sum(flag << (step * OUTCOME_WIDTH) for step in steps)
+            for flag in (HINT1_USED, HINT2_USED, SOLUTION_SHOWN)
+        }
+
+    @classmethod
+    def compile(cls, steps: Iterable[int], transitions: Iterable[Transition],
+                endings: Dict[int, str], start: int) -> 'QuestGraph':
+        """Проверяет граф и строит таблицу переходов. Ошибки описания - ValueError"""
+        steps = list(steps)
+        step_set = set(steps)
+        if not endings:
+            raise ValueError("У квеста нет концовок")
+        if set(endings) & step_set:
+            raise ValueError("Номера концовок совпадают с номерами загадок")
+        if min(endings) <= max(steps):
+            raise ValueError("Концовки должны иметь номера больше номера последней загадки")
+        if start not in step_set:
+            raise ValueError(f"Начальный шаг {start} не является загадкой")
+
+        by_source: Dict[int, List[Transition]] = {}
+        for transition in transitions:
+            for step in (transition.target, *transition.requires, *transition.unlocks):
+                if step not in step_set and step not in endings:
+                    raise ValueError(f"Переход {transition.source}->{transition.target}: неизвестный шаг {step}")
+            if transition.source not in step_set:
+                raise ValueError(f"Переход из неизвестной загадки {transition.source}")
+            by_source.setdefault(transition.source, []).append(transition)
+
+        table = {}
+        for step in steps:
+            outgoing = by_source.get(step, [])
+            row = []
+            for outcome in range(OUTCOMES):
+                candidates = tuple(
+                    (mask(transition.requires), transition.target, mask(transition.unlocks))
+                    for transition in outgoing if transition.when(outcome)
+                )
+                # Последний подходящий переход должен быть безусловным, иначе игрок может застрять
+                if not candidates or candidates[-1][0]:
+                    raise ValueError(f"Из загадки {step} нет безусловного перехода для исхода {outcome}")
+                row.append(candidates)
+            table[step] = row
+
+        graph = cls(start, steps, dict(endings), table)
+        graph._check_reachable()
+        return graph
+
+    @classmethod
+    def linear(cls, steps: Iterable[int], ending: str) -> 'QuestGraph':
+        """Загадки по порядку и одна концовка"""
+        steps = list(steps)
+        ending_id = max(steps) + 1
+        transitions = [Transition(source, target) for source, target in zip(steps, steps[1:] + [ending_id])]
+        return cls.compile(steps, transitions, {ending_id: ending}, steps[0])
+
+    def _check_reachable(self):
+        """Каждая загадка и хотя бы одна концовка должны быть достижимы из начала"""
+        seen = {self.start}
+        frontier = [self.start]
+        while frontier:
+            step = frontier.pop()
+            for candidates in self.table.get(step, ()):
+                for _, target, _ in candidates:
+                    if target not in seen:
+                        seen.add(target)
+                        frontier.append(target)
+        unreachable = [step for step in self.steps if step not in seen]
+        if unreachable:
+            raise ValueError(f"Загадки недостижимы из начала: {unreachable}")
+        if not seen & set(self.endings):
+            raise ValueError("Ни одна концовка не достижима")
+
+    def next_step(self, step: int, outcome: int, unlocked: int) -> Tuple[int, int]:
+        """Следующий шаг и маска открываемых шагов после загадки step с исходом outcome"""
+        candidates = self.table[step][outcome]
+        for required, target, unlocks in candidates:
+            if required & unlocked == required:
+                return target, unlocks
+        # Сюда не попасть: последний кандидат безусловный (проверено при компиляции)
+        return candidates[-1][1], candidates[-1][2]
+
+    def is_ending(self, step: int) -> bool:
+        return step in self.endings
+
+    def is_step(self, step: int) -> bool:
+        return step in self.table
+
+    def is_finished(self, step: int) -> bool:
+        """Шаг за последней загадкой (концовка) - квест пройден"""
+        return step >= self.first_ending
+
+    def count_outcomes(self, outcomes: int, flags: int) -> int:
+        """Сколько бит исхода из flags выставлено у всех шагов (взятые подсказки, показанные решения)"""
+        return sum(count_bits(outcomes & self.outcome_masks[flag]) for flag in self.outcome_masks if flag & flags)
@@ -0,0 +1,124 @@
+"""Планировщик таймеров пользователей (лимит времени квеста, напоминания).
+
+Все таймеры лежат в одной куче по сроку срабатывания и обслуживаются одной
+задачей asyncio, а не отдельной задачей на пользователя. Перенос или отмена
+таймера не ищет его в куче: актуальный срок хранится в словаре, а устаревшие
+записи кучи пропускаются при извлечении (ленивое удаление).
+
+Сроки сохраняются в хранилище (таблица timers), поэтому таймеры переживают
+перезапуск. Таймеры привязаны к user_id и делятся на шарды так же, как
+пользователи: экземпляр бота загружает только user_id % shards == shard.
+"""
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from storage import ProgressStore
+
+logger = logging.getLogger(__name__)
+
+TimerKey = Tuple[int, str]  # (user_id, вид таймера)
+TimerCallback = Callable[[int, str], Awaitable[None]]
+
+
+class TimerScheduler:
+    """Таймеры на куче с ленивым удалением и отложенной записью в хранилище"""
+
+    def __init__(self, store: ProgressStore, callback: TimerCallback,
+                 shards: int = 1, shard: int = 0, coalesce: float = 60.0):
+        self.store = store
+        self.callback = callback
+        self.shards = shards
+        self.shard = shard
+        self.coalesce = coalesce  # перенос меньше чем на столько секунд не записываем
+        self.heap: List[Tuple[float, int, str]] = []
+        self.deadlines: Dict[TimerKey, float] = {}
+        self.pending_writes: Dict[TimerKey, Optional[float]] = {}  # None - таймер удален
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def load(self):
+        """Загружает сохраненные таймеры своего шарда"""
+        self.deadlines = {
+            (user_id, kind): due_at for user_id, kind, due_at in self.store.load_timers(self.shards, self.shard)
+        }
+        self.heap = [(due_at, user_id, kind) for (user_id, kind), due_at in self.deadlines.items()]
+        heapq.heapify(self.heap)
+        logger.info(f"Загружено таймеров: {len(self.heap)}")
+
+    def owns(self, user_id: int) -> bool:
+        """Таймер пользователя относится к этому шарду (как в load_timers, и для отрицательных id групп)"""
+        return user_id % self.shards == self.shard
+
+    def schedule(self, user_id: int, kind: str, due_at: float):
+        """Поставить или перенести таймер. Таймеры чужого шарда не ставятся"""
+        if not self.owns(user_id):
+            return
+        key = (user_id, kind)
+        current = self.deadlines.get(key)
+        if current is not None and abs(current - due_at) < self.coalesce:
+            return
+
+        self.deadlines[key] = due_at
+        self.pending_writes[key] = due_at
+        heapq.heappush(self.heap, (due_at, user_id, kind))
+        self._compact()
+        if self.wakeup is not None and self.heap[0][0] == due_at:
+            self.wakeup.set()
+
+    def cancel(self, user_id: int, kind: str):
+        """Отменить таймер (запись в куче станет устаревшей)"""
+        key = (user_id, kind)
+        if self.deadlines.pop(key, None) is not None:
+            self.pending_writes[key] = None
+
+    def has(self, user_id: int, kind: str) -> bool:
+        return (user_id, kind) in self.deadlines
+
+    def _compact(self):
+        """Пересобирает кучу, если устаревших записей стало больше, чем живых"""
+        if len(self.heap) > 2 * len(self.deadlines) + 1024:
+            self.heap = [(due_at, user_id, kind) for (user_id, kind), due_at in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def flush(self):
+        """Записывает изменения сроков в хранилище"""
+        if self.pending_writes:
+            self.store.save_timers((user_id, kind, due_at) for (user_id, kind), due_at in self.pending_writes.items())
+            self.pending_writes.clear()
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        """Спит до ближайшего срока и вызывает обработчики наступивших таймеров"""
+        while True:
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                due_at, user_id, kind = heapq.heappop(self.heap)
+                if self.deadlines.get((user_id, kind)) != due_at:
+                    continue  # таймер перенесен или отменен
+                self.cancel(user_id, kind)
+                try:
+                    await self.callback(user_id, kind)
+                except Exception as e:
+                    logger.error(f"Ошибка таймера {kind} пользователя {user_id}: {e}")
+
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,94 @@
+"""Снятие клавиатур с устаревших сообщений с вопросами.
+
+Когда игрок уходит с вопроса (ответил, получил новое сообщение с вопросом,
+нажал "Продолжить"), кнопки старого сообщения больше ничего не делают.
+Чтобы по ним не нажимали, бот в фоне убирает их через editMessageReplyMarkup.
+
+Правки идут пачками и с ограничением частоты, чтобы не конкурировать с
+ответами игрокам за лимиты Telegram. При RetryAfter пачка возвращается в
+очередь и задача ждет, сколько попросил Telegram. Очередь живет только в
+памяти: то, что не успели снять до остановки, отвечает на нажатие тостом.
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MessageKey = Tuple[int, int]  # (chat_id, message_id)
+
+
+class KeyboardStripper:
+    """Очередь сообщений, с которых нужно снять клавиатуру, и фоновая задача правок"""
+
+    def __init__(self, rate: float = 5.0, batch: int = 10, max_pending: int = 10000):
+        self.rate = rate  # правок в секунду в среднем
+        self.batch = batch  # правок, отправляемых одновременно
+        self.max_pending = max_pending
+        self.queue: 'OrderedDict[MessageKey, None]' = OrderedDict()
+        self.counters = {'queued': 0, 'stripped': 0, 'failed': 0, 'dropped': 0, 'retry_after': 0}
+        self.telegram_bot = None
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def add(self, chat_id: int, message_id: int):
+        """Поставить сообщение в очередь (повторная постановка ничего не меняет)"""
+        key = (chat_id, message_id)
+        if key in self.queue or self.rate <= 0:
+            return
+        if len(self.queue) >= self.max_pending:
+            # Самые старые сообщения давно пролистаны - их не жалко оставить с кнопками
+            self.queue.popitem(last=False)
+            self.counters['dropped'] += 1
+        self.queue[key] = None
+        self.counters['queued'] += 1
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def start(self, telegram_bot):
+        self.telegram_bot = telegram_bot
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.queue:
+            logger.info(f"Не успели снять клавиатуры с {len(self.queue)} сообщений")
+
+    async def run(self):
+        """Берет из очереди пачку, правит ее и выдерживает паузу по лимиту частоты"""
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+
+            batch = [self.queue.popitem(last=False)[0] for _ in range(min(self.batch, len(self.queue)))]
+            delays = await asyncio.gather(*(self._strip(chat_id, message_id) for chat_id, message_id in batch))
+            await asyncio.sleep(max(len(batch) / self.rate, *delays))
+
+    async def _strip(self, chat_id: int, message_id: int) -> float:
+        """Снимает клавиатуру. Возвращает, сколько Telegram попросил подождать"""
+        try:
+            await self.telegram_bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id,
+                                                              reply_markup=None)
+            self.counters['stripped'] += 1
+            return 0.0
+        except Exception as e:
+            retry_after = getattr(e, 'retry_after', None)
+            if retry_after is not None:
+                # В новых версиях python-telegram-bot это timedelta
+                seconds = retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+                self.counters['retry_after'] += 1
+                self.queue[(chat_id, message_id)] = None
+                return seconds
+            # Сообщение удалено, слишком старое или уже без кнопок - повторять незачем
+            self.counters['failed'] += 1
+            logger.debug(f"Не удалось снять клавиатуру {chat_id}/{message_id}: {e}")
+            return 0.0
@@ -0,0 +1,870 @@
+"""Хранилище прогресса пользователей в SQLite.
+
+Прогресс хранится как журнал событий (таблица actions, только добавление)
+и периодические снимки состояния (таблица progress). Текущее состояние -
+это снимок плюс события после него, поэтому сохранение одного действия
+стоит одной вставки, а не перезаписи всей истории пользователя. Событие
+записано компактно (см. actions.py): код, время в миллисекундах и данные.
+
+Это горячий уровень - игроки, которые проходят квест. Прошедших квест и
+давно неактивных archive() переносит в холодный уровень: вся история игрока
+сжимается одним блобом (cold_progress), а для /stats и /debt рядом лежат
+короткие итоги (cold_index), которые читаются без распаковки. Первое
+обращение через load() возвращает игрока в горячий уровень.
+"""
+import gzip
+import importlib.util
+import json
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from actions import ActionRecord, decode as decode_action, encode as encode_action
+from progress_stream import Quarantine, iter_raw_progress
+
+logger = logging.getLogger(__name__)
+
+# zstd сжимает историю лучше и быстрее gzip, но пакет zstandard необязателен
+HAS_ZSTD = importlib.util.find_spec('zstandard') is not None
+
+SCHEMA_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS progress (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    has_started INTEGER NOT NULL,
+    current_question INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS progress_started_idx ON progress (has_started, updated_at);
+CREATE TABLE IF NOT EXISTS actions (
+    user_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    code INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS attempts (
+    user_id INTEGER NOT NULL,
+    attempt INTEGER NOT NULL,
+    started_at TEXT NOT NULL,
+    ended_at TEXT NOT NULL,
+    completed INTEGER NOT NULL,
+    without_hints INTEGER NOT NULL,
+    solutions INTEGER NOT NULL,
+    finished INTEGER NOT NULL,
+    debt TEXT NOT NULL,
+    PRIMARY KEY (user_id, attempt)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS ledger (
+    user_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    question_id INTEGER,
+    hint_num INTEGER,
+    hugs INTEGER NOT NULL,
+    kisses INTEGER NOT NULL,
+    wishes INTEGER NOT NULL,
+    PRIMARY KEY (user_id, seq, entry)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS debt_totals (
+    entry TEXT PRIMARY KEY,
+    hugs INTEGER NOT NULL,
+    kisses INTEGER NOT NULL,
+    wishes INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS timers (
+    user_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    due_at REAL NOT NULL,
+    PRIMARY KEY (user_id, kind)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS leaderboard (
+    quest TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    solutions INTEGER NOT NULL,
+    hints INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    finished_at TEXT NOT NULL,
+    PRIMARY KEY (quest, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS leaderboard_rank_idx ON leaderboard (quest, solutions, hints, duration, user_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cold_index (
+    user_id INTEGER PRIMARY KEY,
+    partition TEXT NOT NULL,
+    has_started INTEGER NOT NULL,
+    current_question INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    summary TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cold_partition_idx ON cold_index (partition);
+CREATE TABLE IF NOT EXISTS cold_progress (
+    user_id INTEGER PRIMARY KEY,
+    codec TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+"""
+
+# Сколько последних действий загружать в память вместе с прогрессом
+RECENT_ACTIONS = 20
+
+# Событие журнала: (порядковый номер, запись действия)
+Event = Tuple[int, ActionRecord]
+
+# Сколько строк старого журнала переводить в компактный вид за один проход
+MIGRATE_BATCH = 10_000
+
+# Порядок мест в таблице лидеров: меньше решений, потом меньше подсказок, потом быстрее
+LEADERBOARD_ORDER = 'solutions, hints, duration, user_id'
+LEADERBOARD_ORDER_DESC = 'solutions DESC, hints DESC, duration DESC, user_id DESC'
+LEADERBOARD_COLUMNS = 'user_id, name, attempt, solutions, hints, duration, finished_at'
+
+# Ключ места в таблице лидеров: (решений, подсказок, время, user_id) - меньше значит выше
+LeaderboardKey = Tuple[int, int, float, int]
+
+# Номер "события" для входящего остатка долга, перенесенного из данных без журнала долгов
+OPENING_SEQ = -1
+
+# Сегменты пользователей для массовых операций: условие на строку progress.
+# first_ending - первый номер концовки графа квеста (концовки нумеруются после загадок),
+# idle_before - граница неактивности (unix time)
+SEGMENTS = {
+    'all': '1',
+    'active': 'has_started = 1 AND current_question < :first_ending',
+    'finished': 'current_question >= :first_ending',
+    'idle': 'updated_at < :idle_before',
+}
+
+
+def legacy_to_snapshot(record: dict) -> Tuple[dict, List[Event]]:
+    """Переводит запись старого формата (progress.json) в снимок и события.
+
+    В старом журнале нет всех событий, меняющих состояние, поэтому снимок
+    берется из сохраненных полей и считается сделанным после последнего действия.
+    """
+    actions = record.get('action_log', {}).get('actions', [])
+    state = {key: record[key] for key in (
+        'current_question', 'used_hints', 'showed_solutions', 'questions_without_hints',
+        'debt', 'start_time', 'has_started_quest') if key in record}
+    snapshot = {'user_id': record['user_id'], 'seq': len(actions), 'state': state}
+    return snapshot, list(enumerate(ActionRecord.from_legacy(action) for action in actions))
+
+
+def compress(data: bytes) -> Tuple[str, bytes]:
+    """Сжимает историю игрока для холодного уровня: (кодек, байты)"""
+    if HAS_ZSTD:
+        import zstandard
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(data)
+    return 'gzip', gzip.compress(data, compresslevel=6)
+
+
+def decompress(codec: str, data: bytes) -> bytes:
+    if codec == 'gzip':
+        return gzip.decompress(data)
+    if codec == 'zstd':
+        if not HAS_ZSTD:
+            raise RuntimeError("Архив сжат zstd - для чтения нужен пакет zstandard")
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Неизвестный кодек архива: {codec}")
+
+
+def _event_row(user_id: int, seq: int, action: ActionRecord) -> tuple:
+    return (user_id, seq, *encode_action(action))
+
+
+def _event_from_row(code: int, ts: int, data: str) -> ActionRecord:
+    return decode_action(code, ts, data)
+
+
+class StoredProgress:
+    """Все, что нужно для восстановления прогресса: снимок, события после него и хвост журнала"""
+    __slots__ = ('snapshot', 'events', 'recent')
+
+    def __init__(self, snapshot: dict, events: List[Event], recent: List[ActionRecord]):
+        self.snapshot = snapshot
+        self.events = events
+        self.recent = recent
+
+    @classmethod
+    def from_history(cls, user_id: int, snapshot: Optional[dict], history: List[Event]) -> 'StoredProgress':
+        """Из снимка (или None) и всей истории событий по порядку"""
+        snapshot = snapshot or {'user_id': user_id, 'seq': 0, 'state': {}}
+        return cls(snapshot, [(seq, event) for seq, event in history if seq >= snapshot['seq']],
+                   [event for _, event in history[-RECENT_ACTIONS:]])
+
+
+def _leaderboard_row(row: tuple) -> dict:
+    user_id, name, attempt, solutions, hints, duration, finished_at = row
+    return {'user_id': user_id, 'name': name, 'attempt': attempt, 'solutions': solutions, 'hints': hints,
+            'duration': duration, 'finished_at': finished_at}
+
+
+def leaderboard_key(row: dict) -> LeaderboardKey:
+    return row['solutions'], row['hints'], row['duration'], row['user_id']
+
+
+class LedgerEntry:
+    """Проводка журнала долгов: начисление (debit) или погашение (credit) по событию seq"""
+    __slots__ = ('seq', 'timestamp', 'entry', 'reason', 'question_id', 'hint_num', 'amounts')
+
+    def __init__(self, seq: int, timestamp: str, entry: str, reason: str,
+                 question_id: Optional[int], hint_num: Optional[int], amounts: dict):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.entry = entry
+        self.reason = reason
+        self.question_id = question_id
+        self.hint_num = hint_num
+        self.amounts = amounts
+
+    def row(self, user_id: int) -> tuple:
+        return (user_id, self.seq, self.timestamp, self.entry, self.reason, self.question_id, self.hint_num,
+                self.amounts.get('hugs', 0), self.amounts.get('kisses', 0), self.amounts.get('wishes', 0))
+
+    def to_dict(self) -> dict:
+        """Как строка из load_ledger()"""
+        return {'timestamp': self.timestamp, 'entry': self.entry, 'reason': self.reason,
+                'question_id': self.question_id, 'hint_num': self.hint_num,
+                'amounts': {kind: self.amounts.get(kind, 0) for kind in ('hugs', 'kisses', 'wishes')}}
+
+
+class ProgressChanges:
+    """Изменения прогресса одного пользователя с прошлого сохранения"""
+    __slots__ = ('user_id', 'has_started', 'current_question', 'snapshot', 'events', 'attempts', 'ledger',
+                 'result', 'left_leaderboard')
+
+    def __init__(self, user_id: int, has_started: bool, current_question: int,
+                 snapshot: Optional[dict], events: List[Event], attempts: Optional[List[dict]] = None,
+                 ledger: Optional[List[LedgerEntry]] = None, result: Optional[dict] = None,
+                 left_leaderboard: bool = False):
+        self.user_id = user_id
+        self.has_started = has_started
+        self.current_question = current_question
+        self.snapshot = snapshot  # None - снимок не обновлялся
+        self.events = events
+        self.attempts = attempts or []  # итоги завершенных попыток (после /restart)
+        self.ledger = ledger or []  # проводки журнала долгов
+        self.result = result  # результат для таблицы лидеров (если игрок в ней участвует)
+        self.left_leaderboard = left_leaderboard
+
+
+class ProgressStore:
+    """Постоянное хранилище прогресса: снимки и журнал событий"""
+
+    def __init__(self, path: str = 'progress.db'):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """Переводит строки, сохраненные целиком (с action_log внутри), в снимки и события,
+        а журнал старого формата (таблица events) - в компактную таблицу actions"""
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        migrated = 0
+        rows = self.conn.execute('SELECT user_id, data FROM progress').fetchall() if version < 2 else []
+        with self.conn:
+            for user_id, data in rows:
+                record = json.loads(data)
+                if 'state' in record:
+                    continue
+                snapshot, events = legacy_to_snapshot(record)
+                self._write(self.conn, [ProgressChanges(
+                    user_id, bool(record.get('has_started_quest')), record['current_question'], snapshot, events)])
+                migrated += 1
+            converted = self._migrate_events()
+            self.conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        if migrated:
+            logger.info(f"Переведено в журнал событий записей прогресса: {migrated}")
+        if converted:
+            # Место от удаленной таблицы возвращается файлу только после VACUUM
+            self.conn.execute('VACUUM')
+            logger.info(f"Переведено в компактный журнал действий: {converted}")
+
+    def _migrate_events(self) -> int:
+        """Переносит действия из таблицы events (время ISO, имя, текст, данные) в actions и удаляет ее"""
+        if not self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'events'").fetchone():
+            return 0
+        converted = 0
+        cursor = self.conn.execute('SELECT user_id, seq, timestamp, action, details, data FROM events')
+        while True:
+            rows = cursor.fetchmany(MIGRATE_BATCH)
+            if not rows:
+                break
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO actions (user_id, seq, code, ts, data) VALUES (?, ?, ?, ?, ?)',
+                [
+                    _event_row(user_id, seq, ActionRecord.from_legacy(
+                        {'timestamp': timestamp, 'action': action, 'details': details, 'data': json.loads(data)}))
+                    for user_id, seq, timestamp, action, details, data in rows
+                ]
+            )
+            converted += len(rows)
+        self.conn.execute('DROP TABLE events')
+        return converted
+
+    @staticmethod
+    def _load_with(conn: sqlite3.Connection, user_id: int, data: str) -> StoredProgress:
+        # Без снимка состояние восстанавливается повтором всего журнала с начала
+        snapshot = json.loads(data) if data else {'user_id': user_id, 'seq': 0, 'state': {}}
+        events = [
+            (seq, _event_from_row(*row)) for seq, *row in conn.execute(
+                'SELECT seq, code, ts, data FROM actions '
+                'WHERE user_id = ? AND seq >= ? ORDER BY seq', (user_id, snapshot['seq']))
+        ]
+        recent = [
+            _event_from_row(*row) for row in conn.execute(
+                'SELECT code, ts, data FROM actions '
+                'WHERE user_id = ? ORDER BY seq DESC LIMIT ?', (user_id, RECENT_ACTIONS))
+        ]
+        recent.reverse()
+        return StoredProgress(snapshot, events, recent)
+
+    def load(self, user_id: int) -> Optional[StoredProgress]:
+        """Загрузить прогресс пользователя или None, если его нет. Из архива игрок возвращается в горячий уровень"""
+        row = self.conn.execute('SELECT data FROM progress WHERE user_id = ?', (user_id,)).fetchone()
+        if row:
+            return self._load_with(self.conn, user_id, row[0])
+        return self._thaw(user_id)
+
+    @staticmethod
+    def _read_archive(codec: str, data: bytes) -> Tuple[Optional[dict], List[Event]]:
+        archive = json.loads(decompress(codec, data))
+        if 'events' in archive:
+            # Архив до компактного журнала: события записаны словарями с текстом
+            return archive['snapshot'], [(seq, ActionRecord.from_legacy(event)) for seq, event in archive['events']]
+        return archive['snapshot'], [(seq, _event_from_row(*row)) for seq, *row in archive['rows']]
+
+    def _thaw(self, user_id: int) -> Optional[StoredProgress]:
+        """Возвращает игрока из холодного уровня в горячий"""
+        row = self.conn.execute(
+            'SELECT has_started, current_question, codec, data FROM cold_index JOIN cold_progress USING (user_id) '
+            'WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        has_started, current_question, codec, data = row
+        snapshot, history = self._read_archive(codec, data)
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO actions (user_id, seq, code, ts, data) VALUES (?, ?, ?, ?, ?)',
+                [_event_row(user_id, seq, event) for seq, event in history])
+            self.conn.execute(
+                'INSERT OR REPLACE INTO progress (user_id, data, has_started, current_question, updated_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (user_id, json.dumps(snapshot, ensure_ascii=False) if snapshot else '', has_started,
+                 current_question, time.time()))
+            self.conn.execute('DELETE FROM cold_index WHERE user_id = ?', (user_id,))
+            self.conn.execute('DELETE FROM cold_progress WHERE user_id = ?', (user_id,))
+        return StoredProgress.from_history(user_id, snapshot, history)
+
+    def cold_candidates(self, first_ending: int, finished_before: float, idle_before: float,
+                        limit: int) -> List[int]:
+        """Кого пора переносить в холодный уровень: прошедшие квест и давно неактивные, сначала самые давние"""
+        return [user_id for user_id, in self.conn.execute(
+            'SELECT user_id FROM progress WHERE has_started = 1 '
+            'AND ((current_question >= ? AND updated_at < ?) OR updated_at < ?) ORDER BY updated_at LIMIT ?',
+            (first_ending, finished_before, idle_before, limit)
+        )]
+
+    def archive(self, user_ids: Iterable[int], summarize: Callable[[StoredProgress], dict]) -> int:
+        """Переносит игроков в холодный уровень одной транзакцией.
+
+        summarize(прогресс) возвращает итоги, которые кладутся в cold_index и
+        отдаются load_summary() без распаковки истории.
+        """
+        partition = datetime.now(timezone.utc).strftime('%Y-%m')  # месяц архивации
+        archived = 0
+        with self.conn:
+            for user_id in user_ids:
+                row = self.conn.execute(
+                    'SELECT data, has_started, current_question, updated_at FROM progress WHERE user_id = ?',
+                    (user_id,)
+                ).fetchone()
+                if row is None:
+                    continue
+                data, has_started, current_question, updated_at = row
+                snapshot = json.loads(data) if data else None
+                history = [
+                    (seq, _event_from_row(*event)) for seq, *event in self.conn.execute(
+                        'SELECT seq, code, ts, data FROM actions WHERE user_id = ? ORDER BY seq',
+                        (user_id,))
+                ]
+                summary = summarize(StoredProgress.from_history(user_id, snapshot, history))
+                codec, blob = compress(json.dumps(
+                    {'snapshot': snapshot, 'rows': [(seq, *encode_action(event)) for seq, event in history]},
+                    ensure_ascii=False, separators=(',', ':')
+                ).encode('utf-8'))
+
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO cold_index (user_id, partition, has_started, current_question, '
+                    'updated_at, summary) VALUES (?, ?, ?, ?, ?, ?)',
+                    (user_id, partition, has_started, current_question, updated_at,
+                     json.dumps(summary, ensure_ascii=False)))
+                self.conn.execute('INSERT OR REPLACE INTO cold_progress (user_id, codec, data) VALUES (?, ?, ?)',
+                                  (user_id, codec, blob))
+                self.conn.execute('DELETE FROM actions WHERE user_id = ?', (user_id,))
+                self.conn.execute('DELETE FROM progress WHERE user_id = ?', (user_id,))
+                archived += 1
+        return archived
+
+    def load_summary(self, user_id: int) -> Optional[dict]:
+        """Итоги игрока из холодного уровня или None, если его там нет"""
+        row = self.conn.execute('SELECT summary FROM cold_index WHERE user_id = ?', (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def cold_partitions(self) -> List[Tuple[str, int, int]]:
+        """Холодный уровень по месяцам архивации: (месяц, игроков, байт в сжатом виде)"""
+        return self.conn.execute(
+            'SELECT partition, COUNT(*), SUM(LENGTH(data)) FROM cold_index JOIN cold_progress USING (user_id) '
+            'GROUP BY partition ORDER BY partition'
+        ).fetchall()
+
+    @staticmethod
+    def _write_ledger(conn: sqlite3.Connection, rows: List[tuple]):
+        """Добавляет проводки и тут же обновляет итоги, чтобы не пересчитывать их по всем пользователям"""
+        conn.executemany(
+            'INSERT OR IGNORE INTO ledger (user_id, seq, timestamp, entry, reason, question_id, hint_num, '
+            'hugs, kisses, wishes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        conn.executemany(
+            'INSERT INTO debt_totals (entry, hugs, kisses, wishes) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(entry) DO UPDATE SET hugs = hugs + excluded.hugs, '
+            'kisses = kisses + excluded.kisses, wishes = wishes + excluded.wishes',
+            [(row[3], row[7], row[8], row[9]) for row in rows]
+        )
+
+    @staticmethod
+    def _write(conn: sqlite3.Connection, changes: List[ProgressChanges]):
+        now = time.time()
+        ProgressStore._write_ledger(
+            conn, [entry.row(change.user_id) for change in changes for entry in change.ledger])
+        conn.executemany(
+            'INSERT INTO actions (user_id, seq, code, ts, data) VALUES (?, ?, ?, ?, ?)',
+            [_event_row(change.user_id, seq, action) for change in changes for seq, action in change.events]
+        )
+        conn.executemany(
+            'INSERT OR REPLACE INTO attempts (user_id, attempt, started_at, ended_at, completed, '
+            'without_hints, solutions, finished, debt) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                (change.user_id, attempt['attempt'], attempt['started_at'], attempt['ended_at'],
+                 attempt['completed'], attempt['without_hints'], attempt['solutions'],
+                 int(attempt['finished']), json.dumps(attempt['debt']))
+                for change in changes for attempt in change.attempts
+            ]
+        )
+        results = [change for change in changes if change.result]
+        # Лучший результат заменяется только более сильным; имя обновляется всегда
+        conn.executemany(
+            'INSERT INTO leaderboard (quest, user_id, name, attempt, solutions, hints, duration, finished_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(quest, user_id) DO UPDATE SET attempt = excluded.attempt, '
+            'solutions = excluded.solutions, hints = excluded.hints, duration = excluded.duration, '
+            'finished_at = excluded.finished_at '
+            'WHERE (excluded.solutions, excluded.hints, excluded.duration) < (solutions, hints, duration)',
+            [
+                (change.result['quest'], change.user_id, change.result['name'], change.result['attempt'],
+                 change.result['solutions'], change.result['hints'], change.result['duration'],
+                 change.result['finished_at'])
+                for change in results
+            ]
+        )
+        conn.executemany(
+            'UPDATE leaderboard SET name = ? WHERE quest = ? AND user_id = ?',
+            [(change.result['name'], change.result['quest'], change.user_id) for change in results]
+        )
+        conn.executemany(
+            'DELETE FROM leaderboard WHERE user_id = ?',
+            [(change.user_id,) for change in changes if change.left_leaderboard]
+        )
+        conn.executemany(
+            'INSERT INTO progress (user_id, data, has_started, current_question, updated_at) '
+            'VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET data = COALESCE(?, data), '
+            'has_started = excluded.has_started, current_question = excluded.current_question, '
+            'updated_at = excluded.updated_at',
+            [
+                (change.user_id,
+                 json.dumps(change.snapshot, ensure_ascii=False) if change.snapshot else '',
+                 int(change.has_started), change.current_question, now,
+                 json.dumps(change.snapshot, ensure_ascii=False) if change.snapshot else None)
+                for change in changes
+            ]
+        )
+
+    def save_changes(self, changes: Iterable[ProgressChanges], meta: Optional[Dict[str, dict]] = None) -> int:
+        """Сохранить изменения нескольких пользователей одной транзакцией (и, если нужно, записи meta)"""
+        changes = list(changes)
+        if not changes and not meta:
+            return 0
+        with self.conn:
+            if changes:
+                self._write(self.conn, changes)
+            for key, value in (meta or {}).items():
+                self._write_meta(self.conn, key, value)
+        return len(changes)
+
+    def delete_never_started(self, older_than: float, limit: int = -1) -> int:
+        """Удалить пользователей, которые так и не начали квест (и не играли раньше).
+
+        limit - сколько удалить за раз (-1 - всех), чтобы большая уборка шла короткими транзакциями.
+        """
+        never_started = (
+            'SELECT user_id FROM progress WHERE has_started = 0 AND updated_at < ? '
+            'AND user_id NOT IN (SELECT user_id FROM attempts) ORDER BY user_id LIMIT ?'
+        )
+        with self.conn:
+            self.conn.execute(f'DELETE FROM actions WHERE user_id IN ({never_started})', (older_than, limit))
+            cursor = self.conn.execute(f'DELETE FROM progress WHERE user_id IN ({never_started})', (older_than, limit))
+        return cursor.rowcount
+
+    def load_attempts(self, user_id: int) -> List[dict]:
+        """Итоги завершенных попыток пользователя по порядку"""
+        return [
+            {'attempt': attempt, 'started_at': started_at, 'ended_at': ended_at, 'completed': completed,
+             'without_hints': without_hints, 'solutions': solutions, 'finished': bool(finished),
+             'debt': json.loads(debt)}
+            for attempt, started_at, ended_at, completed, without_hints, solutions, finished, debt
+            in self.conn.execute(
+                'SELECT attempt, started_at, ended_at, completed, without_hints, solutions, finished, debt '
+                'FROM attempts WHERE user_id = ? ORDER BY attempt', (user_id,))
+        ]
+
+    def load_ledger(self, user_id: int, limit: int = 20) -> List[dict]:
+        """Последние проводки журнала долгов пользователя (от старых к новым)"""
+        rows = self.conn.execute(
+            'SELECT timestamp, entry, reason, question_id, hint_num, hugs, kisses, wishes FROM ledger '
+            'WHERE user_id = ? ORDER BY seq DESC, entry DESC LIMIT ?', (user_id, limit)
+        ).fetchall()
+        return [
+            {'timestamp': timestamp, 'entry': entry, 'reason': reason, 'question_id': question_id,
+             'hint_num': hint_num, 'amounts': {'hugs': hugs, 'kisses': kisses, 'wishes': wishes}}
+            for timestamp, entry, reason, question_id, hint_num, hugs, kisses, wishes in reversed(rows)
+        ]
+
+    def debt_totals(self) -> dict:
+        """Суммы начислений и погашений по всем пользователям"""
+        totals = {entry: {'hugs': 0, 'kisses': 0, 'wishes': 0} for entry in ('debit', 'credit')}
+        for entry, hugs, kisses, wishes in self.conn.execute('SELECT entry, hugs, kisses, wishes FROM debt_totals'):
+            totals[entry] = {'hugs': hugs, 'kisses': kisses, 'wishes': wishes}
+        return totals
+
+    def open_ledger(self, debt_of: Callable[[StoredProgress], dict]) -> int:
+        """Переносит текущие остатки долга в журнал долгов (один раз для данных без журнала).
+
+        debt_of(прогресс) - сохраненный долг игрока. Работает в отдельном соединении,
+        поэтому прогрев вызывает его в фоновом потоке, пока бот уже отвечает игрокам.
+        Проводки, записанные ботом до этого, уже вошли в сохраненный долг, поэтому
+        остаток берется за их вычетом; долг и проводки читаются в одной транзакции.
+        """
+        timestamp = datetime.now(timezone.utc).isoformat()
+        conn = sqlite3.connect(self.path)
+        try:
+            conn.execute('BEGIN')  # один снимок базы для долга и проводок
+            written = {
+                user_id: {'hugs': hugs, 'kisses': kisses, 'wishes': wishes}
+                for user_id, hugs, kisses, wishes in conn.execute(
+                    "SELECT user_id, SUM(CASE entry WHEN 'debit' THEN hugs ELSE -hugs END), "
+                    "SUM(CASE entry WHEN 'debit' THEN kisses ELSE -kisses END), "
+                    "SUM(CASE entry WHEN 'debit' THEN wishes ELSE -wishes END) FROM ledger GROUP BY user_id"
+                )
+            }
+            rows = []
+            for stored in self._iter_progress_with(conn):
+                user_id = stored.snapshot['user_id']
+                debt = debt_of(stored)
+                opening = {kind: debt.get(kind, 0) - written.get(user_id, {}).get(kind, 0)
+                           for kind in ('hugs', 'kisses', 'wishes')}
+                if any(opening.values()):
+                    rows.append((user_id, OPENING_SEQ, timestamp, 'debit', 'OPENING', None, None,
+                                 opening['hugs'], opening['kisses'], opening['wishes']))
+            conn.rollback()
+
+            with conn:
+                self._write_ledger(conn, rows)
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('ledger', ?)",
+                    (json.dumps({'opened_at': timestamp, 'users': len(rows)}),)
+                )
+            return len(rows)
+        finally:
+            conn.close()
+
+    def _iter_progress_with(self, conn: sqlite3.Connection) -> Iterator[StoredProgress]:
+        for user_id, data in conn.execute('SELECT user_id, data FROM progress'):
+            yield self._load_with(conn, user_id, data)
+        for user_id, codec, data in conn.execute('SELECT user_id, codec, data FROM cold_progress'):
+            yield StoredProgress.from_history(user_id, *self._read_archive(codec, data))
+
+    def iter_progress(self) -> Iterator[StoredProgress]:
+        """Итерирует сохраненный прогресс всех пользователей, включая архив (отдельное соединение)"""
+        conn = sqlite3.connect(self.path)
+        try:
+            yield from self._iter_progress_with(conn)
+        finally:
+            conn.close()
+
+    def leaderboard_rows(self, quest: str, limit: int, after: Optional[LeaderboardKey] = None,
+                         before: Optional[LeaderboardKey] = None) -> List[dict]:
+        """Строки таблицы лидеров по порядку мест сразу после ключа after или перед ключом before.
+
+        Чтение начинается поиском ключа в индексе мест, а не пропуском OFFSET строк,
+        поэтому любая страница стоит O(log n).
+        """
+        if before is not None:
+            rows = self.conn.execute(
+                f'SELECT {LEADERBOARD_COLUMNS} FROM leaderboard '
+                f'WHERE quest = ? AND ({LEADERBOARD_ORDER}) < (?, ?, ?, ?) '
+                f'ORDER BY {LEADERBOARD_ORDER_DESC} LIMIT ?', (quest, *before, limit)
+            ).fetchall()
+            rows.reverse()
+        elif after is not None:
+            rows = self.conn.execute(
+                f'SELECT {LEADERBOARD_COLUMNS} FROM leaderboard '
+                f'WHERE quest = ? AND ({LEADERBOARD_ORDER}) > (?, ?, ?, ?) '
+                f'ORDER BY {LEADERBOARD_ORDER} LIMIT ?', (quest, *after, limit)
+            ).fetchall()
+        else:
+            rows = self.conn.execute(
+                f'SELECT {LEADERBOARD_COLUMNS} FROM leaderboard WHERE quest = ? ORDER BY {LEADERBOARD_ORDER} LIMIT ?',
+                (quest, limit)
+            ).fetchall()
+        return [_leaderboard_row(row) for row in rows]
+
+    def leaderboard_key_at(self, quest: str, offset: int) -> Optional[LeaderboardKey]:
+        """Ключ строки на месте offset + 1. Нужен только для перехода на страницу по номеру и читает один индекс"""
+        return self.conn.execute(
+            f'SELECT {LEADERBOARD_ORDER} FROM leaderboard WHERE quest = ? '
+            f'ORDER BY {LEADERBOARD_ORDER} LIMIT 1 OFFSET ?',
+            (quest, offset)
+        ).fetchone()
+
+    def leaderboard_row(self, quest: str, user_id: int) -> Optional[dict]:
+        row = self.conn.execute(
+            f'SELECT {LEADERBOARD_COLUMNS} FROM leaderboard WHERE quest = ? AND user_id = ?', (quest, user_id)
+        ).fetchone()
+        return _leaderboard_row(row) if row else None
+
+    def leaderboard_count(self, quest: str) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM leaderboard WHERE quest = ?', (quest,)).fetchone()[0]
+
+    def _leaderboard_ahead(self, quest: str, key: LeaderboardKey) -> int:
+        return self.conn.execute(
+            f'SELECT COUNT(*) FROM leaderboard WHERE quest = ? AND ({LEADERBOARD_ORDER}) < (?, ?, ?, ?)', (quest, *key)
+        ).fetchone()[0]
+
+    def _merge_pending(self, quest: str, pending: Dict[int, Optional[dict]]
+                       ) -> Tuple[Dict[int, Optional[dict]], Dict[int, LeaderboardKey]]:
+        """Строки игроков из pending такими, какими их сделает сохранение (правила как в _write),
+        и их ключи в хранилище сейчас"""
+        merged, stored = {}, {}
+        for user_id, result in pending.items():
+            row = self.leaderboard_row(quest, user_id)
+            if row is not None:
+                stored[user_id] = leaderboard_key(row)
+            if result is None:
+                merged[user_id] = None
+                continue
+            new = {'user_id': user_id, **{column: result[column] for column in (
+                'name', 'attempt', 'solutions', 'hints', 'duration', 'finished_at')}}
+            # Лучший результат заменяется только более сильным, имя обновляется всегда
+            better = row is None or leaderboard_key(new) < stored[user_id]
+            merged[user_id] = new if better else dict(row, name=new['name'])
+        return merged, stored
+
+    def leaderboard_view(self, quest: str, limit: int, viewer: int, after: Optional[LeaderboardKey] = None,
+                         before: Optional[LeaderboardKey] = None, pending: Optional[Dict[int, Optional[dict]]] = None
+                         ) -> Tuple[List[dict], int, Optional[int]]:
+        """Страница таблицы (см. leaderboard_rows), число участников и место viewer (None - его нет в таблице).
+
+        pending - еще не сохраненные изменения: user_id -> результат (как в ProgressChanges.result)
+        или None, если игрок вышел из таблицы. Они видны сразу, без записи на диск.
+        """
+        merged, stored = self._merge_pending(quest, pending or {})
+        # Строк игроков из pending в хранилище может быть не больше len(merged) - берем с запасом
+        rows = [row for row in self.leaderboard_rows(quest, limit + len(merged), after, before)
+                if row['user_id'] not in merged]
+        rows += [row for row in merged.values()
+                 if row is not None and (after is None or leaderboard_key(row) > after)
+                 and (before is None or leaderboard_key(row) < before)]
+        rows.sort(key=leaderboard_key)
+        rows = rows[-limit:] if before is not None else rows[:limit]
+
+        total = (self.leaderboard_count(quest)
+                 + sum(1 for user_id, row in merged.items() if row is not None and user_id not in stored)
+                 - sum(1 for user_id, row in merged.items() if row is None and user_id in stored))
+
+        row = merged[viewer] if viewer in merged else self.leaderboard_row(quest, viewer)
+        place = None
+        if row is not None:
+            key = leaderboard_key(row)
+            place = self._leaderboard_ahead(quest, key) + 1
+            for user_id, other in merged.items():
+                if user_id == viewer:
+                    continue
+                place -= user_id in stored and stored[user_id] < key
+                place += other is not None and leaderboard_key(other) < key
+        return rows, total, place
+
+    def leaderboard_place(self, quest: str, user_id: int) -> Optional[int]:
+        """Место игрока или None, если его нет в таблице"""
+        row = self.leaderboard_row(quest, user_id)
+        return self._leaderboard_ahead(quest, leaderboard_key(row)) + 1 if row else None
+
+    def load_timers(self, shards: int = 1, shard: int = 0) -> List[Tuple[int, str, float]]:
+        """Таймеры пользователей своего шарда: (user_id, вид, срок)"""
+        return self.conn.execute(
+            # % в SQLite для отрицательных id (группы) дает отрицательный остаток, приводим как в Python
+            'SELECT user_id, kind, due_at FROM timers WHERE ((user_id % :shards) + :shards) % :shards = :shard',
+            {'shards': shards, 'shard': shard}
+        ).fetchall()
+
+    def save_timers(self, timers: Iterable[Tuple[int, str, Optional[float]]]):
+        """Сохранить сроки таймеров; срок None удаляет таймер"""
+        timers = list(timers)
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO timers (user_id, kind, due_at) VALUES (?, ?, ?) '
+                'ON CONFLICT(user_id, kind) DO UPDATE SET due_at = excluded.due_at',
+                [timer for timer in timers if timer[2] is not None]
+            )
+            self.conn.executemany(
+                'DELETE FROM timers WHERE user_id = ? AND kind = ?',
+                [(user_id, kind) for user_id, kind, due_at in timers if due_at is None]
+            )
+
+    def count(self) -> int:
+        return sum(self.count_tiers())
+
+    def count_tiers(self) -> Tuple[int, int]:
+        """Сколько игроков в горячем и в холодном уровне"""
+        return (self.conn.execute('SELECT COUNT(*) FROM progress').fetchone()[0],
+                self.conn.execute('SELECT COUNT(*) FROM cold_index').fetchone()[0])
+
+    def select_users(self, segment: str, after: Optional[int], limit: int,
+                     first_ending: int, idle_before: float = 0.0) -> List[int]:
+        """Следующие limit пользователей сегмента с user_id больше after (курсор по первичному ключу).
+
+        after=None - с самого начала: у групп id отрицательные, поэтому "больше 0" их бы пропустило.
+        В cold_index те же столбцы, что и в progress, поэтому условия сегментов подходят обоим уровням.
+        """
+        params = {'after': after, 'limit': limit, 'first_ending': first_ending, 'idle_before': idle_before}
+        after_cursor = 'user_id > :after AND ' if after is not None else ''
+        user_ids = []
+        for table in ('progress', 'cold_index'):
+            user_ids += [user_id for user_id, in self.conn.execute(
+                f'SELECT user_id FROM {table} WHERE {after_cursor}({SEGMENTS[segment]}) '
+                f'ORDER BY user_id LIMIT :limit', params
+            )]
+        return sorted(user_ids)[:limit]
+
+    def count_users(self, segment: str, first_ending: int, idle_before: float = 0.0) -> int:
+        return sum(
+            self.conn.execute(
+                f'SELECT COUNT(*) FROM {table} WHERE {SEGMENTS[segment]}',
+                {'first_ending': first_ending, 'idle_before': idle_before}
+            ).fetchone()[0]
+            for table in ('progress', 'cold_index')
+        )
+
+    def iter_actions(self) -> Iterator[Tuple[int, ActionRecord]]:
+        """Итерирует все действия всех пользователей, включая архив (отдельное соединение, можно из другого потока)"""
+        conn = sqlite3.connect(self.path)
+        try:
+            for user_id, *row in conn.execute(
+                    'SELECT user_id, code, ts, data FROM actions ORDER BY user_id, seq'):
+                yield user_id, _event_from_row(*row)
+            for user_id, codec, data in conn.execute('SELECT user_id, codec, data FROM cold_progress ORDER BY user_id'):
+                for _, event in self._read_archive(codec, data)[1]:
+                    yield user_id, event
+        finally:
+            conn.close()
+
+    def load_recent(self, since: float, limit: int) -> List[StoredProgress]:
+        """Недавно активные начавшие квест пользователи (отдельное соединение, для фонового потока)"""
+        conn = sqlite3.connect(self.path)
+        try:
+            rows = conn.execute(
+                'SELECT user_id, data FROM progress WHERE has_started = 1 AND updated_at >= ? '
+                'ORDER BY updated_at DESC LIMIT ?', (since, limit)
+            ).fetchall()
+            return [self._load_with(conn, user_id, data) for user_id, data in rows]
+        finally:
+            conn.close()
+
+    def get_meta(self, key: str) -> Optional[dict]:
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @staticmethod
+    def _write_meta(conn: sqlite3.Connection, key: str, value: dict):
+        conn.execute(
+            'INSERT INTO meta (key, value) VALUES (?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+            (key, json.dumps(value, ensure_ascii=False))
+        )
+
+    def set_meta(self, key: str, value: dict):
+        with self.conn:
+            self._write_meta(self.conn, key, value)
+
+    def import_json(self, path: str, batch_size: int = 500, quarantine_path: Optional[str] = None,
+                    on_batch: Optional[Callable[[int, int], None]] = None) -> int:
+        """Перенести записи из старого progress.json, читая его потоково.
+
+        Битая запись не прерывает перенос: она уходит в карантин (по умолчанию
+        <path>.quarantine.jsonl), остальные переносятся. on_batch(перенесено, в карантине)
+        вызывается после каждой записанной пачки.
+        """
+        if not os.path.exists(path):
+            return 0
+
+        quarantine = Quarantine(quarantine_path or f'{path}.quarantine.jsonl')
+        imported = 0
+        batch = []
+        try:
+            for key, raw in iter_raw_progress(path):
+                try:
+                    record = json.loads(raw)
+                    snapshot, events = legacy_to_snapshot(record)
+                    batch.append(ProgressChanges(
+                        int(record['user_id']), bool(record.get('has_started_quest')),
+                        int(record['current_question']), snapshot, events))
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    quarantine.add(key, raw, e)
+                    continue
+                if len(batch) >= batch_size:
+                    imported += self.save_changes(batch)
+                    batch = []
+                    if on_batch:
+                        on_batch(imported, quarantine.count)
+        finally:
+            # Даже если файл оборван посередине, все разобранное до этого места сохраняется
+            imported += self.save_changes(batch)
+            quarantine.close()
+
+        logger.info(f"Импортировано {imported} записей прогресса из {path}")
+        if quarantine.count:
+            logger.warning(f"Не удалось перенести {quarantine.count} записей, они отложены в {quarantine.path}")
+        return imported
+
+    def close(self):
+        self.conn.close()
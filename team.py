@@ -0,0 +1,122 @@
+"""Командный режим: группа проходит один общий квест.
+
+Прогресс группы хранится под chat_id. У групп он отрицательный и не
+пересекается с id пользователей, поэтому хранилище, кэш и таймеры работают
+без изменений. Здесь то, что нужно из-за множества игроков в одном чате:
+
+- обновления одного чата обрабатываются по очереди (KeyedLocks), разных
+  чатов - параллельно;
+- необязательные ответы бота (неправильно, слишком часто) ограничены
+  бюджетом чата, чтобы 200 человек, перебирающих ответы, не получили 200
+  ответов и бот не уперся в лимиты Telegram на группу;
+- правильный ответ засчитывается первому, а тот же ответ от остальных в
+  течение нескольких секунд склеивается с ним и молча пропускается.
+"""
+import asyncio
+import contextlib
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+GROUP_CHAT_TYPES = ('group', 'supergroup')
+
+
+def is_team_chat(chat) -> bool:
+    """Групповой чат - в нем играют командой"""
+    return chat is not None and chat.type in GROUP_CHAT_TYPES
+
+
+class KeyedLocks:
+    """Блокировки по ключу, которые живут, пока их кто-то держит или ждет"""
+
+    def __init__(self):
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.holders: Dict[int, int] = {}  # сколько обработчиков держат или ждут блокировку
+        self.counters = {'acquired': 0, 'waited': 0}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: int):
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        self.holders[key] = self.holders.get(key, 0) + 1
+        if lock.locked():
+            self.counters['waited'] += 1
+        try:
+            async with lock:
+                self.counters['acquired'] += 1
+                yield
+        finally:
+            self.holders[key] -= 1
+            if not self.holders[key]:
+                del self.holders[key]
+                del self.locks[key]
+
+
+@dataclass
+class TeamChat:
+    """Состояние группы, которое нужно только в памяти"""
+    tokens: float
+    updated: float
+    solved_answer: Optional[str] = None  # последний засчитанный ответ
+    solved_at: float = 0.0
+
+
+class TeamRegistry:
+    """Бюджет необязательных ответов и склейка одновременных правильных ответов по группам"""
+
+    def __init__(self, reply_burst: int = 2, reply_interval: float = 5.0,
+                 coalesce_window: float = 10.0, idle_ttl: float = 3600.0):
+        self.reply_burst = reply_burst
+        self.reply_interval = reply_interval  # секунд на восстановление одного ответа
+        self.coalesce_window = coalesce_window
+        self.idle_ttl = idle_ttl
+        self.chats: Dict[int, TeamChat] = {}
+        self.last_cleanup = time.monotonic()
+        self.counters = {'replies': 0, 'suppressed': 0, 'coalesced': 0}
+
+    def _chat(self, chat_id: int, now: float) -> TeamChat:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            self._cleanup(now)
+            chat = self.chats[chat_id] = TeamChat(tokens=self.reply_burst, updated=now)
+        return chat
+
+    def allow_reply(self, chat_id: int) -> bool:
+        """Можно ли отправить в группу необязательный ответ (расходует бюджет)"""
+        now = time.monotonic()
+        chat = self._chat(chat_id, now)
+        if self.reply_interval > 0:
+            chat.tokens = min(self.reply_burst, chat.tokens + (now - chat.updated) / self.reply_interval)
+        chat.updated = now
+        if chat.tokens < 1:
+            self.counters['suppressed'] += 1
+            return False
+        chat.tokens -= 1
+        self.counters['replies'] += 1
+        return True
+
+    def solved(self, chat_id: int, answer: str):
+        """Запомнить засчитанный ответ, чтобы склеить с ним опоздавшие"""
+        now = time.monotonic()
+        chat = self._chat(chat_id, now)
+        chat.solved_answer = answer
+        chat.solved_at = now
+
+    def is_late_answer(self, chat_id: int, answer: str) -> bool:
+        """Тот же ответ, что только что засчитан другому участнику"""
+        chat = self.chats.get(chat_id)
+        if chat is None or chat.solved_answer != answer:
+            return False
+        if time.monotonic() - chat.solved_at > self.coalesce_window:
+            return False
+        self.counters['coalesced'] += 1
+        return True
+
+    def _cleanup(self, now: float):
+        """Забываем группы, от которых давно ничего не было"""
+        if now - self.last_cleanup < self.idle_ttl:
+            return
+        self.last_cleanup = now
+        self.chats = {chat_id: chat for chat_id, chat in self.chats.items()
+                      if now - max(chat.updated, chat.solved_at) < self.idle_ttl}
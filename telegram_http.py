@@ -0,0 +1,158 @@
+"""HTTP-клиент для Bot API: отдельные пулы соединений и метрика ожидания пула.
+
+getUpdates держит соединение открытым на время long polling, поэтому у него
+свой маленький пул, а отправка сообщений идет через отдельный пул побольше
+и не встает в очередь за polling. Размеры пулов, keep-alive, HTTP/2, таймауты
+и адрес локального сервера Bot API задаются переменными окружения (см. .env.exmaple).
+
+Сколько запрос ждал свободного соединения, измеряется в транспорте: от входа
+в транспорт до первого события httpcore на соединении (подключение нового
+или отправка заголовков по уже открытому). По этим замерам пул подбирается
+под реальную нагрузку, см. /metrics.
+"""
+import importlib.util
+import logging
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+import httpx
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Первые события httpcore после того, как запрос получил соединение из пула
+_ACQUIRED_EVENTS = frozenset({
+    'connection.connect_tcp.started',
+    'connection.connect_unix_socket.started',
+    'http11.send_request_headers.started',
+    'http2.send_request_headers.started',
+})
+
+
+class PoolStats:
+    """Счетчики одного пула: запросы, ожидание соединения, таймауты пула"""
+
+    def __init__(self, name: str, size: int, window: int = 1000):
+        self.name = name
+        self.size = size
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.pool_timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits: Deque[float] = deque(maxlen=window)  # для перцентилей
+
+    def record_wait(self, seconds: float):
+        self.total_wait += seconds
+        self.max_wait = max(self.max_wait, seconds)
+        self.recent_waits.append(seconds)
+
+    def percentile(self, fraction: float) -> float:
+        if not self.recent_waits:
+            return 0.0
+        waits = sorted(self.recent_waits)
+        return waits[min(len(waits) - 1, int(fraction * len(waits)))]
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            'size': self.size,
+            'requests': self.requests,
+            'in_flight': self.in_flight,
+            'peak_in_flight': self.peak_in_flight,
+            'pool_timeouts': self.pool_timeouts,
+            'wait_avg_ms': self.total_wait / self.requests * 1000 if self.requests else 0.0,
+            'wait_p50_ms': self.percentile(0.5) * 1000,
+            'wait_p95_ms': self.percentile(0.95) * 1000,
+            'wait_max_ms': self.max_wait * 1000,
+        }
+
+
+class MeasuredTransport(httpx.AsyncHTTPTransport):
+    """Транспорт httpx, который замеряет ожидание соединения из пула"""
+
+    def __init__(self, stats: PoolStats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        stats = self.stats
+        started = time.perf_counter()
+        acquired = False
+
+        async def trace(event: str, info: dict):
+            nonlocal acquired
+            if not acquired and event in _ACQUIRED_EVENTS:
+                acquired = True
+                stats.record_wait(time.perf_counter() - started)
+
+        request.extensions = {**request.extensions, 'trace': trace}
+        stats.requests += 1
+        stats.in_flight += 1
+        stats.peak_in_flight = max(stats.peak_in_flight, stats.in_flight)
+        try:
+            return await super().handle_async_request(request)
+        except httpx.PoolTimeout:
+            stats.pool_timeouts += 1
+            raise
+        finally:
+            stats.in_flight -= 1
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def build_request(prefix: str, name: str, pool_size: int, read_timeout: float) -> Tuple[HTTPXRequest, PoolStats]:
+    """HTTPXRequest с настройками из переменных окружения {prefix}_* и счетчиками пула"""
+    size = _env_int(f'{prefix}_POOL_SIZE', pool_size)
+    http2 = os.getenv('TELEGRAM_HTTP2', '0') == '1'
+    if http2 and importlib.util.find_spec('h2') is None:
+        logger.warning("TELEGRAM_HTTP2=1, но пакет h2 не установлен (python-telegram-bot[http2]) - используем HTTP/1.1")
+        http2 = False
+
+    stats = PoolStats(name, size)
+    transport = MeasuredTransport(
+        stats,
+        http1=not http2,
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=size,
+            max_keepalive_connections=_env_int('TELEGRAM_KEEPALIVE_CONNECTIONS', size),
+            keepalive_expiry=_env_float('TELEGRAM_KEEPALIVE_EXPIRY', 30.0),
+        ),
+    )
+    request = HTTPXRequest(
+        connection_pool_size=size,
+        connect_timeout=_env_float('TELEGRAM_CONNECT_TIMEOUT', 5.0),
+        read_timeout=_env_float(f'{prefix}_READ_TIMEOUT', read_timeout),
+        write_timeout=_env_float('TELEGRAM_WRITE_TIMEOUT', 5.0),
+        pool_timeout=_env_float(f'{prefix}_POOL_TIMEOUT', 1.0),
+        http_version='2' if http2 else '1.1',
+        httpx_kwargs={'transport': transport},
+    )
+    return request, stats
+
+
+def configure(builder) -> Dict[str, PoolStats]:
+    """Подключает к ApplicationBuilder пулы отправки и getUpdates и адрес сервера Bot API"""
+    send_request, send_stats = build_request('TELEGRAM_SEND', 'send', 64, 5.0)
+    updates_request, updates_stats = build_request('TELEGRAM_UPDATES', 'updates', 1, 5.0)
+    builder.request(send_request).get_updates_request(updates_request)
+
+    # Локальный сервер Bot API (telegram-bot-api --local): свои адреса и файлы с диска
+    base_url: Optional[str] = os.getenv('TELEGRAM_BASE_URL')
+    if base_url:
+        builder.base_url(base_url)
+        builder.base_file_url(os.getenv('TELEGRAM_BASE_FILE_URL', base_url.replace('/bot', '/file/bot')))
+        builder.local_mode(os.getenv('TELEGRAM_LOCAL_MODE', '0') == '1')
+
+    return {'send': send_stats, 'updates': updates_stats}
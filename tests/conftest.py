@@ -0,0 +1,16 @@
+"""Общие фикстуры тестов: запускаются из корня репозитория командой python -m pytest"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import ProgressStore  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ProgressStore(str(tmp_path / 'progress.db'))
+    yield store
+    store.close()
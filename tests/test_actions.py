@@ -0,0 +1,50 @@
+import json
+
+from actions import ActionCode, ActionRecord, decode, decode_data, encode, encode_data, to_ms
+
+
+def test_payload_is_positional_when_keys_fit_schema():
+    data = {'question_id': 3, 'hint_num': 2, 'debit': {'hugs': 5}}
+    text = encode_data(ActionCode.HINT_USED, data)
+    assert json.loads(text) == [3, 2, {'hugs': 5}]
+    assert decode_data(ActionCode.HINT_USED, text) == data
+
+
+def test_optional_trailing_fields_are_kept_positionally():
+    data = {'question_id': 1, 'user_answer': 'нет', 'by': 7, 'by_name': 'Аня'}
+    text = encode_data(ActionCode.WRONG_ANSWER, data)
+    assert json.loads(text) == [1, 'нет', 7, 'Аня']
+    assert decode_data(ActionCode.WRONG_ANSWER, text) == data
+
+
+def test_payload_falls_back_to_dict_outside_schema():
+    # Пропущено поле из середины схемы и есть лишнее - пишется словарь
+    data = {'question_id': 1, 'by': 7}
+    assert json.loads(encode_data(ActionCode.WRONG_ANSWER, data)) == data
+    assert decode_data(ActionCode.WRONG_ANSWER, encode_data(ActionCode.WRONG_ANSWER, data)) == data
+
+    data = {'kind': 'nudge'}
+    assert decode_data(ActionCode.QUEST_COMPLETED, encode_data(ActionCode.QUEST_COMPLETED, data)) == data
+
+
+def test_empty_payload():
+    assert encode_data(ActionCode.QUEST_STARTED, {}) == ''
+    assert decode_data(ActionCode.QUEST_STARTED, '') == {}
+
+
+def test_record_round_trip():
+    record = ActionRecord(ActionCode.DEBT_REPAID, 1_700_000_000_123, {'credit': {'kisses': 2}})
+    assert decode(*encode(record)) == record
+
+
+def test_legacy_record():
+    legacy = {'timestamp': '2025-01-31T12:00:00', 'action': 'HINT_USED', 'details': '...',
+              'data': {'question_id': 1, 'hint_num': 1}}
+    record = ActionRecord.from_legacy(legacy)
+    assert record.code == ActionCode.HINT_USED
+    assert record.ts == to_ms('2025-01-31T12:00:00+00:00')
+
+    unknown = ActionRecord.from_legacy({'timestamp': '2025-01-31T12:00:00', 'action': 'SOMETHING', 'details': 'текст'})
+    assert unknown.code == ActionCode.OTHER
+    assert unknown.name == 'SOMETHING'
+    assert unknown.details == 'текст'
@@ -0,0 +1,30 @@
+import base64
+import os
+import shutil
+
+from assets import ImageAssets
+
+# Картинка 1x1 в PNG: собирается и с Pillow, и без него
+PIXEL = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==')
+
+
+def make_assets(tmp_path):
+    assets = ImageAssets(str(tmp_path / 'images'), str(tmp_path / 'images' / '.cache'))
+    os.makedirs(assets.source_dir)
+    with open(os.path.join(assets.source_dir, 'q1.png'), 'wb') as f:
+        f.write(PIXEL)
+    return assets
+
+
+def test_missing_image_is_skipped(tmp_path):
+    assets = make_assets(tmp_path)
+    assert assets.photo('missing.png') is None
+    assert 'missing.png' not in assets.hashes
+
+
+def test_variant_is_rebuilt_after_cache_cleanup(tmp_path):
+    assets = make_assets(tmp_path)
+    first = assets.photo('q1.png')
+    assert isinstance(first, bytes)
+    shutil.rmtree(assets.cache_dir)
+    assert assets.photo('q1.png') == first
@@ -0,0 +1,44 @@
+import asyncio
+
+from actions import ActionCode, ActionRecord
+from bulk_jobs import META_KEY, BulkJob, BulkJobRunner
+from storage import ProgressChanges
+
+
+def add_users(store, user_ids):
+    event = ActionRecord(ActionCode.QUEST_STARTED, 1_700_000_000_000, {})
+    store.save_changes([ProgressChanges(user_id, True, 1, None, [(0, event)]) for user_id in user_ids])
+
+
+def test_job_covers_group_chats_in_both_tiers(store):
+    # Группы (отрицательные id) и в горячем, и в холодном уровне
+    add_users(store, [-1002, -1001, -5, 7, 42])
+    assert store.archive([-1002, 7], lambda stored: {}) == 2
+    seen = []
+
+    async def process(job, user_ids):
+        seen.extend(user_ids)
+        return [], 0
+
+    async def report(job, finished):
+        pass
+
+    async def scenario():
+        runner = BulkJobRunner(store, process, report, first_ending=11, batch_size=2)
+        runner.submit(BulkJob('clear_debt', 'all'))
+        await runner.task
+        return runner.job
+
+    job = asyncio.run(scenario())
+    assert seen == [-1002, -1001, -5, 7, 42]
+    assert (job.status, job.total, job.processed, job.cursor) == ('done', 5, 5, 42)
+    assert store.get_meta(META_KEY)['cursor'] == 42
+
+
+def test_new_job_starts_before_negative_ids(store):
+    add_users(store, [-7, 3])
+    job = BulkJob('reset', 'all')
+    assert job.cursor is None
+    assert BulkJob.from_dict(job.to_dict()).cursor is None
+    assert store.select_users('all', job.cursor, 10, 11) == [-7, 3]
+    assert store.select_users('all', -7, 10, 11) == [3]
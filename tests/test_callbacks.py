@@ -0,0 +1,50 @@
+import base64
+import struct
+
+import pytest
+
+from callbacks import Action, Callback, PREFIX, decode, encode
+
+
+@pytest.mark.parametrize('callback', [
+    Callback(Action.START_QUEST),
+    Callback(Action.HINT, 3, 2, nonce=5),
+    Callback(Action.SOLUTION, 255, nonce=0),
+    Callback(Action.LEADERBOARD_PAGE, arg=0xFFFF),
+    Callback(Action.LEADERBOARD_PAGE, arg=2, extra=struct.pack('>?HHdq', False, 1, 4, 3600.5, -100)),
+])
+def test_round_trip(callback):
+    data = encode(callback)
+    assert data.startswith(PREFIX)
+    assert len(data.encode('ascii')) <= 64  # предел callback_data в Telegram
+    assert decode(data) == callback
+
+
+def test_compact_size():
+    assert len(encode(Callback(Action.HINT, 10, 1, nonce=3))) == 11
+
+
+@pytest.mark.parametrize('data', ['.', '.!!!', '.AAAA', '.' + 'A' * 7, 'garbage', 'hint_x_1', 'lb_1_2'])
+def test_broken_data_is_rejected(data):
+    assert decode(data) is None
+
+
+def test_other_version_is_rejected():
+    packed = struct.pack('>BBBBHB', 2, Action.HINT, 0, 1, 1, 0)
+    assert decode(PREFIX + base64.urlsafe_b64encode(packed).rstrip(b'=').decode()) is None
+
+
+def test_unknown_action_is_rejected():
+    packed = struct.pack('>BBBBHB', 1, 200, 0, 1, 1, 0)
+    assert decode(PREFIX + base64.urlsafe_b64encode(packed).rstrip(b'=').decode()) is None
+
+
+@pytest.mark.parametrize('data, expected', [
+    ('start_quest', Callback(Action.START_QUEST)),
+    ('hint_3_1', Callback(Action.HINT, 3, 1)),
+    ('solution_10', Callback(Action.SOLUTION, 10)),
+    ('next_2', Callback(Action.NEXT, 2)),
+    ('lb_4', Callback(Action.LEADERBOARD_PAGE, arg=4)),
+])
+def test_legacy_buttons(data, expected):
+    assert decode(data) == expected
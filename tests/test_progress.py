@@ -0,0 +1,73 @@
+"""Свертка журнала в UserProgress и вытеснение игроков из памяти (нужен python-telegram-bot)"""
+import importlib
+
+import pytest
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    # Модуль бота открывает лог действий в текущем каталоге - импортируем его в каталоге теста
+    pytest.importorskip('telegram')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('PROGRESS_DB', str(tmp_path / 'progress.db'))
+    return importlib.import_module('bot')
+
+
+def play(progress):
+    """Несколько ходов: подсказки, показанное решение, правильные ответы и переходы"""
+    progress.start_quest()
+    progress.add_hint_used(1, 1)
+    progress.answer_correct(1)
+    progress.advance()
+    progress.answer_correct(2)
+    progress.advance()
+    progress.add_hint_used(3, 1)
+    progress.add_hint_used(3, 2)
+    progress.add_solution_shown(3)
+    progress.answer_correct(3)
+    progress.advance()
+    progress.add_hint_used(4, 1)
+
+
+def test_replay_from_snapshot_and_tail(bot, store):
+    progress = bot.UserProgress(1)
+    play(progress)
+    # Снимок делается при первом сохранении и дальше раз в 4 события, остальное - хвост журнала
+    store.save_changes([progress.collect_changes(4)])
+    progress.log_user_message('привет')
+    progress.clear_debt()
+    progress.add_hint_used(4, 2)
+    progress.answer_correct(4)
+    progress.advance()
+    store.save_changes([progress.collect_changes(4)])
+    progress.add_solution_shown(5)
+    store.save_changes([progress.collect_changes(4)])
+
+    stored = store.load(1)
+    assert stored.snapshot['seq'] > 0
+    assert stored.events
+    restored = bot.UserProgress.from_stored(stored)
+    assert restored.state_dict() == progress.state_dict()
+
+    # Новые события продолжают нумерацию журнала, а не перезаписывают его
+    restored.answer_correct(5)
+    restored.advance()
+    store.save_changes([restored.collect_changes(4)])
+    assert bot.UserProgress.from_stored(store.load(1)).state_dict() == restored.state_dict()
+
+
+def test_evicted_player_is_reloaded(bot, monkeypatch):
+    monkeypatch.setenv('MAX_CACHED_USERS', '1')
+    quest_bot = bot.QuestBot()
+    try:
+        progress = quest_bot.get_user_progress(1)
+        play(progress)
+        state = progress.state_dict()
+
+        quest_bot.get_user_progress(2)  # второй игрок вытесняет первого, несохраненное пишется
+        assert 1 not in quest_bot.user_progress
+        reloaded = quest_bot.peek_user_progress(1)
+        assert reloaded is not progress
+        assert reloaded.state_dict() == state
+    finally:
+        quest_bot.store.close()
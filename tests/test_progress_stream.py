@@ -0,0 +1,54 @@
+import io
+import json
+
+import pytest
+
+from progress_stream import iter_raw_records
+
+DATA = {
+    '1': {'user_id': 1, 'used_hints': {'1': [1, 2]}, 'name': 'скобки { [ и "кавычки" \\ внутри'},
+    '22': {'user_id': 22, 'current_question': 3, 'flags': [True, False, None], 'score': -1.5e3},
+    '333': {'user_id': 333, 'action_log': {'actions': []}},
+}
+TEXT = json.dumps(DATA, ensure_ascii=False, indent=1)
+
+
+def read(text: str, chunk_size: int = 1 << 16):
+    return [(key, json.loads(raw)) for key, raw in iter_raw_records(io.StringIO(text), chunk_size)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 64, 1 << 16])
+def test_reads_records_across_chunks(chunk_size):
+    assert read(TEXT, chunk_size) == list(DATA.items())
+
+
+def test_empty_input():
+    assert read('') == []
+    assert read('  {  }  ') == []
+
+
+@pytest.mark.parametrize('cut', [
+    TEXT.index('"скобки') + 5,  # внутри строки
+    TEXT.index('\\\\') + 1,  # сразу после обратной косой черты
+    TEXT.index('"flags"') + 12,  # внутри массива
+    TEXT.index('"333"') + 3,  # внутри ключа
+    TEXT.index('"333"') + 6,  # после ключа, до ':'
+    len(TEXT) - 2,  # в последней записи, без закрывающих скобок
+])
+@pytest.mark.parametrize('chunk_size', [1, 5, 1 << 16])
+def test_truncated_input_raises(cut, chunk_size):
+    with pytest.raises(ValueError):
+        read(TEXT[:cut], chunk_size)
+
+
+def test_truncated_input_yields_complete_records_first():
+    records = iter_raw_records(io.StringIO(TEXT[:TEXT.index('"333"') + 10]), 4)
+    assert json.loads(next(records)[1]) == DATA['1']
+    assert json.loads(next(records)[1]) == DATA['22']
+    with pytest.raises(ValueError):
+        next(records)
+
+
+def test_bad_separator():
+    with pytest.raises(ValueError, match="Ожидалась"):
+        read('{"1": {} "2": {}}')
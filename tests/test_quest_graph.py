@@ -0,0 +1,60 @@
+import pytest
+
+from quest_graph import (HINT1_USED, HINT2_USED, SOLUTION_SHOWN, QuestGraph, Transition, bit, outcome_of,
+                         with_hints, with_outcome, without_hints)
+
+
+def test_linear_graph():
+    graph = QuestGraph.linear([1, 2, 3], "Конец")
+    assert graph.first_ending == 4
+    assert graph.next_step(1, 0, 0) == (2, 0)
+    assert graph.next_step(3, SOLUTION_SHOWN, 0) == (4, 0)
+    assert graph.is_ending(4) and graph.is_finished(4)
+    assert graph.is_step(3) and not graph.is_finished(3)
+
+
+def test_branching_with_unlocks_and_requirements():
+    graph = QuestGraph.compile(
+        [1, 2, 3],
+        [
+            Transition(1, 2, when=without_hints, unlocks=(3,)),
+            Transition(1, 2),
+            Transition(2, 3, requires=(3,)),
+            Transition(2, 5, when=with_hints),
+            Transition(2, 4),
+            Transition(3, 4),
+        ],
+        {4: "Обычная концовка", 5: "Концовка с подсказками"}, start=1)
+    assert graph.next_step(1, 0, bit(1)) == (2, bit(3))
+    assert graph.next_step(1, HINT1_USED, bit(1)) == (2, 0)
+    assert graph.next_step(2, 0, bit(3)) == (3, 0)
+    assert graph.next_step(2, HINT2_USED, 0) == (5, 0)
+    assert graph.next_step(2, 0, 0) == (4, 0)
+
+
+@pytest.mark.parametrize('steps, transitions, endings, start, message', [
+    ([1, 2], [Transition(1, 2), Transition(2, 3)], {}, 1, "нет концовок"),
+    ([1, 2], [Transition(1, 2), Transition(2, 2)], {2: "Конец"}, 1, "совпадают"),
+    ([1, 3], [Transition(1, 3), Transition(3, 2)], {2: "Конец"}, 1, "больше номера"),
+    ([1, 2], [Transition(1, 2), Transition(2, 3)], {3: "Конец"}, 7, "Начальный шаг"),
+    ([1, 2], [Transition(1, 9), Transition(2, 3)], {3: "Конец"}, 1, "неизвестный шаг"),
+    ([1, 2], [Transition(1, 2), Transition(2, 3), Transition(5, 3)], {3: "Конец"}, 1, "неизвестной загадки"),
+    ([1, 2], [Transition(1, 2, when=without_hints), Transition(2, 3)], {3: "Конец"}, 1, "нет безусловного"),
+    ([1, 2], [Transition(1, 2), Transition(2, 3, requires=(1,))], {3: "Конец"}, 1, "нет безусловного"),
+    ([1, 2, 3], [Transition(1, 4), Transition(2, 3), Transition(3, 4)], {4: "Конец"}, 1, "недостижимы"),
+])
+def test_compile_rejects_bad_graphs(steps, transitions, endings, start, message):
+    with pytest.raises(ValueError, match=message):
+        QuestGraph.compile(steps, transitions, endings, start)
+
+
+def test_packed_outcomes():
+    graph = QuestGraph.linear(range(1, 12), "Конец")
+    outcomes = with_outcome(0, 1, HINT1_USED)
+    outcomes = with_outcome(outcomes, 11, HINT1_USED | HINT2_USED | SOLUTION_SHOWN)
+    outcomes = with_outcome(outcomes, 1, HINT1_USED)  # повторная подсказка ничего не меняет
+    assert outcome_of(outcomes, 1) == HINT1_USED
+    assert outcome_of(outcomes, 2) == 0
+    assert outcome_of(outcomes, 11) == HINT1_USED | HINT2_USED | SOLUTION_SHOWN
+    assert graph.count_outcomes(outcomes, HINT1_USED | HINT2_USED) == 3
+    assert graph.count_outcomes(outcomes, SOLUTION_SHOWN) == 1
@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+from scheduler import TimerScheduler
+
+
+async def noop(user_id, kind):
+    pass
+
+
+def test_reschedule_within_coalesce_window_is_ignored(store):
+    scheduler = TimerScheduler(store, noop, coalesce=60)
+    scheduler.schedule(1, 'nudge', 1000.0)
+    scheduler.schedule(1, 'nudge', 1030.0)
+    assert scheduler.deadlines == {(1, 'nudge'): 1000.0}
+
+    scheduler.schedule(1, 'nudge', 2000.0)
+    assert scheduler.deadlines == {(1, 'nudge'): 2000.0}
+    assert scheduler.pending_writes == {(1, 'nudge'): 2000.0}
+
+
+def test_cancel_and_flush(store):
+    scheduler = TimerScheduler(store, noop)
+    scheduler.schedule(1, 'nudge', 1000.0)
+    scheduler.schedule(2, 'time_limit', 2000.0)
+    scheduler.flush()
+    assert sorted(store.load_timers()) == [(1, 'nudge', 1000.0), (2, 'time_limit', 2000.0)]
+
+    scheduler.cancel(1, 'nudge')
+    scheduler.cancel(1, 'nudge')  # повторная отмена ничего не делает
+    assert not scheduler.has(1, 'nudge')
+    scheduler.flush()
+    assert store.load_timers() == [(2, 'time_limit', 2000.0)]
+
+
+def test_load_respects_shards(store):
+    store.save_timers([(user_id, 'nudge', 1000.0) for user_id in (-5, -4, 3, 4)])
+    loaded = {}
+    for shard in (0, 1):
+        scheduler = TimerScheduler(store, noop, shards=2, shard=shard)
+        scheduler.load()
+        loaded[shard] = sorted(user_id for user_id, _ in scheduler.deadlines)
+    assert loaded == {0: [-4, 4], 1: [-5, 3]}
+
+
+def test_schedule_respects_shards(store):
+    scheduler = TimerScheduler(store, noop, shards=2, shard=0)
+    for user_id in (-5, -4, 3, 4):
+        scheduler.schedule(user_id, 'nudge', 1000.0)
+    assert sorted(user_id for user_id, _ in scheduler.deadlines) == [-4, 4]
+    scheduler.flush()
+    assert sorted(user_id for user_id, _, _ in store.load_timers()) == [-4, 4]
+
+
+def test_fires_only_current_deadlines(store):
+    fired = []
+
+    async def callback(user_id, kind):
+        fired.append((user_id, kind))
+
+    async def scenario():
+        scheduler = TimerScheduler(store, callback, coalesce=0)
+        scheduler.start()
+        now = time.time()
+        scheduler.schedule(1, 'nudge', now + 0.05)
+        scheduler.schedule(2, 'nudge', now + 0.05)
+        scheduler.schedule(3, 'nudge', now + 0.05)
+        scheduler.schedule(2, 'nudge', now + 60)  # перенесен
+        scheduler.cancel(3, 'nudge')  # отменен
+        await asyncio.sleep(0.2)
+        await scheduler.stop()
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert fired == [(1, 'nudge')]
+    assert set(scheduler.deadlines) == {(2, 'nudge')}
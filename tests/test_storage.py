@@ -0,0 +1,178 @@
+import json
+import time
+
+import pytest
+
+from actions import ActionCode, ActionRecord
+from storage import RECENT_ACTIONS, LedgerEntry, ProgressChanges, leaderboard_key
+
+
+def hint(seq: int) -> ActionRecord:
+    return ActionRecord(ActionCode.HINT_USED, 1_700_000_000_000 + seq, {'question_id': seq, 'hint_num': 1})
+
+
+def save(store, user_id, events, snapshot=None, current_question=1, result=None):
+    store.save_changes([ProgressChanges(user_id, True, current_question, snapshot, events, result=result)])
+
+
+def test_snapshot_and_replay(store):
+    save(store, 1, [(seq, hint(seq)) for seq in range(30)])
+    save(store, 1, [(seq, hint(seq)) for seq in range(30, 35)],
+         snapshot={'user_id': 1, 'seq': 32, 'state': {'current_question': 4}})
+
+    stored = store.load(1)
+    assert stored.snapshot['state'] == {'current_question': 4}
+    # Повторяются только события с номера снимка
+    assert [seq for seq, _ in stored.events] == [32, 33, 34]
+    assert stored.events[0][1] == hint(32)
+    assert stored.recent == [hint(seq) for seq in range(35 - RECENT_ACTIONS, 35)]
+
+
+def test_without_snapshot_everything_is_replayed(store):
+    save(store, 2, [(seq, hint(seq)) for seq in range(3)])
+    stored = store.load(2)
+    assert stored.snapshot == {'user_id': 2, 'seq': 0, 'state': {}}
+    assert [event for _, event in stored.events] == [hint(seq) for seq in range(3)]
+
+
+def test_update_without_snapshot_keeps_previous_one(store):
+    save(store, 3, [(0, hint(0))], snapshot={'user_id': 3, 'seq': 1, 'state': {'current_question': 2}})
+    save(store, 3, [(1, hint(1))])
+    stored = store.load(3)
+    assert stored.snapshot['seq'] == 1
+    assert [seq for seq, _ in stored.events] == [1]
+
+
+def test_ledger_history_and_totals(store):
+    entries = [
+        LedgerEntry(0, '2025-01-01T00:00:00', 'debit', 'HINT_USED', 1, 1, {'hugs': 5}),
+        LedgerEntry(1, '2025-01-01T00:01:00', 'debit', 'SOLUTION_SHOWN', 1, None, {'wishes': 1}),
+        LedgerEntry(2, '2025-01-01T00:02:00', 'credit', 'DEBT_REPAID', None, None, {'hugs': 3}),
+    ]
+    store.save_changes([ProgressChanges(1, True, 1, None, [], ledger=entries)])
+
+    history = store.load_ledger(1)
+    assert [(row['entry'], row['reason']) for row in history] == [
+        ('debit', 'HINT_USED'), ('debit', 'SOLUTION_SHOWN'), ('credit', 'DEBT_REPAID')]
+    assert history[0]['amounts'] == {'hugs': 5, 'kisses': 0, 'wishes': 0}
+    assert [row['reason'] for row in store.load_ledger(1, limit=1)] == ['DEBT_REPAID']
+    assert store.debt_totals() == {'debit': {'hugs': 5, 'kisses': 0, 'wishes': 1},
+                                   'credit': {'hugs': 3, 'kisses': 0, 'wishes': 0}}
+
+
+def test_open_ledger_moves_balances(store):
+    debts = {1: {'hugs': 5, 'kisses': 10, 'wishes': 0}, 2: {'hugs': 0, 'kisses': 0, 'wishes': 0},
+             3: {'hugs': 8, 'kisses': 0, 'wishes': 1}}
+    for user_id in debts:
+        save(store, user_id, [])
+    # Проводки, записанные до открытия журнала, уже вошли в сохраненный долг
+    store.save_changes([ProgressChanges(3, True, 1, None, [], ledger=[
+        LedgerEntry(0, '2025-01-01T00:00:00', 'debit', 'HINT_USED', 1, 1, {'hugs': 5})])])
+
+    assert store.open_ledger(lambda stored: debts[stored.snapshot['user_id']]) == 2
+    assert [row['reason'] for row in store.load_ledger(1)] == ['OPENING']
+    assert store.load_ledger(2) == []
+    assert store.load_ledger(3)[0]['amounts'] == {'hugs': 3, 'kisses': 0, 'wishes': 1}
+    assert store.get_meta('ledger')['users'] == 2
+    assert store.debt_totals()['debit'] == {'hugs': 13, 'kisses': 10, 'wishes': 1}
+
+
+def legacy(user_id: int) -> dict:
+    return {'user_id': user_id, 'current_question': 3, 'has_started_quest': True,
+            'used_hints': {'1': [1]}, 'action_log': {'actions': []}}
+
+
+def test_import_quarantines_bad_records(store, tmp_path):
+    path = tmp_path / 'progress.json'
+    path.write_text(json.dumps({'1': legacy(1), '2': {'user_id': 2}, '3': legacy(3)}), encoding='utf-8')
+
+    assert store.import_json(str(path)) == 2
+    assert store.load(1) is not None and store.load(3) is not None
+    assert store.load(2) is None
+    with open(f'{path}.quarantine.jsonl', encoding='utf-8') as f:
+        quarantined = [json.loads(line) for line in f]
+    assert [row['key'] for row in quarantined] == ['2']
+    assert 'KeyError' in quarantined[0]['error']
+
+
+def test_truncated_import_keeps_parsed_records(store, tmp_path):
+    path = tmp_path / 'progress.json'
+    text = json.dumps({str(user_id): legacy(user_id) for user_id in (1, 2, 3)})
+    path.write_text(text[:-10], encoding='utf-8')
+
+    with pytest.raises(ValueError):
+        store.import_json(str(path), batch_size=1)
+    assert store.count() == 2
+
+
+def test_archive_and_thaw_round_trip(store):
+    save(store, 4, [(seq, hint(seq)) for seq in range(25)],
+         snapshot={'user_id': 4, 'seq': 20, 'state': {'current_question': 12}}, current_question=12)
+    save(store, 5, [(0, hint(0))])
+    before = store.load(4)
+
+    summaries = []
+    archived = store.archive([4, 404], lambda stored: summaries.append(stored) or {'finished': True})
+    assert archived == 1
+    assert store.count_tiers() == (1, 1)
+    assert store.load_summary(4) == {'finished': True}
+    assert summaries[0].snapshot == before.snapshot
+
+    after = store.load(4)
+    assert store.count_tiers() == (2, 0)
+    assert store.load_summary(4) is None
+    assert after.snapshot == before.snapshot
+    assert after.events == before.events
+    assert after.recent == before.recent
+    # После возвращения из архива игрок снова читается из горячего уровня
+    assert store.load(4).events == before.events
+
+
+def test_cold_candidates_and_segments(store):
+    save(store, 6, [(0, hint(0))], current_question=12)
+    save(store, 7, [(0, hint(0))], current_question=3)
+    later = time.time() + 1
+    assert store.cold_candidates(12, later, 0, 10) == [6]
+    assert sorted(store.cold_candidates(12, 0, later, 10)) == [6, 7]
+    assert store.count_users('finished', 12) == 1
+    assert store.select_users('active', 0, 10, 12) == [7]
+
+
+def test_delete_never_started_in_chunks(store):
+    store.save_changes([ProgressChanges(user_id, False, 1, None, [(0, hint(0))]) for user_id in range(10, 15)])
+    save(store, 20, [(0, hint(0))])
+    later = time.time() + 1
+    assert store.delete_never_started(later, 2) == 2
+    assert store.delete_never_started(later) == 3
+    assert store.count() == 1
+
+
+def result(solutions, hints, duration):
+    return {'quest': 'main', 'name': 'Игрок', 'attempt': 1, 'solutions': solutions, 'hints': hints,
+            'duration': duration, 'finished_at': '2025-01-01T00:00:00+00:00'}
+
+
+def test_leaderboard_keeps_best_result_and_pages_by_key(store):
+    for user_id in range(1, 8):
+        save(store, user_id, [], result=result(user_id % 2, user_id % 3, 100.0))
+    save(store, 1, [], result=result(5, 5, 1.0))  # хуже прежнего - не заменяет
+
+    first = store.leaderboard_rows('main', 3)
+    second = store.leaderboard_rows('main', 3, after=leaderboard_key(first[-1]))
+    third = store.leaderboard_rows('main', 3, after=leaderboard_key(second[-1]))
+    order = [row['user_id'] for row in first + second + third]
+    assert sorted(order) == list(range(1, 8))
+    assert [leaderboard_key(row) for row in first + second + third] == sorted(
+        leaderboard_key(row) for row in first + second + third)
+    assert store.leaderboard_rows('main', 3, before=leaderboard_key(second[0])) == first
+    assert store.leaderboard_key_at('main', 2) == leaderboard_key(first[-1])
+    assert store.leaderboard_place('main', order[4]) == 5
+    assert store.leaderboard_row('main', 1)['solutions'] == 1
+
+
+def test_leaderboard_view_merges_pending_results(store):
+    for user_id in range(1, 5):
+        save(store, user_id, [], result=result(0, user_id, 100.0))
+    rows, total, place = store.leaderboard_view('main', 10, viewer=9, pending={9: result(0, 0, 50.0), 4: None})
+    assert [row['user_id'] for row in rows] == [9, 1, 2, 3]
+    assert (total, place) == (4, 1)